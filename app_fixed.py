@@ -1,12 +1,18 @@
 import streamlit as st
 import cv2
 import numpy as np
-import json
 import os
 import traceback
-from omr.preprocess import detect_sheet_and_warp, read_qr_version
-from omr.detectbub_fixed import detect_from_template, bbox_norm_to_px, choose_selected_option
-from omr.scoring import load_answer_key, compute_scores
+from omr.pipeline import DEFAULT_MIN_BUBBLE_PX, DEFAULT_OUTPUT_SIZE
+from omr.cache import default_cache, default_stage_store
+from omr.incremental import IncrementalGrader
+from omr.template import compile_template
+from omr.registry import default_registry
+from omr.resultset import ResultSet, ResultSetBuilder, preferred_suffix
+from omr.store import IMAGE_FORMATS, default_store
+from omr.batch import iter_grade_batch, default_workers
+from omr.overlay import draw_overlay, draw_bubble_positions
+from omr.selection import SelectionPolicy
 
 # Create results folder
 os.makedirs("results", exist_ok=True)
@@ -24,139 +30,113 @@ with col1:
     uploaded_multi = st.file_uploader("Or upload multiple (zip not supported here) - multi select", accept_multiple_files=True, type=["jpg","jpeg","png"])
 
 with col2:
-    # Only include template files (not answer key files)
-    template_files = [f for f in os.listdir("templates") if f.endswith(".json") and not f.startswith("answers_")]
+    # Only include template files (not answer key files); loaded once per process
+    registry = default_registry("templates")
+    for fn, err in registry.errors.items():
+        st.error(f"Error loading template {fn}: {err}")
+    template_files = registry.names()
     template_choice = st.selectbox("Choose template (or use QR on sheet)", template_files)
-
-# helper to load template JSON
-def load_template(fn):
-    try:
-        with open(os.path.join("templates", fn), "r") as f:
-            return json.load(f)
-    except Exception as e:
-        st.error(f"Error loading template {fn}: {e}")
-        return None
-
-def save_json(obj, path):
-    with open(path, "w") as f:
-        json.dump(obj, f, indent=2)
-
-def draw_overlay(warped_bgr, template, per_question_result):
-    overlay = warped_bgr.copy()
-    h, w = overlay.shape[:2]
-    # draw rectangles and mark selected / correct
-    for entry in template['bubbles']:
-        q = int(entry['q']); opt = entry.get('option')
-        x, y, bw, bh = bbox_norm_to_px(entry['bbox'], w, h)
-        # default color light gray
-        color = (200, 200, 200)
-        # if selected
-        pr = per_question_result.get(q, {})
-        sel = pr.get('selected')
-        correct = pr.get('correct')
-        if sel is not None and opt == sel:
-            # green for correct, red for wrong
-            if correct is True:
-                color = (0, 200, 0)
-            elif correct is False:
-                color = (0, 0, 255)
-            else:
-                color = (0, 200, 200)  # ambiguous
-        cv2.rectangle(overlay, (x, y), (x + bw, y + bh), color, 2)
-    return overlay
-
-def process_single_file(file_bytes, template_fn):
+    batch_workers = st.number_input("Worker processes for multi-file grading", min_value=1,
+                                    max_value=default_workers(), value=default_workers())
+    max_in_flight = st.number_input("Sheets in flight at once for multi-file grading", min_value=1,
+                                    value=2 * default_workers())
+    register_grid = st.checkbox("Align the bubble grid to each sheet (paper curl, lens distortion)", value=False)
+    adaptive_thresholds = st.checkbox("Fit mark thresholds to each sheet (pencil marks, dark scans)", value=False)
+    resolve_unclear = st.checkbox("Decide unclear questions from fill ratios (only the rest go to review)",
+                                  value=False)
+    resolve_margin = st.number_input("Fill ratio lead the darkest option needs", min_value=0.01, max_value=1.0,
+                                     value=0.15, step=0.01)
+    multi_mark = st.selectbox("Clear double marks", ["invalid", "review"])
+    image_format = st.selectbox("Saved image format", ["jpg", "webp", "png", "none"])
+    preview_side = st.number_input("Saved image long side in pixels (0 = full size)", min_value=0, value=1600)
+
+# results are written by a background thread into results/results.jsonl
+# shared by every session, so this session's image settings go with each submit()
+store = default_store("results")
+image_settings = {'image_format': image_format if image_format in IMAGE_FORMATS else None,
+                  'preview_max_side': preview_side or None}
+
+policy = SelectionPolicy(resolve_margin, multi_mark=multi_mark) if resolve_unclear else None
+
+# graded sheets by content hash, so reruns and re-uploads skip the pipeline
+cache = default_cache("results/cache")
+# per-stage outputs, so after a template or answer key edit only the
+# affected stages run again (see omr.incremental)
+stages = default_stage_store("results/stages")
+
+def process_single_file(file_bytes, file_name, template_fn):
     try:
-        arr = np.frombuffer(file_bytes, np.uint8)
-        img = cv2.imdecode(arr, cv2.IMREAD_COLOR)
-
-        if img is None:
-            raise ValueError("Could not decode image file")
-
-        warped = detect_sheet_and_warp(img)
-
-        if warped is None:
-            raise ValueError("Could not detect and warp the sheet")
-
-        # try QR detection
-        version_from_qr = read_qr_version(warped)
-        if version_from_qr:
-            # try find matching template file
-            matching = [f for f in template_files if version_from_qr in f or version_from_qr in f.replace(".json","")]
-            if matching:
-                template_use = load_template(matching[0])
-                if template_use:
-                    st.info(f"Using QR-detected template: {matching[0]}")
-            else:
-                template_use = load_template(template_fn)
-        else:
-            template_use = load_template(template_fn)
-
-        if template_use is None:
+        templates = registry.templates()
+        if template_fn not in templates:
             raise ValueError("Could not load template")
-
-        # detect bubbles
-        detected, ambiguous = detect_from_template(warped, template_use)
-
-        # compute selected per question
-        per_question_selected = {}
-        for q, opts in detected.items():
-            sel = choose_selected_option(opts)
-            per_question_selected[int(q)] = {'selected': sel, 'correct': None}
-
-        # load answer key file for template
-        answer_key_raw = {}
-        # look for "answers" in template file or side-by-side answer key file named key_<template_fn>
-        if 'answers' in template_use:
-            answer_key_raw = template_use['answers']
+        answer_keys = registry.answer_keys()
+
+        key = cache.key(file_bytes, templates, template_fn, answer_keys,
+                        output_size=DEFAULT_OUTPUT_SIZE, min_bubble_px=DEFAULT_MIN_BUBBLE_PX,
+                        register=register_grid, adaptive=adaptive_thresholds, policy=policy)
+        hit = cache.get(key)
+        if hit is not None:
+            warped, result, ambiguous, used_fn = hit['warped'], hit['result'], hit['ambiguous'], hit['template']
+            positions = hit['positions']
+            if positions is not None:
+                # the alignment the first grade applied, not a fresh compile
+                size, xs, ys = positions
+                compiled = compile_template(templates[used_fn], size).moved_to(xs, ys)
+            else:
+                compiled = compile_template(templates[used_fn], (warped.shape[1], warped.shape[0]))
+            ratio_grid = hit['ratios']
+            sheet_id = hit['extra'].get('sheet_id')
         else:
-            # try answers_{version}.json
-            v = template_use.get('version')
-            if v:
-                candidate = f"templates/answers_{v}.json"
-                if os.path.exists(candidate):
-                    try:
-                        with open(candidate) as f:
-                            answer_key_raw = json.load(f)
-                    except Exception as e:
-                        st.warning(f"Could not load answer key {candidate}: {e}")
-
-        if not answer_key_raw:
+            grader = IncrementalGrader(stages, templates, template_fn, answer_keys, register=register_grid,
+                                       adaptive=adaptive_thresholds, policy=policy)
+            _, warped, compiled, result, ambiguous, used_fn, ratios = grader.grade(file_bytes, preview_max_side=0)
+            ratio_grid = compiled.grid(ratios, dtype=np.float16)
+            positions = None
+            if compiled.offsets is not None:
+                positions = (compiled.size, np.asarray(compiled.xs), np.asarray(compiled.ys))
+            sheet_id = None
+
+        if sheet_id is None:
+            # saved once per distinct upload; the overlay is drawn on the writer thread
+            overlay = lambda: draw_overlay(warped, compiled, result['per_question'])
+            sheet_id = store.submit(file_name, result, images={'warped': warped, 'overlay': overlay},
+                                    **image_settings)
+            # on disk before the user is told it was saved
+            store.flush()
+            for err in store.failures(sheet_id):
+                st.error(f"Error saving sheet {sheet_id}: {err}")
+                sheet_id = None
+            # the id is cached only once its record exists, so a later hit
+            # never points at a sheet that was not written
+            cache.put(key, result, ambiguous, used_fn, warped=warped, ratios=ratio_grid,
+                      extra={'sheet_id': sheet_id} if sheet_id is not None else {}, positions=positions)
+
+        if used_fn != template_fn:
+            st.info(f"Using QR-detected template: {used_fn}")
+        if not registry.answer_key(used_fn):
             st.warning("No answer key found - scores will not be calculated")
-            per_question_result = per_question_selected
-            per_subject_score = {}
-            total_score = 0
-        else:
-            # Now compute scores
-            per_subject_score, total_score, per_question_result = compute_scores(detected, template_use, answer_key_raw)
-
-        # Build result dict
-        result = {
-            "per_subject_score": per_subject_score,
-            "total_score": total_score,
-            "per_question": per_question_result,
-            "ambiguous_count": len(ambiguous),
-            "template_used": template_use.get('version', template_fn)
-        }
 
-        return warped, template_use, result, ambiguous
+        return warped, compiled, result, ambiguous, sheet_id
 
     except Exception as e:
         st.error(f"Error processing file: {str(e)}")
         st.error(f"Full traceback: {traceback.format_exc()}")
-        return None, None, None, []
+        return None, None, None, [], None
 
 # handle single file
 if uploaded is not None:
     template_fn = template_choice
     bytes_data = uploaded.getvalue()
-    warped, template_use, result, ambiguous = process_single_file(bytes_data, template_fn)
+    warped, template_use, result, ambiguous, sheet_id = process_single_file(bytes_data, uploaded.name, template_fn)
 
     if warped is not None and result is not None:
         st.subheader("Warped Sheet Preview")
         st.image(cv2.cvtColor(warped, cv2.COLOR_BGR2RGB), use_container_width=True)
 
-        if ambiguous:
+        if result.get('review'):
+            st.warning(f"{len(result['review'])} questions need review: {', '.join(map(str, result['review']))}. "
+                       "They are outlined in orange on the overlay.")
+        elif ambiguous and policy is None:
             st.warning(f"Found {len(ambiguous)} ambiguous bubbles. Check the overlay for details.")
 
         st.subheader("Automated result")
@@ -164,58 +144,67 @@ if uploaded is not None:
 
         # draw overlay
         overlay = draw_overlay(warped, template_use, result['per_question'])
-        st.subheader("Overlay (green=correct, red=wrong, gray=not selected)")
+        st.subheader("Overlay (green=correct, red=wrong, gray=not selected, orange=needs review)")
         st.image(cv2.cvtColor(overlay, cv2.COLOR_BGR2RGB), use_container_width=True)
 
-        # Save outputs
-        idx = len(os.listdir("results/images")) + 1
-        img_path = f"results/images/warped_{idx}.png"
-        ov_path = f"results/overlays/overlay_{idx}.png"
-        json_path = f"results/result_{idx}.json"
-        cv2.imwrite(img_path, warped)
-        cv2.imwrite(ov_path, overlay)
-        with open(json_path, "w") as f:
-            json.dump(result, f, indent=2)
-
-        st.success(f"Saved warped image -> {img_path}, overlay -> {ov_path}, result -> {json_path}")
+        if sheet_id is not None:
+            st.success(f"Saved as sheet #{sheet_id} -> {store.path}")
 
         if warped is not None and template_use is not None:
-            debug_overlay = warped.copy()
-            h, w = debug_overlay.shape[:2]
-            for entry in template_use['bubbles']:
-                x, y, bw, bh = bbox_norm_to_px(entry['bbox'], w, h)
-                cv2.rectangle(debug_overlay, (x, y), (x + bw, y + bh), (255, 0, 0), 2)
+            debug_overlay = draw_bubble_positions(warped, template_use)
             st.image(cv2.cvtColor(debug_overlay, cv2.COLOR_BGR2RGB), caption="Bubble positions overlay", use_container_width=True)
 
-# handle multiple files (simple loop)
+# handle multiple files: bounded decode -> grade -> persist pipeline
 if uploaded_multi:
-    st.info(f"Processing {len(uploaded_multi)} files...")
+    total = len(uploaded_multi)
+    st.info(f"Processing {total} files...")
     template_fn = template_choice
-    csv_rows = []
-    for f in uploaded_multi:
-        try:
-            warped, template_use, result, ambiguous = process_single_file(f.getvalue(), template_fn)
-            if warped is not None and result is not None:
-                idx = len(os.listdir("results/images")) + 1
-                img_path = f"results/images/warped_{idx}.png"
-                ov_path = f"results/overlays/overlay_{idx}.png"
-                json_path = f"results/result_{idx}.json"
-                cv2.imwrite(img_path, warped)
-                overlay = draw_overlay(warped, template_use, result['per_question'])
-                cv2.imwrite(ov_path, overlay)
-                with open(json_path, "w") as jf:
-                    json.dump(result, jf, indent=2)
-                csv_rows.append({"file": f.name, "total": result['total_score']})
-        except Exception as e:
-            st.error(f"Error processing {f.name}: {e}")
-
-    # save CSV
-    if csv_rows:
-        import pandas as pd
-        df = pd.DataFrame(csv_rows)
-        csv_path = "results/batch_results.csv"
-        if os.path.exists(csv_path):
-            df.to_csv(csv_path, mode='a', header=False, index=False)
-        else:
-            df.to_csv(csv_path, index=False)
-        st.success(f"Batch done, results at {csv_path}")
+    templates = registry.templates()
+    batch_rows = ResultSetBuilder()
+    progress_bar = st.progress(0.0)
+
+    # uploads are read one at a time as the pool has room; at most
+    # max_in_flight sheets (bytes, images, results) exist at once, and the
+    # store's bounded queue pushes back when writing falls behind
+    items = ((f.name, f.getvalue()) for f in uploaded_multi)
+    results = iter_grade_batch(items, templates, template_fn, workers=batch_workers,
+                               max_in_flight=max_in_flight, return_images=True,
+                               image_max_side=image_settings['preview_max_side'],
+                               answer_keys=registry.answer_keys(),
+                               fill_ratios=True, register=register_grid, adaptive=adaptive_thresholds,
+                               policy=policy, stages=stages.root)
+    errors = 0
+    sheet_ids = []
+    for done, res in enumerate(results, 1):
+        progress_bar.progress(done / total, text=f"{done}/{total} sheets graded")
+        if res['error'] is not None:
+            errors += 1
+            st.error(f"Error processing {res['name']}: {res['error']}")
+            continue
+        result = res['result']
+        warped = res.pop('warped')
+        template = templates[res['template']]
+        positions = res.pop('positions', None)
+        if positions is not None:
+            # draw the bubbles where the worker's alignment sampled them
+            size, xs, ys = positions
+            template = compile_template(template, size).moved_to(xs, ys)
+        # the overlay is drawn on the writer thread
+        overlay = lambda warped=warped, template=template, pq=result['per_question']: draw_overlay(warped, template, pq)
+        sheet_ids.append(store.submit(res['name'], result, images={'warped': warped, 'overlay': overlay},
+                                      **image_settings))
+        batch_rows.add(res['name'], result, res['template'], ratios=res.pop('ratios', None))
+        del res, warped, overlay
+    store.flush()
+    for sheet_id in sheet_ids:
+        for err in store.failures(sheet_id):
+            st.error(f"Error saving sheet {sheet_id}: {err}")
+
+    # one row per sheet, appended to the columnar batch table
+    if len(batch_rows):
+        table_path = "results/batch_results" + preferred_suffix()
+        batch = batch_rows.build()
+        if os.path.exists(table_path):
+            batch = ResultSet.concat([ResultSet.load(table_path), batch])
+        batch.save(table_path)
+        st.success(f"Batch done, results at {table_path} ({len(batch)} sheets)")
@@ -0,0 +1,290 @@
+"""
+Headless batch grading: fan decode -> warp -> detect -> score out over a process pool.
+
+    results = grade_batch(items, templates, default_name, workers=8, progress=cb)
+    for res in iter_grade_batch(items, templates, default_name): ...
+
+items is an iterable of (name, source) where source is image bytes or a file
+path. Results come back in input order as dicts with 'name', 'template',
+'result', 'ambiguous' and 'error' (None on success). Templates and answer keys
+are compiled in the parent and shipped to every worker once, at pool start.
+"""
+from concurrent.futures import ProcessPoolExecutor, FIRST_COMPLETED, wait
+import os
+import traceback
+
+import cv2
+import numpy as np
+
+from omr import metrics
+from omr.cache import StageStore
+from omr.incremental import IncrementalGrader
+from omr.preprocess import QRVersionReader, template_qr_rois
+from omr.review import crop_ambiguous
+from omr.pipeline import DEFAULT_MIN_BUBBLE_PX, DEFAULT_OUTPUT_SIZE, decode_image, find_answer_key, grade_sheet
+from omr.selection import review_records
+from omr.template import compile_template, grading_size
+
+# state of a pool worker process, set by _init_worker
+_worker = {}
+
+def _worker_state(templates, default_name, answer_keys, output_size, grade_size, return_images, sticky_qr,
+                  review_crops, fill_ratios, image_max_side=None, register=False, adaptive=False,
+                  policy=None, stages=None, ship_metrics=False):
+    """Everything _grade_one needs for one batch, as a dict"""
+    state = {}
+    state['templates'] = templates
+    state['default_name'] = default_name
+    state['answer_keys'] = answer_keys
+    state['output_size'] = output_size
+    state['grading_size'] = grade_size
+    state['return_images'] = return_images
+    state['review_crops'] = review_crops
+    state['fill_ratios'] = fill_ratios
+    state['image_max_side'] = image_max_side
+    state['register'] = register
+    state['adaptive'] = adaptive
+    state['policy'] = policy
+    # JPEGs are decoded at the smallest scale that still covers every canvas
+    decode_size = tuple(grade_size)
+    if return_images:
+        out_w, out_h = output_size
+        scale = min(1.0, image_max_side / float(max(out_w, out_h))) if image_max_side else 1.0
+        decode_size = (max(decode_size[0], round(out_w * scale)), max(decode_size[1], round(out_h * scale)))
+    state['decode_size'] = decode_size
+    state['qr_reader'] = QRVersionReader(*template_qr_rois(templates.values()), sticky=sticky_qr)
+    state['grader'] = None
+    if stages is not None:
+        state['grader'] = IncrementalGrader(StageStore(stages), templates, default_name, answer_keys,
+                                            output_size, grade_size, register=register,
+                                            adaptive=adaptive, policy=policy)
+    state['ship_metrics'] = ship_metrics
+    return state
+
+def _init_worker(*args):
+    _worker.clear()
+    _worker.update(_worker_state(*args))
+    # pool workers record metrics locally and send them back with each result
+    if _worker['ship_metrics']:
+        metrics.enable(memory=_worker['ship_metrics'] == "memory")
+
+def _read_source(source):
+    if isinstance(source, (bytes, bytearray, memoryview)):
+        return bytes(source)
+    with open(source, "rb") as f:
+        return f.read()
+
+def _warp_buffer(state):
+    """
+    Warp destination reused across one worker's or batch's sheets (unless images are
+    returned without review crops, which are cut from it)
+    """
+    if state['return_images'] and not state['review_crops']:
+        return None
+    buf = state.get('warp_buffer')
+    if buf is None:
+        out_w, out_h = state['grading_size']
+        buf = state['warp_buffer'] = np.empty((out_h, out_w), np.uint8)
+    return buf
+
+def _shrink(image, max_side):
+    """Downscale so the long side is at most max_side (None: unchanged)"""
+    h, w = image.shape[:2]
+    if not max_side or max(h, w) <= max_side:
+        return image
+    scale = max_side / float(max(h, w))
+    return cv2.resize(image, (max(1, round(w * scale)), max(1, round(h * scale))), interpolation=cv2.INTER_AREA)
+
+def _grade_one(name, source, state=None):
+    """Grade one sheet with state (a _worker_state), by default the pool worker's own"""
+    if state is None:
+        state = _worker
+    out = {'name': name, 'template': None, 'result': None, 'ambiguous': [], 'error': None}
+    with metrics.stage("sheet"):
+        _grade_into(out, source, state)
+    metrics.count("sheets")
+    if out['error'] is not None:
+        metrics.count("sheets.error")
+    if state['ship_metrics']:
+        out['metrics'] = metrics.drain()
+    return out
+
+def _grade_into(out, source, state):
+    try:
+        grader = state['grader']
+        if grader is not None:
+            preview_side = (state['image_max_side'] or 0) if state['return_images'] else None
+            canvas, warped, compiled, result, ambiguous, template_name, ratios = grader.grade(
+                _read_source(source), preview_side)
+        else:
+            # colour is decoded only when the caller wants images back
+            img = decode_image(_read_source(source), target_size=state['decode_size'],
+                               gray=not state['return_images'])
+            buf = _warp_buffer(state)
+            warped, compiled, result, ambiguous, template_name, ratios = grade_sheet(
+                img, state['templates'], state['default_name'],
+                state['answer_keys'], state['output_size'], buf,
+                grading_size=state['grading_size'], keep_full=state['return_images'],
+                qr_reader=state['qr_reader'], return_ratios=True, gray=True, register=state['register'],
+                adaptive=state['adaptive'], policy=state['policy'])
+            # the grading canvas stays in buf when keep_full warps a new one
+            canvas = warped if buf is None else buf
+            if warped is buf and state['return_images']:
+                warped = warped.copy()
+        out['template'] = template_name
+        out['result'] = result
+        out['ambiguous'] = ambiguous
+        if state['review_crops']:
+            # rects refer to the grading canvas (canvas), not the kept warped;
+            # with a policy only the questions it left open are queued, each one whole
+            if state['policy'] is not None:
+                out['review'] = review_records(compiled, ratios, result['review'])
+            else:
+                out['review'] = ambiguous
+            out['crops'] = crop_ambiguous(canvas, out['review'])
+        if compiled.offsets is not None:
+            # registration moved the bubbles; overlays go where they were sampled
+            out['positions'] = (compiled.size, np.asarray(compiled.xs), np.asarray(compiled.ys))
+        if state['fill_ratios']:
+            out['ratios'] = (compiled.questions, compiled.options, compiled.grid(ratios, dtype=np.float16))
+        if state['return_images']:
+            # the incremental grader already returns its preview at image_max_side
+            out['warped'] = warped if grader is not None else _shrink(warped, state['image_max_side'])
+    except Exception as e:
+        out['error'] = f"{type(e).__name__}: {e}"
+        out['traceback'] = traceback.format_exc()
+
+def prepare_templates(templates, size, answer_keys=None):
+    """Compile every template for size and resolve its answer key (given, or from disk)"""
+    compiled = {}
+    resolved = {}
+    for name, template in templates.items():
+        compiled[name] = compile_template(template, size)
+        if answer_keys is not None and name in answer_keys:
+            resolved[name] = answer_keys[name]
+        else:
+            resolved[name] = find_answer_key(template)
+    return compiled, resolved
+
+def default_workers():
+    return os.cpu_count() or 1
+
+def iter_grade_batch(items, templates, default_name, workers=None, progress=None,
+                     output_size=DEFAULT_OUTPUT_SIZE, return_images=False, max_in_flight=None,
+                     min_bubble_px=DEFAULT_MIN_BUBBLE_PX, sticky_qr=False, answer_keys=None,
+                     review_crops=False, fill_ratios=False, image_max_side=None, register=False,
+                     adaptive=False, policy=None, stages=None):
+    """
+    Grade many sheets, in parallel when workers > 1, yielding results in input order.
+
+    templates: {template file name: loaded template}; default_name is used when
+    no QR version matches. answer_keys ({file name: key}, e.g. from a
+    TemplateRegistry) avoids re-reading keys from disk. progress(done, total, item_result) is called in the
+    parent after each sheet finishes (total is None for unsized iterables).
+    items is consumed lazily: at most max_in_flight sheets (default 2 per
+    worker) are submitted but not yet collected, so input bytes are never all
+    held at once. With return_images=True each result also carries 'warped'
+    at output_size, downscaled in the worker to image_max_side if given. Sheets are graded on the smallest canvas keeping every
+    bubble at least min_bubble_px across (min_bubble_px=None grades at output_size).
+    sticky_qr makes each worker assume its previous sheet's QR version until a
+    decode disagrees (see QRVersionReader). review_crops adds 'crops', small
+    gray arrays of the bubbles in 'review' (the ambiguous ones) for an
+    AmbiguousCropWriter.
+    fill_ratios adds 'ratios' = (questions, options, float16 grid of every
+    bubble's fill ratio, NaN where none) for ResultSetBuilder.add.
+    register moves each sheet's bubble grid onto its printed bubbles before
+    sampling (omr.register), for paper curl and lens distortion; results then
+    carry 'positions' = (canvas size, xs, ys) of the moved bubbles, for
+    compile_template(template, size).moved_to(xs, ys).
+    adaptive fits the marked/blank thresholds to each sheet's fill ratios
+    (omr.calibrate), so pencil marks and dark scans leave fewer ambiguous bubbles.
+    policy (an omr.selection.SelectionPolicy) decides unclear questions from
+    their fill ratios; 'review' then holds every option of the questions it
+    left for a person, instead of every ambiguous bubble.
+    stages is a StageStore root directory: sheets then go through an
+    IncrementalGrader, so re-runs after a template or answer key edit reuse
+    the decoded canvases, QR versions and fill ratios that edit left valid
+    (sticky_qr does not apply there).
+    When omr.metrics is enabled in the parent, workers record stage timings
+    too and they are merged into the parent's metrics as results arrive.
+    """
+    if min_bubble_px is None:
+        grade_size = tuple(output_size)
+    else:
+        grade_size = grading_size(templates.values(), output_size, min_bubble_px)
+    compiled, answer_keys = prepare_templates(templates, grade_size, answer_keys)
+    initargs = (compiled, default_name, answer_keys, output_size, grade_size, return_images, sticky_qr,
+                review_crops, fill_ratios, image_max_side, register, adaptive, policy, stages)
+    try:
+        total = len(items)
+    except TypeError:
+        total = None
+
+    if workers is None:
+        workers = default_workers()
+
+    if workers <= 1:
+        # local state: concurrent in-process batches must not share _worker
+        state = _worker_state(*initargs)
+        done_count = 0
+        for name, source in items:
+            res = _grade_one(name, source, state)
+            done_count += 1
+            if progress is not None:
+                progress(done_count, total, res)
+            yield res
+        return
+
+    if max_in_flight is None:
+        max_in_flight = 2 * workers
+
+    # finished results waiting for an earlier index, so output stays in order
+    ready = {}
+    next_index = 0
+    done_count = 0
+    ship_metrics = False
+    if metrics.enabled():
+        ship_metrics = "memory" if metrics.memory_enabled() else True
+    initargs += (ship_metrics,)
+    with ProcessPoolExecutor(max_workers=workers, initializer=_init_worker, initargs=initargs) as pool:
+        pending = {}
+        it = iter(enumerate(items))
+        exhausted = False
+        while pending or not exhausted:
+            while not exhausted and len(pending) + len(ready) < max_in_flight:
+                try:
+                    i, (name, source) = next(it)
+                except StopIteration:
+                    exhausted = True
+                    break
+                pending[pool.submit(_grade_one, name, source)] = (i, name)
+            if not pending:
+                break
+            finished, _ = wait(pending, return_when=FIRST_COMPLETED)
+            for fut in finished:
+                i, name = pending.pop(fut)
+                try:
+                    res = fut.result()
+                except Exception as e:
+                    # worker crashed or result could not be pickled back
+                    res = {'name': name, 'template': None, 'result': None, 'ambiguous': [],
+                           'error': f"{type(e).__name__}: {e}"}
+                metrics.merge(res.pop('metrics', None))
+                ready[i] = res
+                done_count += 1
+                if progress is not None:
+                    progress(done_count, total, res)
+            while next_index in ready:
+                yield ready.pop(next_index)
+                next_index += 1
+
+def grade_batch(items, templates, default_name, workers=None, progress=None,
+                output_size=DEFAULT_OUTPUT_SIZE, return_images=False, max_in_flight=None,
+                min_bubble_px=DEFAULT_MIN_BUBBLE_PX, sticky_qr=False, answer_keys=None,
+                review_crops=False, fill_ratios=False, image_max_side=None, register=False,
+                adaptive=False, policy=None, stages=None):
+    """Like iter_grade_batch, but returns the whole list of results"""
+    return list(iter_grade_batch(items, templates, default_name, workers, progress,
+                                 output_size, return_images, max_in_flight, min_bubble_px, sticky_qr,
+                                 answer_keys, review_crops, fill_ratios, image_max_side, register, adaptive,
+                                 policy, stages))
@@ -0,0 +1,278 @@
+"""
+Synthetic-sheet benchmarks for every grading stage.
+
+    python -m omr.bench -t templates/seta.json --resolutions 1600 3000 4000 -o bench.json
+    python -m omr.bench -t templates/seta.json --compare bench.json
+
+Renders filled sheets from a template, photographs them (skew, perspective,
+blur, lighting gradient), then times detect_sheet_and_warp, read_qr_version,
+detect_from_template, compute_scores and draw_overlay separately at each
+input resolution. The JSON report holds throughput, p50/p99 latency and peak
+RSS per stage so runs from different commits can be compared.
+"""
+import argparse
+import json
+import platform
+import resource
+import subprocess
+import sys
+import time
+
+import cv2
+import numpy as np
+
+from omr.detectbub_fixed import bbox_norm_to_px, detect_from_template
+from omr.fiducials import parse_fiducials, template_fiducials
+from omr.overlay import draw_overlay
+from omr.preprocess import detect_sheet_and_warp, read_qr_version
+from omr.scoring import compute_scores
+from omr.template import compile_template, grading_size
+
+SHEET_SIZE = (2480, 3508)
+
+def draw_fiducials(sheet, spec):
+    """Print a template's corner markers (see omr.fiducials) onto sheet"""
+    layout = parse_fiducials(spec)
+    h, w = sheet.shape[:2]
+    if layout['type'] == 'aruco':
+        aruco = cv2.aruco
+        dictionary = aruco.getPredefinedDictionary(getattr(aruco, layout['dictionary']))
+        side = int(round(0.04 * w))
+    for i, (cx, cy) in enumerate(layout['centers']):
+        if layout['type'] == 'aruco':
+            marker = cv2.cvtColor(aruco.generateImageMarker(dictionary, layout['ids'][i], side), cv2.COLOR_GRAY2BGR)
+            x0 = int(round(cx * w - side / 2)); y0 = int(round(cy * h - side / 2))
+            sheet[y0:y0 + side, x0:x0 + side] = marker
+        else:
+            mw, mh = layout['size'][0] * w, layout['size'][1] * h
+            cv2.rectangle(sheet, (int(round(cx * w - mw / 2)), int(round(cy * h - mh / 2))),
+                          (int(round(cx * w + mw / 2)) - 1, int(round(cy * h + mh / 2)) - 1), (20, 20, 20), -1)
+    return sheet
+
+def render_sheet(template, size=SHEET_SIZE, fill_density=0.9, fill_level=1.0, seed=0):
+    """
+    Draw a filled answer sheet for template on white paper, with its corner
+    fiducials when the template declares them.
+
+    fill_density: fraction of questions that get a mark
+    fill_level: how much of the bubble the mark covers (0..1)
+    returns: (sheet_bgr, marks {q: option or None})
+    """
+    rng = np.random.default_rng(seed)
+    w, h = size
+    sheet = np.full((h, w, 3), 240, np.uint8)
+    if template.get('fiducials'):
+        draw_fiducials(sheet, template['fiducials'])
+    options = {}
+    for entry in template['bubbles']:
+        if entry.get('bbox') is None:
+            continue
+        x, y, bw, bh = bbox_norm_to_px(entry['bbox'], w, h)
+        options.setdefault(int(entry['q']), []).append((entry.get('option'), (x, y, bw, bh)))
+        cv2.ellipse(sheet, (x + bw // 2, y + bh // 2), (max(1, bw // 2 - 1), max(1, bh // 2 - 1)),
+                    0, 0, 360, (110, 110, 110), 1)
+
+    marks = {}
+    for q, opts in options.items():
+        if rng.random() >= fill_density:
+            marks[q] = None
+            continue
+        opt, (x, y, bw, bh) = opts[rng.integers(len(opts))]
+        marks[q] = opt
+        rx = max(1, int((bw // 2 - 2) * fill_level))
+        ry = max(1, int((bh // 2 - 2) * fill_level))
+        shade = int(rng.integers(20, 70))
+        cv2.ellipse(sheet, (x + bw // 2, y + bh // 2), (rx, ry), 0, 0, 360, (shade, shade, shade), -1)
+    return sheet, marks
+
+def photograph(sheet, long_edge=3000, skew_deg=3.0, perspective=0.03, blur=1.0,
+               lighting=0.25, background=70, seed=0):
+    """
+    Simulate a phone photo of sheet: the page rotated by skew_deg, corners
+    jittered by perspective (fraction of size), a linear lighting gradient of
+    strength lighting, Gaussian blur sigma blur, on a plain background, in a
+    3:4 frame whose long edge is long_edge pixels.
+    returns: (photo_bgr, corners of the page in the photo)
+    """
+    rng = np.random.default_rng(seed)
+    out_h = int(long_edge)
+    out_w = int(long_edge * 3 / 4)
+    sh, sw = sheet.shape[:2]
+
+    # page covers ~80% of the frame, centred, then rotated and jittered
+    scale = 0.8 * min(out_w / sw, out_h / sh)
+    cx, cy = out_w / 2.0, out_h / 2.0
+    half = np.array([[-sw, -sh], [sw, -sh], [sw, sh], [-sw, sh]], np.float64) * scale / 2
+    a = np.deg2rad(skew_deg)
+    rot = np.array([[np.cos(a), -np.sin(a)], [np.sin(a), np.cos(a)]])
+    corners = half @ rot.T + (cx, cy)
+    corners += rng.uniform(-1, 1, corners.shape) * perspective * np.array([out_w, out_h])
+    corners = corners.astype(np.float32)
+
+    src = np.float32([[0, 0], [sw - 1, 0], [sw - 1, sh - 1], [0, sh - 1]])
+    M = cv2.getPerspectiveTransform(src, corners)
+    photo = np.full((out_h, out_w, 3), background, np.uint8)
+    cv2.warpPerspective(sheet, M, (out_w, out_h), dst=photo, borderMode=cv2.BORDER_TRANSPARENT)
+
+    if lighting:
+        gx = np.linspace(1.0 - lighting, 1.0, out_w, dtype=np.float32)
+        gy = np.linspace(1.0, 1.0 - lighting / 2, out_h, dtype=np.float32)
+        gain = gy[:, None] * gx[None, :]
+        photo = np.clip(photo * gain[..., None], 0, 255).astype(np.uint8)
+    if blur:
+        photo = cv2.GaussianBlur(photo, (0, 0), blur)
+    return photo, corners
+
+def _timed(fn, repeat):
+    """Run fn repeat times; returns (last result, list of seconds)"""
+    times = []
+    result = None
+    for _ in range(repeat):
+        t0 = time.perf_counter()
+        result = fn()
+        times.append(time.perf_counter() - t0)
+    return result, times
+
+def _peak_rss_mb():
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # kilobytes on Linux, bytes on macOS
+    return peak / (1024.0 * 1024.0) if sys.platform == "darwin" else peak / 1024.0
+
+def _summary(times):
+    arr = np.asarray(times) * 1000.0
+    total = float(np.sum(arr)) / 1000.0
+    return {
+        "runs": len(times),
+        "p50_ms": round(float(np.percentile(arr, 50)), 3),
+        "p99_ms": round(float(np.percentile(arr, 99)), 3),
+        "mean_ms": round(float(np.mean(arr)), 3),
+        "throughput_per_s": round(len(times) / total, 2) if total > 0 else None,
+        "peak_rss_mb": round(_peak_rss_mb(), 1),
+    }
+
+def bench_resolution(template, long_edge, repeat=10, output_size=SHEET_SIZE, seed=0, fill_density=0.9,
+                     fill_level=1.0, **photo_kw):
+    """
+    Time every stage on one synthetic photo with the given long edge; the
+    sheet is filled as render_sheet's fill_density / fill_level say
+    """
+    sheet, marks = render_sheet(template, fill_density=fill_density, fill_level=fill_level, seed=seed)
+    photo, _ = photograph(sheet, long_edge=long_edge, seed=seed, **photo_kw)
+    del sheet
+    answer_key = {str(q): opt for q, opt in marks.items() if opt is not None}
+
+    stages = {}
+    fiducials = template_fiducials([template])
+    warped, times = _timed(lambda: detect_sheet_and_warp(photo, output_size=output_size, fiducials=fiducials),
+                           repeat)
+    stages["detect_sheet_and_warp"] = _summary(times)
+
+    _, times = _timed(lambda: read_qr_version(warped), repeat)
+    stages["read_qr_version"] = _summary(times)
+
+    compiled = compile_template(template, (warped.shape[1], warped.shape[0]))
+    (detected, ambiguous), times = _timed(lambda: detect_from_template(warped, compiled), repeat)
+    stages["detect_from_template"] = _summary(times)
+
+    (_, _, per_question), times = _timed(lambda: compute_scores(detected, compiled, answer_key), repeat)
+    stages["compute_scores"] = _summary(times)
+
+    _, times = _timed(lambda: draw_overlay(warped, compiled, per_question), repeat)
+    stages["draw_overlay"] = _summary(times)
+
+    correct = sum(1 for q, opt in marks.items() if per_question.get(q, {}).get('selected') == opt)
+    return {
+        "input_size": [int(photo.shape[1]), int(photo.shape[0])],
+        "output_size": list(output_size),
+        "stages": stages,
+        "accuracy": round(correct / float(len(marks)), 4) if marks else None,
+        "ambiguous": len(ambiguous),
+    }
+
+def _git_commit():
+    try:
+        out = subprocess.run(["git", "rev-parse", "--short", "HEAD"], capture_output=True, text=True, timeout=5)
+    except (OSError, subprocess.SubprocessError):
+        return None
+    return out.stdout.strip() or None
+
+def run(template, resolutions=(1600, 3000, 4000), repeat=10, output_size=SHEET_SIZE, fill_density=0.9,
+        fill_level=1.0, **photo_kw):
+    report = {
+        "commit": _git_commit(),
+        "python": platform.python_version(),
+        "opencv": cv2.__version__,
+        "numpy": np.__version__,
+        "threads": cv2.getNumThreads(),
+        "template": template.get('version'),
+        "repeat": repeat,
+        "sheet": {"fill_density": fill_density, "fill_level": fill_level},
+        "photo": photo_kw,
+        "results": [],
+    }
+    for long_edge in resolutions:
+        report["results"].append(bench_resolution(template, long_edge, repeat, output_size,
+                                                   fill_density=fill_density, fill_level=fill_level,
+                                                   **photo_kw))
+    return report
+
+def compare(old, new):
+    """Lines of p50 ratios new/old per (resolution, stage)"""
+    lines = []
+    old_by_size = {tuple(r["input_size"]): r for r in old["results"]}
+    for r in new["results"]:
+        prev = old_by_size.get(tuple(r["input_size"]))
+        if prev is None:
+            continue
+        for stage, s in r["stages"].items():
+            p = prev["stages"].get(stage)
+            if not p or not p["p50_ms"]:
+                continue
+            ratio = s["p50_ms"] / p["p50_ms"]
+            lines.append(f"{r['input_size'][0]}x{r['input_size'][1]} {stage:24s} "
+                         f"{p['p50_ms']:9.2f} -> {s['p50_ms']:9.2f} ms  x{ratio:.2f}")
+    return lines
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(prog="omr.bench", description="Benchmark OMR grading stages on synthetic sheets.")
+    parser.add_argument("-t", "--template", default="templates/seta.json")
+    parser.add_argument("--resolutions", type=int, nargs="+", default=[1600, 3000, 4000],
+                        help="long edge of the synthetic photos, in pixels")
+    parser.add_argument("-n", "--repeat", type=int, default=10)
+    parser.add_argument("--fill-density", type=float, default=0.9, help="fraction of questions marked")
+    parser.add_argument("--fill-level", type=float, default=1.0,
+                        help="how much of the bubble a mark covers (0..1); lower for pencil-like marks")
+    parser.add_argument("--skew", type=float, default=3.0, help="page rotation in degrees")
+    parser.add_argument("--perspective", type=float, default=0.03)
+    parser.add_argument("--blur", type=float, default=1.0)
+    parser.add_argument("--lighting", type=float, default=0.25)
+    parser.add_argument("--min-bubble-px", type=int, default=0,
+                        help="warp to the grading canvas for this bubble size instead of the full sheet size")
+    parser.add_argument("-o", "--output", default=None, help="write the JSON report here (default: stdout)")
+    parser.add_argument("--compare", default=None, help="previous JSON report to compare p50s against")
+    args = parser.parse_args(argv)
+
+    with open(args.template) as f:
+        template = json.load(f)
+    output_size = SHEET_SIZE
+    if args.min_bubble_px:
+        output_size = grading_size(template, SHEET_SIZE, args.min_bubble_px)
+    report = run(template, args.resolutions, args.repeat, output_size, fill_density=args.fill_density,
+                 fill_level=args.fill_level, skew_deg=args.skew,
+                 perspective=args.perspective, blur=args.blur, lighting=args.lighting)
+
+    text = json.dumps(report, indent=2)
+    if args.output:
+        with open(args.output, "w") as f:
+            f.write(text + "\n")
+    else:
+        print(text)
+    if args.compare:
+        with open(args.compare) as f:
+            old = json.load(f)
+        for line in compare(old, report):
+            print(line, file=sys.stderr)
+    return 0
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,315 @@
+"""
+Content-addressed cache of graded sheets.
+
+    cache = default_cache("results/cache")
+    key = cache.key(file_bytes, templates, default_name, answer_keys, output_size=(2480, 3508))
+    entry = cache.get(key)
+    if entry is None:
+        ...grade...
+        cache.put(key, result, ambiguous, template_name, warped=warped, ratios=ratios)
+
+The key hashes the image bytes together with every candidate template, the
+answer keys and the pipeline parameters, so editing a template or key, or
+changing a parameter, misses instead of serving a stale grade. Entries live
+on disk as one .npz each with size-bounded LRU eviction; the most recent ones
+are also kept decoded in memory so Streamlit reruns return at once.
+"""
+from collections import OrderedDict
+import hashlib
+import json
+import os
+import threading
+
+import cv2
+import numpy as np
+
+from omr.store import encode_image
+from omr.template import CompiledTemplate
+
+_fingerprints = {}
+_fingerprints_lock = threading.Lock()
+
+def _json_digest(obj):
+    data = json.dumps(obj, sort_keys=True, separators=(",", ":"), default=str).encode()
+    return hashlib.blake2b(data, digest_size=16).hexdigest()
+
+def fingerprint(obj):
+    """
+    Digest of a template or answer key's content, memoized by identity like
+    compile_template (so dicts must not be mutated once fingerprinted).
+    """
+    if isinstance(obj, CompiledTemplate):
+        obj = obj.template
+    key = id(obj)
+    with _fingerprints_lock:
+        hit = _fingerprints.get(key)
+        if hit is not None and hit[0] is obj:
+            return hit[1]
+    digest = _json_digest(obj)
+    with _fingerprints_lock:
+        if len(_fingerprints) > 256:
+            _fingerprints.clear()
+        _fingerprints[key] = (obj, digest)
+    return digest
+
+def _scan_entries(root):
+    """(mtime, path, size) of every .npz entry in root's subdirectories, recursively"""
+    entries = []
+    for dirpath, _, filenames in os.walk(root):
+        if dirpath == root:
+            continue
+        for fn in filenames:
+            if not fn.endswith(".npz"):
+                continue
+            path = os.path.join(dirpath, fn)
+            try:
+                st = os.stat(path)
+            except OSError:
+                continue
+            entries.append((st.st_mtime, path, st.st_size))
+    return entries
+
+def _evict_entries(root, max_bytes):
+    """Remove least recently used entries under root down to 90% of max_bytes; returns bytes left"""
+    entries = sorted(_scan_entries(root))
+    total = sum(size for _, _, size in entries)
+    target = max_bytes * 0.9
+    for _, path, size in entries:
+        if total <= target:
+            break
+        try:
+            os.remove(path)
+        except OSError:
+            continue
+        total -= size
+    return total
+
+def _write_npz(path, arrays):
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    tmp = f"{path}.{os.getpid()}.{threading.get_ident()}.tmp"
+    with open(tmp, "wb") as f:
+        np.savez(f, **arrays)
+    os.replace(tmp, path)
+
+class ResultCache:
+    """
+    Disk + memory cache of grading results keyed by key().
+
+    max_bytes: disk budget; least recently used entries are removed past it
+    memory_items: entries kept decoded in memory
+    warped_format / warped_quality / warped_max_side: how the warped image is
+        kept (None for warped_max_side keeps it at full size)
+    """
+
+    def __init__(self, root="results/cache", max_bytes=512 * 1024 * 1024, memory_items=16,
+                 warped_format="jpg", warped_quality=90, warped_max_side=None):
+        self.root = root
+        self.max_bytes = max_bytes
+        self.memory_items = memory_items
+        self.warped_format = warped_format
+        self.warped_quality = warped_quality
+        self.warped_max_side = warped_max_side
+        self.hits = 0
+        self.misses = 0
+        os.makedirs(root, exist_ok=True)
+        self._lock = threading.Lock()
+        self._memory = OrderedDict()
+        self._disk_bytes = sum(size for _, _, size in self._scan())
+
+    def key(self, file_bytes, templates, default_name, answer_keys=None, **params):
+        """
+        Cache key for grading file_bytes with templates ({name: template}),
+        default_name, answer_keys ({name: key}) and any other pipeline
+        parameters passed as keywords (output_size, min_bubble_px, ...).
+        """
+        h = hashlib.blake2b(digest_size=20)
+        h.update(file_bytes)
+        h.update(b"\0")
+        parts = {
+            'templates': {name: fingerprint(t) for name, t in templates.items()},
+            'default': default_name,
+            'answers': {name: fingerprint(k) for name, k in (answer_keys or {}).items()},
+            'params': params,
+        }
+        h.update(json.dumps(parts, sort_keys=True, default=str).encode())
+        return h.hexdigest()
+
+    def _path(self, key):
+        return os.path.join(self.root, key[:2], key + ".npz")
+
+    def _scan(self):
+        return _scan_entries(self.root)
+
+    def _remember(self, key, entry):
+        with self._lock:
+            self._memory[key] = entry
+            self._memory.move_to_end(key)
+            while len(self._memory) > self.memory_items:
+                self._memory.popitem(last=False)
+
+    def get(self, key):
+        """
+        Cached entry as a dict with 'result', 'ambiguous', 'template',
+        'warped' (array or None), 'ratios' (array or None), 'positions'
+        ((canvas size, xs, ys) or None) and 'extra'; None on a miss. Treat it
+        as read-only.
+        """
+        with self._lock:
+            entry = self._memory.get(key)
+            if entry is not None:
+                self._memory.move_to_end(key)
+                self.hits += 1
+                return entry
+        path = self._path(key)
+        try:
+            with np.load(path) as data:
+                meta = json.loads(data['meta'].tobytes().decode())
+                warped = data['warped'] if 'warped' in data.files else None
+                ratios = data['ratios'] if 'ratios' in data.files else None
+                positions = None
+                if 'xs' in data.files:
+                    positions = (tuple(meta['canvas']), data['xs'], data['ys'])
+            os.utime(path)  # mtime doubles as last-use time for eviction
+        except (OSError, ValueError, KeyError):
+            self.misses += 1
+            return None
+        if warped is not None:
+            warped = cv2.imdecode(warped, cv2.IMREAD_COLOR)
+        entry = {'result': meta['result'], 'ambiguous': meta['ambiguous'], 'template': meta['template'],
+                 'warped': warped, 'ratios': ratios, 'positions': positions, 'extra': meta.get('extra') or {}}
+        # JSON turned the per-question keys into strings
+        entry['result']['per_question'] = {int(q): r for q, r in entry['result'].get('per_question', {}).items()}
+        for amb in entry['ambiguous']:
+            if amb.get('rect') is not None:
+                amb['rect'] = tuple(amb['rect'])
+        self._remember(key, entry)
+        self.hits += 1
+        return entry
+
+    def put(self, key, result, ambiguous, template, warped=None, ratios=None, extra=None, positions=None):
+        """
+        Store one graded sheet; ambiguous crops are dropped, the warped image re-encoded.
+        positions: (canvas size, xs, ys) of bubbles registration moved, so a hit
+        can rebuild the template where they were sampled (CompiledTemplate.moved_to)
+        """
+        ambiguous = [{k: v for k, v in amb.items() if k != 'crop'} for amb in ambiguous]
+        meta = {'result': result, 'ambiguous': ambiguous, 'template': template, 'extra': extra or {}}
+        if positions is not None:
+            meta['canvas'] = [int(v) for v in positions[0]]
+        arrays = {'meta': np.frombuffer(json.dumps(meta, default=str).encode(), np.uint8)}
+        if warped is not None:
+            arrays['warped'] = np.frombuffer(encode_image(warped, self.warped_format, self.warped_quality,
+                                                          self.warped_max_side), np.uint8)
+        if ratios is not None:
+            arrays['ratios'] = np.asarray(ratios, np.float16)
+        if positions is not None:
+            arrays['xs'] = np.asarray(positions[1])
+            arrays['ys'] = np.asarray(positions[2])
+
+        path = self._path(key)
+        old_size = os.path.getsize(path) if os.path.exists(path) else 0
+        _write_npz(path, arrays)
+        with self._lock:
+            self._disk_bytes += os.path.getsize(path) - old_size
+        self._remember(key, {'result': result, 'ambiguous': ambiguous, 'template': template,
+                             'warped': warped, 'ratios': ratios, 'positions': positions,
+                             'extra': extra or {}})
+        if self._disk_bytes > self.max_bytes:
+            self.evict()
+
+    def evict(self):
+        """Remove least recently used entries until the disk budget is met"""
+        total = _evict_entries(self.root, self.max_bytes)
+        with self._lock:
+            self._disk_bytes = total
+
+    def clear(self):
+        with self._lock:
+            self._memory.clear()
+        for _, path, _ in self._scan():
+            try:
+                os.remove(path)
+            except OSError:
+                pass
+        with self._lock:
+            self._disk_bytes = 0
+
+class StageStore:
+    """
+    Disk store of intermediate pipeline outputs (see omr.incremental).
+
+    Each entry is one .npz of arrays plus a JSON 'meta' under
+    root/<stage>/<key[:2]>/<key>.npz, where key digests every input of that
+    stage; writes are atomic, so worker processes can share one root.
+    Least recently used entries are removed past max_bytes.
+    """
+
+    def __init__(self, root="results/stages", max_bytes=2 * 1024 * 1024 * 1024):
+        self.root = root
+        self.max_bytes = max_bytes
+        os.makedirs(root, exist_ok=True)
+        self._lock = threading.Lock()
+        self._disk_bytes = sum(size for _, _, size in _scan_entries(root))
+
+    @staticmethod
+    def key(*parts):
+        """Digest of a stage's inputs: bytes are hashed as they are, anything else as JSON"""
+        h = hashlib.blake2b(digest_size=20)
+        for part in parts:
+            if not isinstance(part, (bytes, bytearray, memoryview)):
+                part = json.dumps(part, sort_keys=True, separators=(",", ":"), default=str).encode()
+            h.update(part)
+            h.update(b"\0")
+        return h.hexdigest()
+
+    def _path(self, stage, key):
+        return os.path.join(self.root, stage, key[:2], key + ".npz")
+
+    def get(self, stage, key):
+        """{'meta': dict, name: array, ...} stored for (stage, key), or None"""
+        path = self._path(stage, key)
+        try:
+            with np.load(path) as data:
+                entry = {name: data[name] for name in data.files}
+            os.utime(path)
+        except (OSError, ValueError, KeyError):
+            return None
+        entry['meta'] = json.loads(entry['meta'].tobytes().decode()) if 'meta' in entry else {}
+        return entry
+
+    def put(self, stage, key, meta=None, **arrays):
+        arrays['meta'] = np.frombuffer(json.dumps(meta or {}, default=str).encode(), np.uint8)
+        path = self._path(stage, key)
+        old_size = os.path.getsize(path) if os.path.exists(path) else 0
+        _write_npz(path, arrays)
+        with self._lock:
+            self._disk_bytes += os.path.getsize(path) - old_size
+            over = self._disk_bytes > self.max_bytes
+        if over:
+            total = _evict_entries(self.root, self.max_bytes)
+            with self._lock:
+                self._disk_bytes = total
+
+
+_caches = {}
+_caches_lock = threading.Lock()
+
+def default_cache(root="results/cache", **kwargs):
+    """Process-wide ResultCache for root, created with kwargs on first use"""
+    key = os.path.abspath(root)
+    with _caches_lock:
+        cache = _caches.get(key)
+        if cache is None:
+            cache = _caches[key] = ResultCache(root, **kwargs)
+        return cache
+
+_stage_stores = {}
+
+def default_stage_store(root="results/stages", **kwargs):
+    """Process-wide StageStore for root, created with kwargs on first use"""
+    key = os.path.abspath(root)
+    with _caches_lock:
+        stages = _stage_stores.get(key)
+        if stages is None:
+            stages = _stage_stores[key] = StageStore(root, **kwargs)
+        return stages
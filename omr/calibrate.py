@@ -0,0 +1,132 @@
+"""
+Per-sheet calibration of the marked/blank decision from the fill ratios.
+
+Fixed thresholds (0.12 / 0.40) suit dark, fully filled marks on a clean scan.
+Pencil marks fill less of the bubble and shadows raise the ratio of blank
+ones, so both end up in the ambiguous band together. With adaptive=True,
+grid_states / bubble_states fit the thresholds on each sheet instead:
+
+  1. rows: the lightest option of every question is taken as that row's paper
+     level, and rows above the sheet's blank level are shifted down by the
+     difference (at most row_shift of the gap), which evens out shadows
+  2. sheet: a two-cluster (Otsu) split of the shifted ratios gives a blank
+     mean, a marked mean and the threshold between them; only bubbles within
+     band x gap of that threshold stay ambiguous. The fitted thresholds are
+     kept inside [low_thresh, high_thresh]: a ratio the fixed thresholds
+     already decide is never overturned, only the band between them narrows
+  3. ties: an ambiguous bubble that is the darkest of its row by margin x gap
+     is marked; one is blank only when an option of its row that step 2
+     already marked beats it by that much. Anything else stays ambiguous, so
+     faint true marks reach review instead of being dropped
+
+A sheet whose clusters are less than min_gap apart (blank or uniformly
+marked) keeps the fixed thresholds.
+"""
+import numpy as np
+
+from omr import metrics
+
+MARKED = 1
+BLANK = 0
+AMBIGUOUS = -1
+
+def _fixed_states(ratios, low_thresh, high_thresh):
+    states = np.full(ratios.shape, AMBIGUOUS, np.int8)
+    states[ratios >= high_thresh] = MARKED
+    states[ratios <= low_thresh] = BLANK
+    return states
+
+def two_cluster_split(ratios):
+    """
+    (threshold, blank mean, marked mean) of the split of ratios that
+    maximizes the between-cluster variance, or None without two distinct values
+    """
+    r = np.sort(np.asarray(ratios, np.float64))
+    n = len(r)
+    if n < 2 or r[0] == r[-1]:
+        return None
+    cs = np.cumsum(r)
+    k = np.arange(1, n)
+    low_mean = cs[:-1] / k
+    high_mean = (cs[-1] - cs[:-1]) / (n - k)
+    variance = k * (n - k) * (high_mean - low_mean) ** 2
+    # a split between equal values is not a split
+    variance[r[1:] == r[:-1]] = -1.0
+    i = int(np.argmax(variance))
+    return (r[i] + r[i + 1]) / 2.0, low_mean[i], high_mean[i]
+
+def _row_floors(grid):
+    """Lightest ratio of every question row (0 for rows with fewer than two options)"""
+    has = ~np.isnan(grid)
+    multi = has.sum(axis=1) > 1
+    floors = np.zeros(len(grid))
+    floors[multi] = np.nanmin(grid[multi], axis=1)
+    return floors, multi
+
+def _break_ties(grid, states, margin):
+    """
+    Resolve ambiguous bubbles by their darkness relative to the rest of their
+    row. Only a bubble the thresholds already mark can make another one blank:
+    a lighter bubble next to a merely ambiguous leader stays ambiguous.
+    """
+    ranked = -np.sort(-np.nan_to_num(grid, nan=-np.inf), axis=1)
+    first = ranked[:, :1]
+    second = ranked[:, 1:2] if grid.shape[1] > 1 else np.full_like(first, -np.inf)
+    marked = np.where(states == MARKED, grid, -np.inf).max(axis=1, keepdims=True)
+    ambiguous = states == AMBIGUOUS
+    darkest = ambiguous & (grid == first) & (first - second >= margin)
+    beaten = ambiguous & (marked - grid >= margin)
+    states[darkest] = MARKED
+    states[beaten] = BLANK
+    return int(darkest.sum() + beaten.sum())
+
+def grid_states(grid, low_thresh=0.12, high_thresh=0.40, adaptive=False,
+                band=0.2, min_gap=0.1, row_shift=0.4, margin=0.5):
+    """
+    MARKED / BLANK / AMBIGUOUS (int8) for one sheet's (questions x options)
+    fill ratio grid, NaN where there is no bubble (AMBIGUOUS there).
+
+    adaptive=False applies low_thresh / high_thresh as they are. adaptive=True
+    fits them per sheet and per question (see the module docstring); band,
+    row_shift and margin are fractions of the gap between the blank and
+    marked cluster means.
+    """
+    grid = np.asarray(grid, np.float64)
+    if not adaptive:
+        return _fixed_states(grid, low_thresh, high_thresh)
+
+    ratios = grid[~np.isnan(grid)]
+    split = two_cluster_split(ratios)
+    if split is None or split[2] - split[1] < min_gap:
+        metrics.count("calibrate.fixed")
+        return _fixed_states(grid, low_thresh, high_thresh)
+    _, blank, marked = split
+
+    floors, multi = _row_floors(grid)
+    shift = np.where(multi, np.clip(floors - blank, 0.0, row_shift * (marked - blank)), 0.0)[:, None]
+    shifted = grid - shift
+    split = two_cluster_split(shifted[~np.isnan(shifted)])
+    if split is None or split[2] - split[1] < min_gap:
+        metrics.count("calibrate.fixed")
+        return _fixed_states(grid, low_thresh, high_thresh)
+    threshold, blank, marked = split
+    gap = marked - blank
+
+    # per-question thresholds, clipped into the fixed band (step 2)
+    half = band * gap
+    low = np.clip(threshold - half + shift, low_thresh, high_thresh)
+    high = np.clip(threshold + half + shift, low_thresh, high_thresh)
+    states = _fixed_states(grid, low, high)
+    resolved = _break_ties(shifted, states, margin * gap)
+    metrics.count("calibrate.sheets")
+    metrics.count("calibrate.row_resolved", resolved)
+    return states
+
+def bubble_states(ct, ratios, low_thresh=0.12, high_thresh=0.40, adaptive=False, **kwargs):
+    """grid_states for fill ratios aligned with ct.keys (a CompiledTemplate), aligned the same way"""
+    ratios = np.asarray(ratios, np.float64)
+    if not adaptive or len(ratios) == 0:
+        return _fixed_states(ratios, low_thresh, high_thresh)
+    states = grid_states(ct.grid(ratios, fill=np.nan, dtype=np.float64), low_thresh, high_thresh,
+                         adaptive, **kwargs)
+    return states[ct.q_row, ct.option_index]
@@ -0,0 +1,240 @@
+"""
+Grade scanned OMR sheets from the command line, without Streamlit.
+
+    python -m omr scans/ exams.zip "more/**/*.jpg" -t setb.json -o results/batch.jsonl
+
+Results are appended one record per sheet as they finish (JSONL or CSV,
+chosen by the output extension). Re-running with the same output skips every
+sheet already recorded there, so an interrupted run resumes where it stopped.
+"""
+import argparse
+import csv
+import json
+import os
+import sys
+
+import numpy as np
+
+from omr import metrics
+from omr.batch import default_workers, iter_grade_batch
+from omr.pipeline import DEFAULT_MIN_BUBBLE_PX
+from omr.registry import TemplateRegistry
+from omr.resultset import ResultSet, ResultSetBuilder
+from omr.review import AmbiguousCropWriter
+from omr.selection import SelectionPolicy
+from omr.sources import iter_images
+
+CSV_FIELDS = ["file", "template", "total_score", "ambiguous_count", "per_subject_score", "error"]
+
+def to_record(res):
+    result = res['result'] or {}
+    return {
+        "file": res['name'],
+        "template": res['template'],
+        "total_score": result.get('total_score'),
+        "ambiguous_count": result.get('ambiguous_count'),
+        "per_subject_score": result.get('per_subject_score'),
+        "per_question": result.get('per_question'),
+        "review": result.get('review'),
+        "error": res['error'],
+    }
+
+def _truncate_partial_line(path):
+    """Drop a trailing half-written record left by a killed run"""
+    with open(path, "rb+") as f:
+        data = f.read()
+        if data and not data.endswith(b"\n"):
+            f.truncate(data.rfind(b"\n") + 1)
+
+def read_done(path, fmt, retry_errors=False):
+    """Names already recorded in an existing output file"""
+    done = set()
+    if not os.path.exists(path):
+        return done
+    if fmt == "columnar":
+        rs = ResultSet.load(path)
+        keep = rs.errors == "" if retry_errors else slice(None)
+        return set(rs.names[keep].tolist())
+    _truncate_partial_line(path)
+    with open(path, newline="") as f:
+        if fmt == "csv":
+            records = csv.DictReader(f)
+        else:
+            records = (json.loads(line) for line in f if line.strip())
+        for rec in records:
+            if retry_errors and rec.get('error'):
+                continue
+            done.add(rec['file'])
+    return done
+
+class ResultWriter:
+    """Append-only JSONL/CSV writer that flushes after every record"""
+
+    def __init__(self, path, fmt):
+        self.fmt = fmt
+        new_file = not os.path.exists(path) or os.path.getsize(path) == 0
+        self.f = open(path, "a", newline="")
+        if fmt == "csv":
+            self.csv = csv.DictWriter(self.f, fieldnames=CSV_FIELDS, extrasaction="ignore")
+            if new_file:
+                self.csv.writeheader()
+
+    def write(self, record):
+        if self.fmt == "csv":
+            record = dict(record, per_subject_score=json.dumps(record['per_subject_score']),
+                          error=record['error'] or "")
+            self.csv.writerow(record)
+        else:
+            self.f.write(json.dumps(record) + "\n")
+        self.f.flush()
+
+    def close(self):
+        self.f.close()
+
+class ColumnarResultWriter:
+    """
+    Collects records into a ResultSet and writes the whole file on close(),
+    merged with the rows already in it (re-graded sheets replace theirs).
+    """
+
+    def __init__(self, path):
+        self.path = path
+        self.builder = ResultSetBuilder()
+
+    def write(self, record, ratios=None):
+        self.builder.add(record['file'], record, record['template'], record['error'], ratios)
+
+    def close(self):
+        rs = self.builder.build()
+        if os.path.exists(self.path):
+            old = ResultSet.load(self.path)
+            old = old.subset(~np.isin(old.names, rs.names))
+            rs = ResultSet.concat([old, rs])
+        rs.save(self.path)
+
+def output_format(path):
+    ext = os.path.splitext(path)[1].lower()
+    if ext == ".csv":
+        return "csv"
+    if ext in (".parquet", ".arrow", ".feather", ".ipc", ".npz"):
+        return "columnar"
+    return "jsonl"
+
+def build_parser():
+    parser = argparse.ArgumentParser(prog="omr", description="Grade OMR sheet scans without the Streamlit UI.")
+    parser.add_argument("inputs", nargs="+", help="directories, globs, image files, or zip/tar archives")
+    parser.add_argument("-t", "--template", required=True,
+                        help="template file name used when no QR version matches (e.g. setb.json)")
+    parser.add_argument("--templates-dir", default="templates")
+    parser.add_argument("-o", "--output", default="results/batch_results.jsonl",
+                        help="results file: .csv writes CSV; .parquet/.arrow (pyarrow) or .npz a columnar "
+                             "table written when the run ends; anything else JSONL")
+    parser.add_argument("-j", "--workers", type=int, default=default_workers())
+    parser.add_argument("--chunk-size", type=int, default=None,
+                        help="max sheets in flight at once (default 2 per worker)")
+    parser.add_argument("--min-bubble-px", type=int, default=DEFAULT_MIN_BUBBLE_PX,
+                        help="grade on the smallest canvas keeping bubbles this many pixels across (0: full size)")
+    parser.add_argument("--sticky-qr", action="store_true",
+                        help="assume the previous sheet's QR version until a decode disagrees")
+    parser.add_argument("--review-crops", metavar="PREFIX", default=None,
+                        help="write ambiguous bubble crops (with --resolve: the options of every question "
+                             "left for review) to PREFIX.crops.npy / PREFIX.index.npz")
+    parser.add_argument("--register", action="store_true",
+                        help="align each sheet's bubble grid to its printed bubbles before sampling "
+                             "(paper curl, lens distortion)")
+    parser.add_argument("--adaptive", action="store_true",
+                        help="fit the marked/blank thresholds to each sheet's fill ratios "
+                             "(pencil marks, dark scans)")
+    parser.add_argument("--resolve", action="store_true",
+                        help="decide unclear questions from the options' fill ratios and record which "
+                             "questions still need review")
+    parser.add_argument("--resolve-margin", type=float, default=0.15,
+                        help="with --resolve, fill ratio lead the darkest option needs over the next one")
+    parser.add_argument("--multi-mark", choices=["invalid", "review"], default="invalid",
+                        help="with --resolve, whether clear double marks count as unanswered or go to review")
+    parser.add_argument("--stages", metavar="DIR", default=None,
+                        help="keep per-stage outputs (canvas, QR, fill ratios) under DIR so re-runs after a "
+                             "template or answer key edit only redo the stages it affects")
+    parser.add_argument("--pattern", default=None, help="fnmatch filter for archive member names")
+    parser.add_argument("--retry-errors", action="store_true", help="re-grade sheets recorded with an error")
+    parser.add_argument("--metrics", metavar="PATH", default=None,
+                        help="record per-stage timings and counters to PATH (Prometheus text, or JSON for *.json)")
+    parser.add_argument("--metrics-memory", action="store_true",
+                        help="with --metrics, also track bytes allocated per stage (slower)")
+    parser.add_argument("-q", "--quiet", action="store_true")
+    return parser
+
+def write_metrics(path):
+    if path.lower().endswith(".json"):
+        metrics.write_json(path)
+    else:
+        metrics.write_prometheus(path)
+
+def main(argv=None):
+    args = build_parser().parse_args(argv)
+    fmt = output_format(args.output)
+
+    registry = TemplateRegistry(args.templates_dir)
+    for fn, err in registry.errors.items():
+        print(f"omr: could not load template {fn}: {err}", file=sys.stderr)
+    templates = registry.templates()
+    if args.template not in templates:
+        print(f"omr: template {args.template} not found in {args.templates_dir}", file=sys.stderr)
+        return 2
+
+    out_dir = os.path.dirname(args.output)
+    if out_dir:
+        os.makedirs(out_dir, exist_ok=True)
+    done = read_done(args.output, fmt, args.retry_errors)
+    items = iter_images(args.inputs, args.pattern, skip=done)
+    policy = SelectionPolicy(args.resolve_margin, multi_mark=args.multi_mark) if args.resolve else None
+
+    if args.metrics:
+        metrics.enable(memory=args.metrics_memory)
+
+    errors = 0
+    graded = 0
+
+    def progress(count, total, res):
+        if count % 50 == 0:
+            if not args.quiet:
+                print(f"graded {count} sheets", file=sys.stderr)
+            if args.metrics:
+                write_metrics(args.metrics)
+
+    writer = ColumnarResultWriter(args.output) if fmt == "columnar" else ResultWriter(args.output, fmt)
+    review = AmbiguousCropWriter(args.review_crops) if args.review_crops else None
+    try:
+        for res in iter_grade_batch(items, templates, args.template, workers=args.workers,
+                                    progress=progress, max_in_flight=args.chunk_size,
+                                    min_bubble_px=args.min_bubble_px or None, sticky_qr=args.sticky_qr,
+                                    answer_keys=registry.answer_keys(),
+                                    review_crops=review is not None, fill_ratios=fmt == "columnar",
+                                    register=args.register, adaptive=args.adaptive, policy=policy,
+                                    stages=args.stages):
+            if fmt == "columnar":
+                # keep raw fill ratios so the table can be regraded later
+                writer.write(to_record(res), res.pop('ratios', None))
+            else:
+                writer.write(to_record(res))
+            if review is not None and res['error'] is None:
+                review.add(res['name'], res.pop('review'), crops=res.pop('crops'))
+            graded += 1
+            if res['error'] is not None:
+                errors += 1
+                if not args.quiet:
+                    print(f"{res['name']}: {res['error']}", file=sys.stderr)
+    finally:
+        writer.close()
+        if review is not None:
+            review.close()
+        if args.metrics:
+            write_metrics(args.metrics)
+
+    if not args.quiet:
+        print(f"graded {graded} sheets ({errors} errors, {len(done)} skipped as already done) -> {args.output}",
+              file=sys.stderr)
+    return 1 if errors else 0
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -1,6 +1,10 @@
 import cv2
 import numpy as np
 
+from omr import metrics
+from omr.calibrate import BLANK, MARKED, bubble_states
+from omr.template import compile_template
+
 def bbox_norm_to_px(bbox_norm, width, height):
     """Convert normalized bbox coordinates to pixel coordinates"""
     xn, yn, wn, hn = bbox_norm
@@ -26,83 +30,117 @@ def is_marked(crop_gray):
     ratio = filled / float(area) if area > 0 else 0
     return ratio, th
 
-def detect_from_template(warped_bgr, template, low_thresh=0.12, high_thresh=0.40):
+def _gray(image):
+    if image.ndim == 2:
+        return image
+    return cv2.cvtColor(image, cv2.COLOR_BGR2GRAY)
+
+def binarize_sheet(gray):
+    """Blur, Otsu-threshold and open the whole gray sheet once.
+
+    Returns a uint8 mask with 1 for ink and 0 for paper, so that an integral
+    image over it counts filled pixels directly.
+    """
+    blur = cv2.GaussianBlur(gray, (3, 3), 0)
+    _, th = cv2.threshold(blur, 0, 1, cv2.THRESH_BINARY_INV + cv2.THRESH_OTSU)
+    kernel = np.ones((3, 3), np.uint8)
+    return cv2.morphologyEx(th, cv2.MORPH_OPEN, kernel)
+
+def fill_ratios(mask, xs, ys, ws, hs):
+    """Fill ratio of every (x, y, w, h) rectangle in one integral-image lookup"""
+    ii = cv2.integral(mask)
+    x2 = xs + ws
+    y2 = ys + hs
+    filled = ii[y2, x2] - ii[ys, x2] - ii[y2, xs] + ii[ys, xs]
+    return filled / (ws * hs).astype(np.float64)
+
+def classify_ratios(ct, ratios, low_thresh=0.12, high_thresh=0.40, image=None, adaptive=False):
     """
-    warped_bgr: warped top-down image
-    template: loaded JSON template (with 'bubbles' list)
+    Bubble states from fill ratios aligned with ct.keys, as detect_from_template
+    returns them: (answers, ambiguous). With image, ambiguous records also get
+    a 'crop' view of their rect. adaptive fits the thresholds to this sheet's
+    ratios (omr.calibrate.bubble_states) instead of applying them as given.
+    """
+    answers = {}
+    for q, opt in ct.order:
+        answers.setdefault(q, {})[opt] = None
+    ambiguous = list(ct.invalid)
+    states = bubble_states(ct, ratios, low_thresh, high_thresh, adaptive=adaptive)
+    for (q, opt), (x, y, bw, bh), ratio, code in zip(ct.keys, ct.rects(), np.asarray(ratios).tolist(),
+                                                     states.tolist()):
+        if code == MARKED:
+            state = True
+        elif code == BLANK:
+            state = False
+        else:
+            state = None
+            amb = {'q': q, 'option': opt, 'ratio': ratio, 'rect': (x, y, bw, bh)}
+            if image is not None:
+                amb['crop'] = image[y:y+bh, x:x+bw]
+            ambiguous.append(amb)
+
+        answers[q][opt] = state
+    return answers, ambiguous
+
+@metrics.timed("detect")
+def detect_from_template(warped_bgr, template, low_thresh=0.12, high_thresh=0.40, crops=False,
+                         return_ratios=False, adaptive=False):
+    """
+    warped_bgr: warped top-down image (BGR, or already single-channel gray)
+    template: loaded JSON template (with 'bubbles' list) or a CompiledTemplate
     returns: answers dict {q: {option: state}} where state True/False/None (ambiguous),
-             ambiguous list with crop images for review
+             ambiguous list for review; sampled bubbles carry their 'ratio' and
+             pixel 'rect' (x, y, w, h) in warped_bgr, plus a zero-copy 'crop'
+             view into warped_bgr when crops=True; with return_ratios also
+             the raw fill ratio of every bubble, aligned with the compiled keys
+    adaptive: fit low_thresh/high_thresh per sheet and question (classify_ratios)
+
+    The bubble rows/columns are binarized once and all fill ratios are read
+    from a single integral image instead of thresholding every crop separately.
     """
     if warped_bgr is None or warped_bgr.size == 0:
         raise ValueError("Invalid input image for bubble detection")
 
-    gray = cv2.cvtColor(warped_bgr, cv2.COLOR_BGR2GRAY)
-    h, w = gray.shape
+    h, w = warped_bgr.shape[:2]
 
     if h == 0 or w == 0:
         raise ValueError("Image has zero dimensions")
 
-    answers = {}
-    ambiguous = []
-
-    # Validate template structure
-    if 'bubbles' not in template:
-        raise ValueError("Template missing 'bubbles' key")
-
-    bubbles = template['bubbles']
-    if not bubbles:
-        raise ValueError("Template has no bubbles defined")
-
-    for entry in bubbles:
-        try:
-            q = int(entry['q'])
-            opt = entry.get('option')
-            bbox = entry.get('bbox')
-
-            if bbox is None:
-                ambiguous.append({'q': q, 'option': opt, 'reason': 'missing-bbox'})
-                answers.setdefault(q, {})[opt] = None
-                continue
-
-            x, y, bw, bh = bbox_norm_to_px(bbox, w, h)
-
-            # clip bbox inside image with more generous bounds
-            x = max(0, min(x, w-1))
-            y = max(0, min(y, h-1))
-            bw = max(1, min(bw, w - x))
-            bh = max(1, min(bh, h - y))
-
-            crop = gray[y:y+bh, x:x+bw]
-
-            if crop.size == 0 or crop.shape[0] == 0 or crop.shape[1] == 0:
-                # bad bbox - mark as ambiguous
-                answers.setdefault(q, {})[opt] = None
-                ambiguous.append({'q': q, 'option': opt, 'reason': 'crop-empty'})
-                continue
-
-            ratio, th = is_marked(crop)
-
-            if ratio >= high_thresh:
-                state = True
-            elif ratio <= low_thresh:
-                state = False
-            else:
-                state = None
-                ambiguous.append({'q': q, 'option': opt, 'ratio': ratio, 'crop': crop.tolist() if crop is not None else None})
-
-            answers.setdefault(q, {})[opt] = state
-
-        except (KeyError, ValueError, TypeError) as e:
-            ambiguous.append({'q': entry.get('q', 'unknown'), 'option': entry.get('option', 'unknown'), 'reason': f'parsing-error: {str(e)}'})
-            continue
-
+    ct = compile_template(template, (w, h))
+    if not ct.keys:
+        answers, ambiguous = classify_ratios(ct, np.zeros(0), low_thresh, high_thresh, adaptive=adaptive)
+        if return_ratios:
+            return answers, ambiguous, np.zeros(0)
+        return answers, ambiguous
+
+    # gather only the rows/columns some bubble covers, then binarize that
+    # packed canvas once; ink outside the bubbles never reaches Otsu
+    packed = _gray(warped_bgr.take(ct.rows, axis=0)).take(ct.cols, axis=1)
+    mask = binarize_sheet(packed)
+    ratios = fill_ratios(mask, ct.xs_packed, ct.ys_packed, ct.ws, ct.hs)
+
+    answers, ambiguous = classify_ratios(ct, ratios, low_thresh, high_thresh, warped_bgr if crops else None,
+                                         adaptive=adaptive)
+
+    metrics.count("detect.bubbles", len(ct.keys))
+    metrics.count("detect.ambiguous", len(ambiguous) - len(ct.invalid))
+    metrics.count("detect.invalid_bbox", len(ct.invalid))
+    if return_ratios:
+        return answers, ambiguous, ratios
     return answers, ambiguous
 
-def choose_selected_option(answer_options):
-    """Given dict {opt: True/False/None} choose selected option string or None"""
+def choose_selected_option(answer_options, ratios=None, policy=None):
+    """
+    Given dict {opt: True/False/None} choose selected option string or None.
+    With a SelectionPolicy (omr.selection) and the options' fill ratios
+    ({opt: ratio}), unclear questions are decided from the ratios instead.
+    """
+    if policy is not None:
+        if ratios is None:
+            raise ValueError("A selection policy needs the options' fill ratios")
+        return policy.select_one(answer_options, ratios)[0]
     marked = [opt for opt, st in answer_options.items() if st is True]
     if len(marked) == 1:
         return marked[0]
-    # If zero marked, try highest ratio among None? but here None don't contain ratios.
-    # For now treat multiple or zero as None (invalid)
+    # zero or several marks select nothing without a policy
     return None
@@ -0,0 +1,243 @@
+"""
+Sheet localization from corner fiducials declared by the template.
+
+A template that prints four corner markers declares them, normalized to the
+sheet like "bbox":
+
+    "fiducials": {
+        "type": "square",                       # filled dark squares
+        "centers": [[0.03, 0.02], [0.97, 0.02], [0.97, 0.98], [0.03, 0.98]],
+        "size": [0.025, 0.018]
+    }
+
+centers are listed top-left, top-right, bottom-right, bottom-left. With
+"type": "aruco" the markers are ArUco tags instead, identified by
+"dictionary" (e.g. "DICT_4X4_50") and "ids" in the same corner order.
+Optional "search" (default 0.35) is the fraction of the image width/height
+scanned for each marker, from the matching image corner.
+
+Each marker is looked for only in its corner window of a downscaled copy,
+square centroids are refined at full resolution, and the page corners follow
+from the homography of the four centres. Any failed check returns None so the
+caller can fall back to the contour search.
+"""
+import json
+
+import cv2
+import numpy as np
+
+DEFAULT_SEARCH = 0.35
+UNIT_SQUARE = np.float32([[0, 0], [1, 0], [1, 1], [0, 1]])
+
+def _gray(image):
+    if image.ndim == 2:
+        return image
+    return cv2.cvtColor(image, cv2.COLOR_BGR2GRAY)
+
+def parse_fiducials(spec):
+    """Validated copy of a template's "fiducials" entry"""
+    if not isinstance(spec, dict):
+        raise ValueError("'fiducials' must be an object")
+    kind = spec.get('type', 'square')
+    centers = np.asarray(spec.get('centers'), dtype=np.float32)
+    if centers.shape != (4, 2):
+        raise ValueError("'fiducials.centers' needs four [x, y] points (tl, tr, br, bl)")
+    search = float(spec.get('search', DEFAULT_SEARCH))
+    if not 0 < search <= 1:
+        raise ValueError("'fiducials.search' must be in (0, 1]")
+    layout = {'type': kind, 'centers': centers.tolist(), 'search': search}
+    if kind == 'square':
+        size = spec.get('size')
+        if size is None or len(size) != 2 or min(float(v) for v in size) <= 0:
+            raise ValueError("'fiducials.size' needs a positive [w, h]")
+        layout['size'] = [float(v) for v in size]
+    elif kind == 'aruco':
+        ids = spec.get('ids')
+        if ids is None or len(ids) != 4:
+            raise ValueError("'fiducials.ids' needs four marker ids (tl, tr, br, bl)")
+        layout['dictionary'] = str(spec.get('dictionary', 'DICT_4X4_50'))
+        layout['ids'] = [int(i) for i in ids]
+    else:
+        raise ValueError(f"Unknown fiducial type {kind!r}")
+    return layout
+
+def template_fiducials(templates):
+    """Distinct fiducial layouts declared by a set of candidate templates"""
+    layouts = []
+    seen = set()
+    for template in templates:
+        if hasattr(template, "template"):
+            template = template.template
+        spec = template.get("fiducials")
+        if not spec:
+            continue
+        layout = parse_fiducials(spec)
+        key = json.dumps(layout, sort_keys=True)
+        if key not in seen:
+            seen.add(key)
+            layouts.append(layout)
+    return layouts
+
+def _windows(shape, search):
+    """(x0, y0, x1, y1) corner windows in tl, tr, br, bl order, plus each image corner"""
+    h, w = shape[:2]
+    ww = max(1, int(round(w * search)))
+    wh = max(1, int(round(h * search)))
+    return [
+        ((0, 0, ww, wh), (0, 0)),
+        ((w - ww, 0, w, wh), (w, 0)),
+        ((w - ww, h - wh, w, h), (w, h)),
+        ((0, h - wh, ww, h), (0, h)),
+    ]
+
+def _square_candidate(window, expected_w, expected_h, corner):
+    """Centroid and pixel area of the dark filled square nearest corner, or None"""
+    _, dark = cv2.threshold(window, 0, 255, cv2.THRESH_BINARY_INV + cv2.THRESH_OTSU)
+    n, labels, stats, centroids = cv2.connectedComponentsWithStats(dark, connectivity=8)
+    lo = 0.4 * min(expected_w, expected_h)
+    hi = 1.6 * max(expected_w, expected_h)
+    expected_elongation = max(expected_w, expected_h) / min(expected_w, expected_h)
+    best = None
+    for i in range(1, n):
+        x, y, bw, bh, area = stats[i]
+        # a rotated square's bounding box grows by up to ~1.4x
+        if not (lo <= bw <= 1.5 * hi and lo <= bh <= 1.5 * hi):
+            continue
+        if area < 0.45 * bw * bh:
+            continue
+        mask = (labels[y:y + bh, x:x + bw] == i).astype(np.uint8)
+        contours, _ = cv2.findContours(mask, cv2.RETR_EXTERNAL, cv2.CHAIN_APPROX_SIMPLE)
+        (_, _), (rw, rh), _ = cv2.minAreaRect(max(contours, key=cv2.contourArea))
+        if rw < 1 or rh < 1 or max(rw, rh) > hi or min(rw, rh) < lo:
+            continue
+        # filled: rings (QR finder patterns) and ellipses (bubbles) fall short
+        if area < 0.8 * rw * rh:
+            continue
+        # minAreaRect does not say which side is which
+        if max(rw, rh) / min(rw, rh) > 1.5 * expected_elongation:
+            continue
+        cx, cy = centroids[i]
+        d = (cx - corner[0]) ** 2 + (cy - corner[1]) ** 2
+        if best is None or d < best[0]:
+            best = (d, (cx, cy), float(area))
+    if best is None:
+        return None
+    return best[1], best[2]
+
+def _refine_square(image, center, radius, min_fill=0.88):
+    """
+    Full-resolution centroid and area of the dark component under center, or
+    None unless it fills at least min_fill of its minimum-area rectangle;
+    at full size a filled bubble (~0.79) no longer passes for a square.
+    """
+    h, w = image.shape[:2]
+    cx, cy = center
+    x0 = int(max(0, cx - radius)); x1 = int(min(w, cx + radius + 1))
+    y0 = int(max(0, cy - radius)); y1 = int(min(h, cy + radius + 1))
+    if x1 - x0 < 3 or y1 - y0 < 3:
+        return None
+    window = _gray(image[y0:y1, x0:x1])
+    _, dark = cv2.threshold(window, 0, 255, cv2.THRESH_BINARY_INV + cv2.THRESH_OTSU)
+    n, labels, stats, centroids = cv2.connectedComponentsWithStats(dark, connectivity=8)
+    label = labels[min(y1 - y0 - 1, max(0, int(cy) - y0)), min(x1 - x0 - 1, max(0, int(cx) - x0))]
+    if label == 0:
+        return None
+    contours, _ = cv2.findContours((labels == label).astype(np.uint8), cv2.RETR_EXTERNAL, cv2.CHAIN_APPROX_SIMPLE)
+    (_, _), (rw, rh), _ = cv2.minAreaRect(max(contours, key=cv2.contourArea))
+    area = float(stats[label, cv2.CC_STAT_AREA])
+    if area < min_fill * rw * rh:
+        return None
+    return (centroids[label][0] + x0, centroids[label][1] + y0), area
+
+def _find_squares(image, small, scale, layout):
+    """Full-resolution marker centres in corner order plus their areas, or None"""
+    sh, sw = small.shape[:2]
+    size_w, size_h = layout['size']
+    centers = []
+    areas = []
+    for (x0, y0, x1, y1), corner in _windows(small.shape, layout['search']):
+        # the page may fill anything from a quarter to all of the frame
+        expected_w = size_w * sw * 0.7
+        expected_h = size_h * sh * 0.7
+        found = _square_candidate(small[y0:y1, x0:x1], expected_w, expected_h,
+                                  (corner[0] - x0, corner[1] - y0))
+        if found is None:
+            return None
+        (cx, cy), _ = found
+        radius = int(round(1.5 * max(size_w * image.shape[1], size_h * image.shape[0])))
+        found = _refine_square(image, ((cx + x0) / scale, (cy + y0) / scale), radius)
+        if found is None:
+            return None
+        center, area = found
+        centers.append(center)
+        areas.append(area)
+    return np.float32(centers), areas
+
+def _aruco_detector(dictionary):
+    aruco = getattr(cv2, "aruco", None)
+    if aruco is None or not hasattr(aruco, dictionary):
+        return None
+    return aruco.ArucoDetector(aruco.getPredefinedDictionary(getattr(aruco, dictionary)))
+
+def _find_aruco(small, scale, layout):
+    detector = _aruco_detector(layout['dictionary'])
+    if detector is None:
+        return None
+    centers = []
+    areas = []
+    for ((x0, y0, x1, y1), _), marker_id in zip(_windows(small.shape, layout['search']), layout['ids']):
+        corners, ids, _ = detector.detectMarkers(small[y0:y1, x0:x1])
+        if ids is None:
+            return None
+        hits = [c for c, i in zip(corners, ids.ravel()) if i == marker_id]
+        if not hits:
+            return None
+        quad = (hits[0].reshape(4, 2) + (x0, y0)).astype(np.float32)
+        centers.append(quad.mean(axis=0) / scale)
+        areas.append(float(cv2.contourArea(quad)) / (scale * scale))
+    return np.float32(centers), areas
+
+def _plausible(centers, areas, layout, image_shape):
+    """Reject marker sets whose geometry does not fit the declared layout"""
+    if not cv2.isContourConvex(centers.reshape(-1, 1, 2)):
+        return False
+    # tl, tr, br, bl runs clockwise in image coordinates (positive shoelace area)
+    x, y = centers[:, 0], centers[:, 1]
+    if np.dot(x, np.roll(y, -1)) - np.dot(y, np.roll(x, -1)) <= 0:
+        return False
+    if layout['type'] != 'square':
+        return True
+    h, w = image_shape[:2]
+    # measured marker areas against the ones the homography predicts
+    H = cv2.getPerspectiveTransform(np.float32(layout['centers']), centers)
+    size_w, size_h = layout['size']
+    for (cx, cy), area in zip(layout['centers'], areas):
+        square = np.float32([[cx - size_w / 2, cy - size_h / 2], [cx + size_w / 2, cy - size_h / 2],
+                             [cx + size_w / 2, cy + size_h / 2], [cx - size_w / 2, cy + size_h / 2]])
+        predicted = cv2.contourArea(cv2.perspectiveTransform(square.reshape(-1, 1, 2), H))
+        if predicted <= 0 or not 0.5 <= area / predicted <= 2.0:
+            return False
+    return True
+
+def locate_fiducials(image, layout, small=None, scale=1.0):
+    """
+    Page corners (tl, tr, br, bl, full-resolution coordinates) from the
+    markers of one parsed layout, or None when they are not all found.
+
+    small is an optional downscaled copy of image (BGR or gray) by factor
+    scale, on which the corner windows are searched.
+    """
+    if small is None:
+        small, scale = image, 1.0
+    small = _gray(small)
+    if layout['type'] == 'aruco':
+        found = _find_aruco(small, scale, layout)
+    else:
+        found = _find_squares(image, small, scale, layout)
+    if found is None:
+        return None
+    centers, areas = found
+    if not _plausible(centers, areas, layout, image.shape):
+        return None
+    H = cv2.getPerspectiveTransform(np.float32(layout['centers']), centers)
+    return cv2.perspectiveTransform(UNIT_SQUARE.reshape(-1, 1, 2), H).reshape(4, 2)
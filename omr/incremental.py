@@ -0,0 +1,180 @@
+"""
+Incremental grading: every stage output is stored under a digest of exactly
+the inputs it depends on, so editing a template or answer key only reruns
+what that edit touches.
+
+    stage     inputs                                          stored
+    canvas    image bytes, grading size, sheet location       gray grading canvas (PNG)
+    preview   image bytes, output size, preview side          colour warp (JPEG), only if asked
+    qr        canvas, QR regions of the candidate templates   decoded version
+    ratios    canvas, chosen template's bubble geometry,      fill ratio of every bubble
+              registration
+    score     ratios, thresholds, answer key, subjects        never stored: rebuilt each time
+              (adaptive thresholds and selection policies only need the ratios)
+
+Fixing an answer or a subject range reruns only the score stage (no image
+is decoded). Moving bboxes re-samples the stored canvas, not the photo.
+A change that alters the grading canvas size (the smallest bubble of any
+template) or the fiducials invalidates the canvas stage itself. Hits and
+misses are counted in omr.metrics as stage.<name>.hit / .miss.
+
+    grader = IncrementalGrader(StageStore("results/stages"), templates, "setb.json", answer_keys)
+    canvas, preview, compiled, result, ambiguous, name, ratios = grader.grade(file_bytes)
+"""
+import hashlib
+
+import cv2
+import numpy as np
+
+from omr import metrics
+from omr.cache import fingerprint
+from omr.detectbub_fixed import classify_ratios, detect_from_template
+from omr.fiducials import template_fiducials
+from omr.pipeline import (DEFAULT_MIN_BUBBLE_PX, DEFAULT_OUTPUT_SIZE, decode_image, find_answer_key,
+                          match_template_name, score_detected)
+from omr.preprocess import QRVersionReader, locate_sheet, template_qr_rois, warp_sheet
+from omr.register import register_template
+from omr.store import encode_image
+from omr.template import compile_template
+from omr.template import grading_size as pick_grading_size
+
+def _image_digest(file_bytes):
+    return hashlib.blake2b(file_bytes, digest_size=20).hexdigest()
+
+class IncrementalGrader:
+    """
+    Grades sheets through a StageStore, reusing every stage whose inputs are unchanged.
+
+    templates: {template file name: template}; default_name is used when no QR
+    version matches. answer_keys ({file name: key}) as for grade_sheet. Results
+    match grade_sheet(gray=True) for the same parameters. The QR reader is
+    never sticky here, since a stored version must not depend on sheet order.
+    """
+
+    def __init__(self, stages, templates, default_name, answer_keys=None, output_size=DEFAULT_OUTPUT_SIZE,
+                 grading_size="auto", min_bubble_px=DEFAULT_MIN_BUBBLE_PX, register=False,
+                 low_thresh=0.12, high_thresh=0.40, adaptive=False, policy=None):
+        self.stages = stages
+        self.templates = templates
+        self.default_name = default_name
+        self.answer_keys = answer_keys
+        self.output_size = tuple(output_size)
+        if grading_size == "auto":
+            grading_size = pick_grading_size(templates.values(), output_size, min_bubble_px)
+        elif grading_size is None:
+            grading_size = output_size
+        self.grading_size = tuple(grading_size)
+        self.register = register
+        self.low_thresh = low_thresh
+        self.high_thresh = high_thresh
+        self.adaptive = adaptive
+        self.policy = policy
+        self.fiducials = template_fiducials(templates.values())
+        rois, full_frame = template_qr_rois(templates.values())
+        self.qr_reader = QRVersionReader(rois, full_frame)
+        self._qr_params = {'rois': rois, 'full_frame': full_frame}
+
+    def _compiled(self, name):
+        template = self.templates.get(name)
+        if template is None:
+            raise ValueError(f"Could not load template {name}")
+        return compile_template(template, self.grading_size)
+
+    def _decode_plan(self, preview_max_side):
+        """(target size, gray) for decoding, as the batch workers decode"""
+        if preview_max_side is None:
+            return self.grading_size, True
+        out_w, out_h = self.output_size
+        scale = min(1.0, preview_max_side / float(max(out_w, out_h))) if preview_max_side else 1.0
+        return (max(self.grading_size[0], round(out_w * scale)), max(self.grading_size[1], round(out_h * scale))), False
+
+    def _canvas(self, file_bytes, digest, preview_max_side):
+        """(canvas key, gray grading canvas, colour preview or None)"""
+        target, gray = self._decode_plan(preview_max_side)
+        # the decode scale and channels shift pixels slightly, so they are inputs too
+        key = self.stages.key("canvas", digest, self.grading_size, self.fiducials, target, gray)
+        preview_key = None
+        preview = None
+        if preview_max_side is not None:
+            preview_key = self.stages.key("preview", digest, self.output_size, preview_max_side, self.fiducials)
+            hit = self.stages.get("preview", preview_key)
+            if hit is not None:
+                preview = cv2.imdecode(hit['image'], cv2.IMREAD_COLOR)
+
+        hit = self.stages.get("canvas", key)
+        if hit is not None and (preview_key is None or preview is not None):
+            metrics.count("stage.canvas.hit")
+            return key, cv2.imdecode(hit['canvas'], cv2.IMREAD_GRAYSCALE), preview
+
+        metrics.count("stage.canvas.miss")
+        img = decode_image(file_bytes, target_size=target, gray=gray)
+        pts = locate_sheet(img, fiducials=self.fiducials)
+        if hit is None:
+            canvas = warp_sheet(img, pts, self.grading_size, gray=True)
+            # PNG keeps the canvas lossless, so later stages see the exact pixels
+            self.stages.put("canvas", key, canvas=np.frombuffer(encode_image(canvas, "png", 100), np.uint8))
+        else:
+            canvas = cv2.imdecode(hit['canvas'], cv2.IMREAD_GRAYSCALE)
+        if preview_key is not None and preview is None:
+            preview = warp_sheet(img, pts, self.output_size)
+            h, w = preview.shape[:2]
+            if preview_max_side and max(h, w) > preview_max_side:
+                scale = preview_max_side / float(max(h, w))
+                preview = cv2.resize(preview, (max(1, round(w * scale)), max(1, round(h * scale))),
+                                     interpolation=cv2.INTER_AREA)
+            self.stages.put("preview", preview_key, image=np.frombuffer(encode_image(preview, "jpg", 90), np.uint8))
+        return key, canvas, preview
+
+    def _version(self, canvas_key, canvas):
+        key = self.stages.key("qr", canvas_key, self._qr_params)
+        hit = self.stages.get("qr", key)
+        if hit is not None:
+            metrics.count("stage.qr.hit")
+            return hit['meta'].get('version')
+        metrics.count("stage.qr.miss")
+        version = self.qr_reader.read(canvas)
+        self.stages.put("qr", key, meta={'version': version})
+        return version
+
+    def _ratios(self, canvas_key, canvas, compiled):
+        """(compiled, possibly moved by registration, and its fill ratios)"""
+        key = self.stages.key("ratios", canvas_key, fingerprint(compiled.template['bubbles']), self.register)
+        hit = self.stages.get("ratios", key)
+        if hit is not None:
+            metrics.count("stage.ratios.hit")
+            if 'xs' in hit:
+                compiled = compiled.shifted(hit['xs'] - compiled.xs, hit['ys'] - compiled.ys)
+            return compiled, hit['ratios']
+        metrics.count("stage.ratios.miss")
+        arrays = {}
+        if self.register:
+            compiled = register_template(canvas, compiled)
+            arrays = {'xs': np.asarray(compiled.xs), 'ys': np.asarray(compiled.ys)}
+        _, _, ratios = detect_from_template(canvas, compiled, self.low_thresh, self.high_thresh, return_ratios=True)
+        self.stages.put("ratios", key, ratios=ratios, **arrays)
+        return compiled, ratios
+
+    def grade(self, file_bytes, preview_max_side=None):
+        """
+        Grade one image. preview_max_side also returns the colour output_size
+        warp, downscaled to that long side (0 keeps it full size); None skips it.
+        returns: (canvas, preview, compiled, result, ambiguous, template_name, ratios)
+        where canvas is the gray grading canvas the bubbles were sampled on
+        """
+        digest = _image_digest(file_bytes)
+        canvas_key, canvas, preview = self._canvas(file_bytes, digest, preview_max_side)
+
+        name = self.default_name
+        version = self._version(canvas_key, canvas)
+        if version:
+            name = match_template_name(version, self.templates) or self.default_name
+        compiled, ratios = self._ratios(canvas_key, canvas, self._compiled(name))
+
+        if self.answer_keys is not None and name in self.answer_keys:
+            answer_key = self.answer_keys[name]
+        else:
+            answer_key = find_answer_key(self.templates[name])
+        detected, ambiguous = classify_ratios(compiled, ratios, self.low_thresh, self.high_thresh,
+                                              adaptive=self.adaptive)
+        result = score_detected(detected, ambiguous, compiled, answer_key, name, ratios, self.policy)
+        return canvas, preview, compiled, result, ambiguous, name, ratios
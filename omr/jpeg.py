@@ -0,0 +1,94 @@
+"""
+Just enough JPEG header parsing to plan a reduced decode: frame size and the
+EXIF orientation tag, read without decoding any pixels.
+"""
+import struct
+
+import cv2
+
+# SOFn markers carry the frame size; C4 (DHT), C8 (JPG) and CC (DAC) do not
+_SOF_MARKERS = frozenset(range(0xC0, 0xD0)) - {0xC4, 0xC8, 0xCC}
+_ORIENTATION_TAG = 0x0112
+
+def _exif_orientation(segment):
+    """Orientation (1..8) from an APP1 payload, or None"""
+    segment = bytes(segment)
+    if not segment.startswith(b"Exif\0\0"):
+        return None
+    tiff = segment[6:]
+    if len(tiff) < 8:
+        return None
+    if tiff[:2] == b"II":
+        e = "<"
+    elif tiff[:2] == b"MM":
+        e = ">"
+    else:
+        return None
+    ifd = struct.unpack(e + "I", tiff[4:8])[0]
+    if ifd + 2 > len(tiff):
+        return None
+    count = struct.unpack(e + "H", tiff[ifd:ifd + 2])[0]
+    for i in range(count):
+        entry = ifd + 2 + 12 * i
+        if entry + 12 > len(tiff):
+            break
+        tag, typ = struct.unpack(e + "HH", tiff[entry:entry + 4])
+        if tag == _ORIENTATION_TAG and typ == 3:
+            value = struct.unpack(e + "H", tiff[entry + 8:entry + 10])[0]
+            return value if 1 <= value <= 8 else None
+    return None
+
+def jpeg_info(data):
+    """
+    (width, height, orientation) of a JPEG as stored, before any EXIF
+    rotation; orientation is 1 when there is no tag. None if data is not a
+    readable JPEG. data may be bytes or a memoryview.
+    """
+    if data[:2] != b"\xff\xd8":
+        return None
+    orientation = 1
+    pos = 2
+    n = len(data)
+    while pos + 4 <= n:
+        if data[pos] != 0xFF:
+            return None
+        marker = data[pos + 1]
+        if marker == 0xFF:  # fill byte
+            pos += 1
+            continue
+        if marker in (0xD8, 0x01) or 0xD0 <= marker <= 0xD7:
+            pos += 2
+            continue
+        length = struct.unpack(">H", data[pos + 2:pos + 4])[0]
+        segment = data[pos + 4:pos + 2 + length]
+        if marker == 0xE1:
+            found = _exif_orientation(segment)
+            if found is not None:
+                orientation = found
+        elif marker in _SOF_MARKERS:
+            if len(segment) < 5:
+                return None
+            height, width = struct.unpack(">HH", segment[1:5])
+            return width, height, orientation
+        elif marker == 0xDA:  # start of scan without a frame header
+            return None
+        pos += 2 + length
+    return None
+
+def apply_orientation(image, orientation):
+    """Turn an image decoded as stored into its upright view for an EXIF orientation"""
+    if orientation == 2:
+        return cv2.flip(image, 1)
+    if orientation == 3:
+        return cv2.rotate(image, cv2.ROTATE_180)
+    if orientation == 4:
+        return cv2.flip(image, 0)
+    if orientation == 5:
+        return cv2.transpose(image)
+    if orientation == 6:
+        return cv2.rotate(image, cv2.ROTATE_90_CLOCKWISE)
+    if orientation == 7:
+        return cv2.flip(cv2.transpose(image), -1)
+    if orientation == 8:
+        return cv2.rotate(image, cv2.ROTATE_90_COUNTERCLOCKWISE)
+    return image
@@ -0,0 +1,216 @@
+"""
+Per-stage timings and counters for the grading pipeline.
+
+Disabled by default (set OMR_METRICS=1 or call enable()); while disabled,
+stage() hands back a shared no-op context manager and count() returns at once.
+
+    with metrics.stage("warp"):
+        ...
+    @metrics.timed("detect")
+    def detect_from_template(...): ...
+    metrics.count("warp.fallback_resize")
+
+Each stage records wall time and thread CPU time into histograms and, when
+enabled with memory=True, bytes allocated (via tracemalloc). Export with
+to_json() or to_prometheus() / write_prometheus(path) for a textfile
+collector. Worker processes drain() their metrics and the parent merge()s them.
+"""
+import functools
+import json
+import os
+import threading
+import time
+import tracemalloc
+
+# histogram bucket upper bounds, in seconds
+BUCKETS = (0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+
+_lock = threading.Lock()
+_state = {'enabled': False, 'memory': False}
+_stages = {}
+_counters = {}
+
+class _NoopStage:
+    __slots__ = ()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        return False
+
+_NOOP = _NoopStage()
+
+def _new_stage():
+    return {'count': 0, 'wall_sum': 0.0, 'cpu_sum': 0.0, 'bytes_sum': 0, 'buckets': [0] * (len(BUCKETS) + 1)}
+
+def _record(name, wall, cpu, nbytes):
+    i = 0
+    while i < len(BUCKETS) and wall > BUCKETS[i]:
+        i += 1
+    with _lock:
+        s = _stages.get(name)
+        if s is None:
+            s = _stages[name] = _new_stage()
+        s['count'] += 1
+        s['wall_sum'] += wall
+        s['cpu_sum'] += cpu
+        s['bytes_sum'] += nbytes
+        s['buckets'][i] += 1
+
+class _Stage:
+    __slots__ = ('name', 't0', 'c0', 'm0')
+
+    def __init__(self, name):
+        self.name = name
+
+    def __enter__(self):
+        self.m0 = tracemalloc.get_traced_memory()[0] if _state['memory'] else 0
+        self.c0 = time.thread_time()
+        self.t0 = time.perf_counter()
+        return self
+
+    def __exit__(self, *exc):
+        wall = time.perf_counter() - self.t0
+        cpu = time.thread_time() - self.c0
+        nbytes = 0
+        if _state['memory']:
+            nbytes = max(0, tracemalloc.get_traced_memory()[0] - self.m0)
+        _record(self.name, wall, cpu, nbytes)
+        return False
+
+def enabled():
+    return _state['enabled']
+
+def memory_enabled():
+    return _state['enabled'] and _state['memory']
+
+def enable(memory=False):
+    """Start recording; memory=True also tracks net bytes allocated per stage"""
+    _state['enabled'] = True
+    _state['memory'] = memory
+    if memory and not tracemalloc.is_tracing():
+        tracemalloc.start()
+
+def disable():
+    _state['enabled'] = False
+    if _state['memory'] and tracemalloc.is_tracing():
+        tracemalloc.stop()
+    _state['memory'] = False
+
+def stage(name):
+    """Context manager timing one pipeline stage"""
+    if not _state['enabled']:
+        return _NOOP
+    return _Stage(name)
+
+def timed(name):
+    """Decorator form of stage() for functions that are a stage as a whole"""
+    def wrap(fn):
+        @functools.wraps(fn)
+        def inner(*args, **kwargs):
+            if not _state['enabled']:
+                return fn(*args, **kwargs)
+            with _Stage(name):
+                return fn(*args, **kwargs)
+        return inner
+    return wrap
+
+def count(name, n=1):
+    """Bump a counter, e.g. ambiguous bubbles or fallback-path hits"""
+    if not _state['enabled']:
+        return
+    with _lock:
+        _counters[name] = _counters.get(name, 0) + n
+
+def snapshot():
+    with _lock:
+        return {
+            'stages': {k: dict(v, buckets=list(v['buckets'])) for k, v in _stages.items()},
+            'counters': dict(_counters),
+        }
+
+def reset():
+    with _lock:
+        _stages.clear()
+        _counters.clear()
+
+def drain():
+    """Snapshot and reset, e.g. to ship a worker's metrics back with its result"""
+    with _lock:
+        snap = {'stages': dict(_stages), 'counters': dict(_counters)}
+        _stages.clear()
+        _counters.clear()
+    return snap
+
+def merge(snap):
+    """Add a snapshot (from drain() in another process) into this process's metrics"""
+    if not snap:
+        return
+    with _lock:
+        for name, other in snap.get('stages', {}).items():
+            s = _stages.get(name)
+            if s is None:
+                s = _stages[name] = _new_stage()
+            s['count'] += other['count']
+            s['wall_sum'] += other['wall_sum']
+            s['cpu_sum'] += other['cpu_sum']
+            s['bytes_sum'] += other['bytes_sum']
+            s['buckets'] = [a + b for a, b in zip(s['buckets'], other['buckets'])]
+        for name, n in snap.get('counters', {}).items():
+            _counters[name] = _counters.get(name, 0) + n
+
+def to_json(indent=2):
+    snap = snapshot()
+    snap['buckets'] = list(BUCKETS)
+    return json.dumps(snap, indent=indent)
+
+def _label(name):
+    return name.replace('\\', '\\\\').replace('"', '\\"')
+
+def to_prometheus(prefix="omr"):
+    """Prometheus text exposition format"""
+    snap = snapshot()
+    lines = [
+        f"# HELP {prefix}_stage_seconds Wall time per grading stage.",
+        f"# TYPE {prefix}_stage_seconds histogram",
+    ]
+    for name in sorted(snap['stages']):
+        s = snap['stages'][name]
+        label = _label(name)
+        cumulative = 0
+        for bound, n in zip(BUCKETS, s['buckets']):
+            cumulative += n
+            lines.append(f'{prefix}_stage_seconds_bucket{{stage="{label}",le="{bound}"}} {cumulative}')
+        lines.append(f'{prefix}_stage_seconds_bucket{{stage="{label}",le="+Inf"}} {s["count"]}')
+        lines.append(f'{prefix}_stage_seconds_sum{{stage="{label}"}} {s["wall_sum"]:.6f}')
+        lines.append(f'{prefix}_stage_seconds_count{{stage="{label}"}} {s["count"]}')
+    lines.append(f"# HELP {prefix}_stage_cpu_seconds_total Thread CPU time per grading stage.")
+    lines.append(f"# TYPE {prefix}_stage_cpu_seconds_total counter")
+    for name in sorted(snap['stages']):
+        lines.append(f'{prefix}_stage_cpu_seconds_total{{stage="{_label(name)}"}} {snap["stages"][name]["cpu_sum"]:.6f}')
+    lines.append(f"# HELP {prefix}_stage_allocated_bytes_total Net bytes allocated per stage (tracemalloc).")
+    lines.append(f"# TYPE {prefix}_stage_allocated_bytes_total counter")
+    for name in sorted(snap['stages']):
+        lines.append(f'{prefix}_stage_allocated_bytes_total{{stage="{_label(name)}"}} {snap["stages"][name]["bytes_sum"]}')
+    lines.append(f"# HELP {prefix}_events_total Pipeline event counters.")
+    lines.append(f"# TYPE {prefix}_events_total counter")
+    for name in sorted(snap['counters']):
+        lines.append(f'{prefix}_events_total{{event="{_label(name)}"}} {snap["counters"][name]}')
+    return "\n".join(lines) + "\n"
+
+def write_prometheus(path, prefix="omr"):
+    """Atomically (re)write a textfile-collector file"""
+    tmp = f"{path}.{os.getpid()}.tmp"
+    with open(tmp, "w") as f:
+        f.write(to_prometheus(prefix))
+    os.replace(tmp, path)
+
+def write_json(path):
+    tmp = f"{path}.{os.getpid()}.tmp"
+    with open(tmp, "w") as f:
+        f.write(to_json())
+    os.replace(tmp, path)
+
+if os.environ.get("OMR_METRICS", "") not in ("", "0"):
+    enable(memory=os.environ.get("OMR_METRICS") == "memory")
@@ -0,0 +1,50 @@
+import cv2
+
+from omr import metrics
+from omr.template import compile_template
+
+def _bgr_copy(image):
+    if image.ndim == 2:
+        return cv2.cvtColor(image, cv2.COLOR_GRAY2BGR)
+    return image.copy()
+
+@metrics.timed("overlay")
+def draw_overlay(warped_bgr, template, per_question_result):
+    """Outline every bubble; selected ones green (correct), red (wrong) or yellow (unscored),
+    and every option of a question left for review (status 'review') orange.
+
+    template may be a loaded JSON template or a CompiledTemplate; a gray
+    warped image is drawn on as a BGR copy.
+    """
+    overlay = _bgr_copy(warped_bgr)
+    h, w = overlay.shape[:2]
+    ct = compile_template(template, (w, h))
+    # draw rectangles and mark selected / correct
+    for (q, opt), (x, y, bw, bh) in zip(ct.keys, ct.rects()):
+        # default color light gray
+        color = (200, 200, 200)
+        # if selected
+        pr = per_question_result.get(q, {})
+        sel = pr.get('selected')
+        correct = pr.get('correct')
+        if pr.get('status') == "review":
+            color = (0, 140, 255)
+        elif sel is not None and opt == sel:
+            # green for correct, red for wrong
+            if correct is True:
+                color = (0, 200, 0)
+            elif correct is False:
+                color = (0, 0, 255)
+            else:
+                color = (0, 200, 200)  # ambiguous
+        cv2.rectangle(overlay, (x, y), (x + bw, y + bh), color, 2)
+    return overlay
+
+def draw_bubble_positions(warped_bgr, template, color=(255, 0, 0)):
+    """Debug view with every template bubble outlined"""
+    debug_overlay = _bgr_copy(warped_bgr)
+    h, w = debug_overlay.shape[:2]
+    ct = compile_template(template, (w, h))
+    for x, y, bw, bh in ct.rects():
+        cv2.rectangle(debug_overlay, (x, y), (x + bw, y + bh), color, 2)
+    return debug_overlay
@@ -0,0 +1,218 @@
+import json
+import os
+
+import cv2
+import numpy as np
+
+from omr import metrics
+from omr.jpeg import apply_orientation, jpeg_info
+from omr.fiducials import template_fiducials
+from omr.preprocess import QRVersionReader, locate_sheet, template_qr_rois, warp_sheet
+from omr.detectbub_fixed import detect_from_template, choose_selected_option
+from omr.register import register_template
+from omr.scoring import compute_scores
+from omr.template import CompiledTemplate, compile_template
+from omr.template import grading_size as pick_grading_size
+
+DEFAULT_OUTPUT_SIZE = (2480, 3508)
+# bubbles stay at least this many pixels across on the grading canvas
+DEFAULT_MIN_BUBBLE_PX = 16
+
+# JPEG decode reductions: {(factor, gray): imdecode flag}
+_REDUCED_FLAGS = {
+    (2, False): cv2.IMREAD_REDUCED_COLOR_2, (4, False): cv2.IMREAD_REDUCED_COLOR_4,
+    (8, False): cv2.IMREAD_REDUCED_COLOR_8, (2, True): cv2.IMREAD_REDUCED_GRAYSCALE_2,
+    (4, True): cv2.IMREAD_REDUCED_GRAYSCALE_4, (8, True): cv2.IMREAD_REDUCED_GRAYSCALE_8,
+}
+
+def reduction_factor(size, target_size, coverage=0.6):
+    """
+    Largest decode reduction (1, 2, 4 or 8) of a size (w, h) photo that still
+    leaves target_size pixels across a sheet spanning coverage of the photo.
+    Orientation-agnostic: long sides are compared with long sides.
+    """
+    long_src, short_src = max(size), min(size)
+    long_t, short_t = max(target_size), min(target_size)
+    for factor in (8, 4, 2):
+        if long_src * coverage / factor >= long_t and short_src * coverage / factor >= short_t:
+            return factor
+    return 1
+
+@metrics.timed("decode")
+def decode_image(file_bytes, target_size=None, gray=False):
+    """
+    Decode uploaded/file bytes into an upright BGR image (single-channel gray
+    with gray=True), applying the JPEG's EXIF orientation.
+    target_size: (w, h) of the largest canvas the sheet will be warped to; a
+                 JPEG with more pixels than that needs is decoded at 1/2, 1/4
+                 or 1/8 scale by the JPEG decoder itself
+    """
+    arr = np.frombuffer(file_bytes, np.uint8)
+    flags = cv2.IMREAD_GRAYSCALE if gray else cv2.IMREAD_COLOR
+    orientation = 1
+    info = jpeg_info(file_bytes)
+    if info is not None:
+        width, height, orientation = info
+        if target_size is not None:
+            factor = reduction_factor((width, height), target_size)
+            if factor > 1:
+                flags = _REDUCED_FLAGS[(factor, gray)]
+                metrics.count(f"decode.reduced_{factor}")
+        # orientation is applied below, identically on every OpenCV version
+        flags |= cv2.IMREAD_IGNORE_ORIENTATION
+    img = cv2.imdecode(arr, flags)
+    if img is None:
+        raise ValueError("Could not decode image file")
+    return apply_orientation(img, orientation)
+
+def match_template_name(version, templates):
+    """
+    Template file name for a QR version, or None: exact 'version' field first,
+    then exact file name without .json (so 'v1' never matches 'v10').
+    """
+    version = version.strip()
+    for name, template in templates.items():
+        v = template.version if isinstance(template, CompiledTemplate) else template.get('version')
+        if v is not None and str(v) == version:
+            return name
+    for name in templates:
+        if name == version or name.replace(".json", "") == version:
+            return name
+    return None
+
+def find_answer_key(template, templates_dir="templates"):
+    """Answer key embedded in the template, else templates/answers_{version}.json, else {}"""
+    if isinstance(template, CompiledTemplate):
+        template = template.template
+    if 'answers' in template:
+        return template['answers']
+    v = template.get('version')
+    if v:
+        candidate = os.path.join(templates_dir, f"answers_{v}.json")
+        if os.path.exists(candidate):
+            with open(candidate) as f:
+                return json.load(f)
+    return {}
+
+def grade_warped(warped, template, answer_key, template_name=None, return_ratios=False, register=False,
+                 adaptive=False, policy=None):
+    """
+    Detect and score an already warped sheet.
+    template: loaded JSON template or CompiledTemplate
+    register: first move the bubble grid onto the sheet's printed outlines
+              (omr.register); compiled then holds the moved rects
+    adaptive: fit the marked/blank thresholds to this sheet (omr.calibrate)
+    policy: SelectionPolicy deciding unclear questions from the fill ratios
+    returns: (compiled, result, ambiguous), plus the per-bubble fill ratios
+             (aligned with compiled.keys) when return_ratios
+    """
+    h, w = warped.shape[:2]
+    compiled = compile_template(template, (w, h))
+    if register:
+        compiled = register_template(warped, compiled)
+
+    detected, ambiguous, ratios = detect_from_template(warped, compiled, return_ratios=True,
+                                                      adaptive=adaptive)
+    result = score_detected(detected, ambiguous, compiled, answer_key, template_name, ratios, policy)
+    if return_ratios:
+        return compiled, result, ambiguous, ratios
+    return compiled, result, ambiguous
+
+def score_detected(detected, ambiguous, compiled, answer_key, template_name=None, ratios=None, policy=None):
+    """
+    Result dict for detected bubble states, scored when there is an answer key.
+    With a SelectionPolicy (and the fill ratios aligned with compiled.keys)
+    every question gets a 'status' and result['review'] lists the questions
+    left for a person.
+    """
+    selections = None
+    if policy is not None:
+        if ratios is None:
+            raise ValueError("A selection policy needs the fill ratios")
+        selections = policy.select(compiled, detected, ratios)
+    if not answer_key:
+        per_question_result = {}
+        for q, opts in detected.items():
+            if selections is not None:
+                selected, status = selections[q]
+                per_question_result[int(q)] = {'selected': selected, 'correct': None, 'status': status}
+            else:
+                per_question_result[int(q)] = {'selected': choose_selected_option(opts), 'correct': None}
+        per_subject_score = {}
+        total_score = 0
+    else:
+        per_subject_score, total_score, per_question_result = compute_scores(detected, compiled, answer_key,
+                                                                             selections=selections)
+
+    result = {
+        "per_subject_score": per_subject_score,
+        "total_score": total_score,
+        "per_question": per_question_result,
+        "ambiguous_count": len(ambiguous),
+        "template_used": compiled.version or template_name
+    }
+    if selections is not None:
+        result["review"] = sorted(q for q, r in per_question_result.items() if r['status'] == "review")
+    return result
+
+def grade_sheet(image_bgr, templates, default_name, answer_keys=None, output_size=DEFAULT_OUTPUT_SIZE,
+                warp_out=None, grading_size="auto", keep_full=True, min_bubble_px=DEFAULT_MIN_BUBBLE_PX,
+                qr_reader=None, return_ratios=False, gray=False, register=False, adaptive=False,
+                policy=None):
+    """
+    Warp, pick the template (QR first, then default_name), detect and score one sheet.
+    templates: {template file name: template or CompiledTemplate}
+    answer_keys: {template file name: answer key dict}; looked up on disk when missing
+    grading_size: canvas (width, height) used for QR and bubble detection;
+                  "auto" picks the smallest one keeping every bubble of every
+                  template at least min_bubble_px across, None uses output_size
+    keep_full: also warp an output_size canvas for archival/overlays
+    warp_out: optional reusable buffer of grading_size for the grading warp (2-D when gray)
+    qr_reader: QRVersionReader to reuse across sheets; by default one is built
+               from the templates' declared QR regions
+    gray: grade on a single-channel warp (QR and bubbles only need gray); the
+          kept output_size canvas is still warped in colour from a colour
+          image_bgr. image_bgr may itself be gray (decode_image(gray=True))
+          when no colour output is wanted.
+    register: correct residual misalignment of the bubble grid (grade_warped)
+    adaptive: per-sheet thresholds for pencil marks and dark scans (grade_warped)
+    policy: SelectionPolicy for questions the bubble states leave unclear (grade_warped)
+    returns: (warped, compiled, result, ambiguous, template_name) where warped is
+             the output_size canvas when keep_full, else the grading canvas;
+             return_ratios appends the per-bubble fill ratios
+    """
+    if grading_size == "auto":
+        grading_size = pick_grading_size(templates.values(), output_size, min_bubble_px)
+    elif grading_size is None:
+        grading_size = output_size
+    grading_size = tuple(grading_size)
+
+    pts = locate_sheet(image_bgr, fiducials=template_fiducials(templates.values()))
+    warped = warp_sheet(image_bgr, pts, grading_size, out=warp_out, gray=gray)
+
+    name = default_name
+    if qr_reader is None:
+        qr_reader = QRVersionReader(*template_qr_rois(templates.values()))
+    version_from_qr = qr_reader.read(warped)
+    if version_from_qr:
+        name = match_template_name(version_from_qr, templates) or default_name
+
+    template = templates.get(name)
+    if template is None:
+        raise ValueError(f"Could not load template {name}")
+
+    if answer_keys is not None and name in answer_keys:
+        answer_key = answer_keys[name]
+    else:
+        answer_key = find_answer_key(template)
+
+    compiled, result, ambiguous, ratios = grade_warped(warped, template, answer_key, name, return_ratios=True,
+                                                       register=register, adaptive=adaptive,
+                                                       policy=policy)
+    if keep_full and (grading_size != tuple(output_size) or warped.ndim != image_bgr.ndim):
+        # archival canvas straight from the source, not upsampled from the grading
+        # one, and in colour when the source has it
+        warped = warp_sheet(image_bgr, pts, output_size)
+    if return_ratios:
+        return warped, compiled, result, ambiguous, name, ratios
+    return warped, compiled, result, ambiguous, name
@@ -1,6 +1,11 @@
+import threading
+
 import cv2
 import numpy as np
 
+from omr import metrics
+from omr.fiducials import locate_fiducials
+
 def order_points(pts):
     rect = np.zeros((4, 2), dtype="float32")
     s = pts.sum(axis=1)
@@ -11,24 +16,83 @@ def order_points(pts):
     rect[3] = pts[np.argmax(diff)]
     return rect
 
-def four_point_transform(image, pts):
+def _output_buffer(out, output_size, gray):
+    """Validate a caller-provided warp destination; None lets OpenCV allocate"""
+    if out is None:
+        return None
+    out_w, out_h = output_size
+    shape = (out_h, out_w) if gray else (out_h, out_w, 3)
+    if out.shape != shape or out.dtype != np.uint8:
+        raise ValueError(f"Output buffer must be uint8 with shape {shape}, got {out.dtype} {out.shape}")
+    return out
+
+def _to_gray(image):
+    if image.ndim == 2:
+        return image
+    return cv2.cvtColor(image, cv2.COLOR_BGR2GRAY)
+
+def four_point_transform(image, pts, output_size=None, out=None, gray=False):
+    """
+    Warp the quadrilateral pts to a top-down view in a single warpPerspective.
+
+    output_size (width, height) maps the sheet straight onto that canvas;
+    without it the canvas is the quadrilateral's own width/height. out is an
+    optional reusable uint8 destination of the final shape. With gray=True
+    only the source region under the quadrilateral is converted to gray and
+    a single-channel warp is produced.
+    """
     rect = order_points(pts)
-    (tl, tr, br, bl) = rect
-    widthA = np.linalg.norm(br - bl)
-    widthB = np.linalg.norm(tr - tl)
-    maxWidth = max(int(widthA), int(widthB))
-    heightA = np.linalg.norm(tr - br)
-    heightB = np.linalg.norm(tl - bl)
-    maxHeight = max(int(heightA), int(heightB))
-    dst = np.array([[0, 0], [maxWidth - 1, 0], [maxWidth - 1, maxHeight - 1], [0, maxHeight - 1]], dtype="float32")
+    if output_size is None:
+        (tl, tr, br, bl) = rect
+        widthA = np.linalg.norm(br - bl)
+        widthB = np.linalg.norm(tr - tl)
+        maxWidth = max(int(widthA), int(widthB))
+        heightA = np.linalg.norm(tr - br)
+        heightB = np.linalg.norm(tl - bl)
+        maxHeight = max(int(heightA), int(heightB))
+        output_size = (maxWidth, maxHeight)
+    out_w, out_h = output_size
+    dst = np.array([[0, 0], [out_w - 1, 0], [out_w - 1, out_h - 1], [0, out_h - 1]], dtype="float32")
+    out = _output_buffer(out, output_size, gray)
+
+    if gray and image.ndim == 3:
+        # convert only the bounding box of the sheet, then warp from that crop
+        h, w = image.shape[:2]
+        x0 = max(0, int(np.floor(rect[:, 0].min())) - 1)
+        y0 = max(0, int(np.floor(rect[:, 1].min())) - 1)
+        x1 = min(w, int(np.ceil(rect[:, 0].max())) + 2)
+        y1 = min(h, int(np.ceil(rect[:, 1].max())) + 2)
+        image = _to_gray(image[y0:y1, x0:x1])
+        rect = rect - np.array([x0, y0], dtype="float32")
+
     M = cv2.getPerspectiveTransform(rect, dst)
-    warped = cv2.warpPerspective(image, M, (maxWidth, maxHeight))
-    return warped
+    return cv2.warpPerspective(image, M, (out_w, out_h), dst=out)
+
+def _largest_quad(mask, min_area):
+    contours, _ = cv2.findContours(mask, cv2.RETR_EXTERNAL, cv2.CHAIN_APPROX_SIMPLE)
+    best = None
+    best_area = min_area
+    for c in contours:
+        _, _, w, h = cv2.boundingRect(c)
+        # the polygon's vertices are contour points, so it never outgrows the box
+        if w * h <= best_area:
+            continue
+        peri = cv2.arcLength(c, True)
+        approx = cv2.approxPolyDP(c, 0.02 * peri, True)
+        area = cv2.contourArea(approx)
+        if len(approx) == 4 and area > best_area:
+            best, best_area = approx, area
+    return None if best is None else best.reshape(4, 2).astype("float32")
 
-def detect_sheet_and_warp(image_bgr, debug=False, output_size=(2480, 3508)):
-    """Detects the largest quadrilateral (sheet) and warps. If not found, uses the whole image."""
-    orig = image_bgr.copy()
-    gray = cv2.cvtColor(image_bgr, cv2.COLOR_BGR2GRAY)
+def find_sheet_quad(image_bgr, min_area_frac=0.6):
+    """
+    Corners of the largest quadrilateral covering min_area_frac of the image, or None.
+
+    Tries the edge map first; on a plain background the Otsu paper/background
+    split is tried as well, at any resolution. image_bgr may already be
+    single-channel gray.
+    """
+    gray = _to_gray(image_bgr)
     clahe = cv2.createCLAHE(clipLimit=2.0, tileGridSize=(8,8))
     gray = clahe.apply(gray)
     blurred = cv2.GaussianBlur(gray, (5, 5), 0)
@@ -37,31 +101,222 @@ def detect_sheet_and_warp(image_bgr, debug=False, output_size=(2480, 3508)):
     kernel = np.ones((5,5), np.uint8)
     closed = cv2.morphologyEx(thresh, cv2.MORPH_CLOSE, kernel)
     edged = cv2.Canny(closed, 50, 150)
-    contours, _ = cv2.findContours(edged.copy(), cv2.RETR_EXTERNAL, cv2.CHAIN_APPROX_SIMPLE)
-    contours = sorted(contours, key=cv2.contourArea, reverse=True)
-    img_area = orig.shape[0] * orig.shape[1]
-    for c in contours:
-        peri = cv2.arcLength(c, True)
-        approx = cv2.approxPolyDP(c, 0.02 * peri, True)
-        area = cv2.contourArea(approx)
-        # Only accept quadrilaterals that are at least 60% of the image area
-        if len(approx) == 4 and area > 0.6 * img_area:
-            pts = approx.reshape(4, 2)
-            warped = four_point_transform(orig, pts)
-            warped = cv2.resize(warped, output_size)
-            if debug:
-                print("Warped using contour.")
-            return warped
-    # If no large quadrilateral, just resize the original image (no cropping)
-    warped = cv2.resize(orig, output_size)
+    # close 1px gaps so the sheet outline forms one contour, mostly at coarse scales
+    edged = cv2.dilate(edged, np.ones((3, 3), np.uint8))
+    # Only accept quadrilaterals that are at least 60% of the image area
+    min_area = min_area_frac * image_bgr.shape[0] * image_bgr.shape[1]
+    pts = _largest_quad(edged, min_area)
+    if pts is None:
+        _, paper = cv2.threshold(blurred, 0, 255, cv2.THRESH_BINARY + cv2.THRESH_OTSU)
+        pts = _largest_quad(paper, min_area)
+    return pts
+
+def refine_corners(image_bgr, pts, radius):
+    """
+    Re-locate coarse corner estimates in small full-resolution windows.
+
+    Each window is split into paper/background with Otsu; the refined corner is
+    the paper pixel furthest out along the centre->corner direction, which is
+    the apex of the paper wedge for a convex sheet outline.
+    """
+    h, w = image_bgr.shape[:2]
+    refined = pts.astype("float32").copy()
+    centre = pts.mean(axis=0)
+    for i, (px, py) in enumerate(pts):
+        x0 = int(max(0, px - radius)); x1 = int(min(w, px + radius + 1))
+        y0 = int(max(0, py - radius)); y1 = int(min(h, py + radius + 1))
+        if x1 - x0 < 3 or y1 - y0 < 3:
+            continue
+        window = _to_gray(image_bgr[y0:y1, x0:x1])
+        window = cv2.GaussianBlur(window, (5, 5), 0)
+        _, paper = cv2.threshold(window, 0, 1, cv2.THRESH_BINARY + cv2.THRESH_OTSU)
+        n, labels, stats, _ = cv2.connectedComponentsWithStats(paper, connectivity=4)
+        if n < 2:
+            continue
+        biggest = 1 + int(np.argmax(stats[1:, cv2.CC_STAT_AREA]))
+        ys, xs = np.nonzero(labels == biggest)
+        direction = np.array([px, py]) - centre
+        k = int(np.argmax((xs + x0) * direction[0] + (ys + y0) * direction[1]))
+        refined[i] = (xs[k] + x0, ys[k] + y0)
+    return refined
+
+@metrics.timed("warp.locate")
+def locate_sheet(image_bgr, detect_max_side=1000, fiducials=None):
+    """
+    Corners of the sheet in image_bgr (BGR or gray, full-resolution
+    coordinates), or None.
+
+    fiducials: layouts from template_fiducials(); their corner markers are
+    tried first and the contour search only runs when none is found.
+    With detect_max_side set, the search runs on a copy whose long edge is
+    at most that many pixels; corners are scaled back and refined locally.
+    detect_max_side=None searches the full-resolution image.
+    """
+    return _locate_sheet(image_bgr, detect_max_side, fiducials)[0]
+
+def _locate_sheet(image_bgr, detect_max_side, fiducials):
+    """locate_sheet's (corners or None, "fiducials" / "contour" / None for the locator that found them)"""
+    h, w = image_bgr.shape[:2]
+    scale = 1.0
+    small = image_bgr
+    if detect_max_side and max(h, w) > detect_max_side:
+        scale = detect_max_side / float(max(h, w))
+        small = cv2.resize(image_bgr, (max(1, int(w * scale)), max(1, int(h * scale))),
+                           interpolation=cv2.INTER_AREA)
+
+    if fiducials:
+        for layout in fiducials:
+            pts = locate_fiducials(image_bgr, layout, small, scale)
+            if pts is not None:
+                metrics.count("warp.fiducials")
+                return pts, "fiducials"
+        metrics.count("warp.fiducials_missed")
+
+    pts = find_sheet_quad(small)
+    if pts is None:
+        return None, None
+    if scale != 1.0:
+        pts = pts / scale
+        pts = refine_corners(image_bgr, pts, int(round(12 / scale)))
+    return pts, "contour"
+
+@metrics.timed("warp.warp")
+def warp_sheet(image_bgr, pts, output_size, out=None, gray=False):
+    """Warp located corners onto output_size; pts=None resizes the whole image instead"""
+    if pts is not None:
+        return four_point_transform(image_bgr, pts, output_size, out=out, gray=gray)
+    metrics.count("warp.fallback_resize")
+    src = _to_gray(image_bgr) if gray else image_bgr
+    return cv2.resize(src, output_size, dst=_output_buffer(out, output_size, gray))
+
+def detect_sheet_and_warp(image_bgr, debug=False, output_size=(2480, 3508), detect_max_side=1000,
+                          out=None, gray=False, fiducials=None):
+    """
+    Detects the largest quadrilateral (sheet) and warps. If not found, uses the whole image.
+
+    See locate_sheet for detect_max_side and fiducials. The sheet is mapped onto output_size
+    in one resample. out may be a reusable uint8 buffer of the output shape;
+    gray=True returns a single-channel warp for callers that do not need colour.
+    """
+    pts, method = _locate_sheet(image_bgr, detect_max_side, fiducials)
+    warped = warp_sheet(image_bgr, pts, output_size, out=out, gray=gray)
     if debug:
-        print("Fallback: resized original image (no cropping).")
+        if pts is not None:
+            print(f"Warped using {method}.")
+        else:
+            # If no large quadrilateral, just resize the original image (no cropping)
+            print("Fallback: resized original image (no cropping).")
     return warped
 
-def read_qr_version(warped_bgr):
-    """Try reading a QR from the warped image. Returns string or None."""
-    qr = cv2.QRCodeDetector()
-    data, points, _ = qr.detectAndDecode(warped_bgr)
+_local = threading.local()
+
+def _qr_detector():
+    """One QRCodeDetector per thread (and so per worker process), reused across sheets"""
+    qr = getattr(_local, "qr", None)
+    if qr is None:
+        qr = _local.qr = cv2.QRCodeDetector()
+    return qr
+
+def _decode_qr(image):
+    try:
+        data, points, _ = _qr_detector().detectAndDecode(image)
+    except cv2.error:
+        return None
     if data:
         return data.strip()
     return None
+
+def _qr_roi(warped, roi, max_side):
+    """Gray crop of a normalized [x, y, w, h] region, downscaled to max_side"""
+    h, w = warped.shape[:2]
+    xn, yn, wn, hn = roi
+    x0 = max(0, int(xn * w)); y0 = max(0, int(yn * h))
+    x1 = min(w, int((xn + wn) * w)); y1 = min(h, int((yn + hn) * h))
+    if x1 - x0 < 8 or y1 - y0 < 8:
+        return None
+    crop = _to_gray(warped[y0:y1, x0:x1])
+    long_side = max(crop.shape)
+    if max_side and long_side > max_side:
+        scale = max_side / float(long_side)
+        crop = cv2.resize(crop, (max(1, int(crop.shape[1] * scale)), max(1, int(crop.shape[0] * scale))),
+                          interpolation=cv2.INTER_AREA)
+    return crop
+
+@metrics.timed("qr")
+def read_qr_version(warped_bgr, rois=None, max_side=800, full_frame=True):
+    """
+    Try reading a QR from the warped image. Returns string or None.
+
+    rois: normalized [x, y, w, h] regions where templates print their QR code;
+    each is decoded on a gray crop downscaled to max_side first. The whole
+    (gray) frame is searched only if those fail and full_frame is set.
+    """
+    for roi in rois or ():
+        crop = _qr_roi(warped_bgr, roi, max_side)
+        if crop is None:
+            continue
+        data = _decode_qr(crop)
+        if data:
+            metrics.count("qr.roi_hit")
+            return data
+    if full_frame:
+        metrics.count("qr.full_frame")
+        return _decode_qr(_to_gray(warped_bgr))
+    return None
+
+def template_qr_rois(templates):
+    """
+    QR search plan for a set of candidate templates: (rois, full_frame).
+
+    A template declares "qr_roi": [x, y, w, h] (normalized) where its QR code is
+    printed, or "qr_roi": false when it never prints one. Templates without the
+    key keep the whole-frame search. When every template says false, nothing
+    needs decoding at all: ([], False).
+    """
+    rois = []
+    full_frame = False
+    for template in templates:
+        if hasattr(template, "template"):
+            template = template.template
+        roi = template.get("qr_roi")
+        if roi is False:
+            continue
+        if roi is None:
+            full_frame = True
+        elif roi not in rois:
+            rois.append(roi)
+    return rois, full_frame
+
+class QRVersionReader:
+    """
+    Reads sheet versions across a batch.
+
+    With sticky=True the previously decoded version is assumed while the cheap
+    ROI pass finds nothing; the whole-frame fallback only runs until a first
+    version is known (or always, if no template declares an ROI), and a
+    successful decode that disagrees switches.
+    """
+
+    def __init__(self, rois=None, full_frame=True, sticky=False, max_side=800):
+        self.rois = list(rois or [])
+        self.full_frame = full_frame
+        self.sticky = sticky
+        self.max_side = max_side
+        self.last = None
+
+    def read(self, warped):
+        if not self.rois and not self.full_frame:
+            return None
+        if self.sticky and self.last is not None:
+            # skip the whole-frame search; without ROIs there is nothing cheaper
+            full_frame = self.full_frame and not self.rois
+            data = read_qr_version(warped, self.rois, self.max_side, full_frame)
+            if data:
+                self.last = data
+            else:
+                metrics.count("qr.sticky_assumed")
+            return self.last
+        data = read_qr_version(warped, self.rois, self.max_side, self.full_frame)
+        if data:
+            self.last = data
+        return data
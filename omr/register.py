@@ -0,0 +1,174 @@
+"""
+Local registration of the bubble grid against a warped sheet.
+
+The page warp fixes the sheet corners, but paper curl and lens distortion
+still leave bubbles a few pixels off inside the page. register_template()
+splits the bubbles into tiles, correlates each tile's bubble footprints
+(rendered from the template) with the ink on a downsampled copy, and
+returns the compiled template with every bubble moved by its tile's offset.
+The image itself is never resampled.
+
+    compiled = compile_template(template, (w, h))
+    compiled = register_template(warped, compiled)
+    detect_from_template(warped, compiled)
+"""
+import threading
+
+import cv2
+import numpy as np
+
+from omr import metrics
+
+def _gray(image):
+    if image.ndim == 2:
+        return image
+    return cv2.cvtColor(image, cv2.COLOR_BGR2GRAY)
+
+def _tile_ids(cx, cy, tiles):
+    """Tile index of every bubble centre on a cols x rows grid over the bubble area"""
+    cols, rows = tiles
+    x0, x1 = cx.min(), cx.max()
+    y0, y1 = cy.min(), cy.max()
+    tx = np.minimum(cols - 1, ((cx - x0) * cols / max(x1 - x0, 1e-9)).astype(np.intp))
+    ty = np.minimum(rows - 1, ((cy - y0) * rows / max(y1 - y0, 1e-9)).astype(np.intp))
+    return ty * cols + tx
+
+def _peak(scores):
+    """Sub-pixel (dx, dy) of the maximum of a correlation map, relative to its centre"""
+    _, best, _, (px, py) = cv2.minMaxLoc(scores)
+    h, w = scores.shape
+    sx, sy = float(px), float(py)
+    if 0 < px < w - 1:
+        l, c, r = scores[py, px - 1], scores[py, px], scores[py, px + 1]
+        d = l - 2 * c + r
+        if d < 0:
+            sx += 0.5 * (l - r) / d
+    if 0 < py < h - 1:
+        u, c, b = scores[py - 1, px], scores[py, px], scores[py + 1, px]
+        d = u - 2 * c + b
+        if d < 0:
+            sy += 0.5 * (u - b) / d
+    on_edge = px in (0, w - 1) or py in (0, h - 1)
+    return sx - (w - 1) / 2.0, sy - (h - 1) / 2.0, best, on_edge
+
+def _tile_model(xs, ys, ws, hs, step):
+    """Bubble footprint image of one tile on the downsampled grid, plus its box there"""
+    x0 = int(xs.min()) // step; y0 = int(ys.min()) // step
+    x1 = -(-int((xs + ws).max()) // step); y1 = -(-int((ys + hs).max()) // step)
+    # drawn at full resolution and downsampled like the sheet, so both share
+    # the same pixel grid and the peak carries no half-pixel bias
+    model = np.zeros(((y1 - y0) * step, (x1 - x0) * step), np.uint8)
+    for x, y, bw, bh in zip(xs.tolist(), ys.tolist(), ws.tolist(), hs.tolist()):
+        centre = (int(round((x - x0 * step + (bw - 1) / 2.0) * 16)), int(round((y - y0 * step + (bh - 1) / 2.0) * 16)))
+        axes = (int(round(max(1.0, bw / 2.0 - 1) * 16)), int(round(max(1.0, bh / 2.0 - 1) * 16)))
+        cv2.ellipse(model, centre, axes, 0, 0, 360, 255, -1, cv2.LINE_AA, 4)
+    if step > 1:
+        model = cv2.resize(model, (x1 - x0, y1 - y0), interpolation=cv2.INTER_AREA)
+    return model, (x0, y0, x1, y1)
+
+_models = {}
+_models_lock = threading.Lock()
+
+def _tile_models(compiled, tiles, min_bubbles):
+    """
+    (bubble, step, [(members, model, box)]) for compiled, where bubble is the
+    median bubble size and step the downsampling factor; memoized by identity
+    like compile_template: the footprints only depend on the template geometry.
+    """
+    key = (id(compiled), tuple(tiles), min_bubbles)
+    with _models_lock:
+        hit = _models.get(key)
+        if hit is not None and hit[0] is compiled:
+            return hit[1]
+    xs, ys, ws, hs = compiled.xs, compiled.ys, compiled.ws, compiled.hs
+    bubble = float(np.median(np.minimum(ws, hs)))
+    # keep bubbles around 8 px across on the correlation canvas
+    step = max(1, int(bubble // 8))
+    tile = _tile_ids(xs + ws / 2.0, ys + hs / 2.0, tiles)
+    entries = []
+    for t in np.unique(tile).tolist():
+        members = np.flatnonzero(tile == t)
+        if len(members) >= min_bubbles:
+            entries.append((members,) + _tile_model(xs[members], ys[members], ws[members], hs[members], step))
+    plan = (bubble, step, entries)
+    with _models_lock:
+        if len(_models) > 32:
+            _models.clear()
+        _models[key] = (compiled, plan)
+    return plan
+
+def _tile_offset(ink, model, box, radius, min_score):
+    """Offset (dx, dy) in downsampled pixels of one tile's bubbles, or None"""
+    x0, y0, x1, y1 = box
+    ih, iw = ink.shape
+    if x0 - radius < 0 or y0 - radius < 0 or x1 + radius > iw or y1 + radius > ih:
+        return None
+    patch = ink[y0 - radius:y1 + radius, x0 - radius:x1 + radius]
+    scores = cv2.matchTemplate(patch, model, cv2.TM_CCOEFF_NORMED)
+    dx, dy, best, on_edge = _peak(scores)
+    if best < min_score or on_edge or not np.isfinite(best):
+        return None
+    return dx, dy
+
+def estimate_offsets(warped, compiled, tiles=(3, 4), max_shift=0.5, min_bubbles=8, min_score=0.25):
+    """
+    Per-bubble (dx, dy) pixel offsets of compiled's bubbles on warped.
+
+    tiles: (columns, rows) of the grid the bubble area is split into; each
+           tile with at least min_bubbles bubbles gets its own offset
+    max_shift: search radius as a fraction of the median bubble size
+    min_score: correlation a tile needs for its offset to be trusted
+    Tiles without a trusted offset follow an affine fit of the trusted ones
+    (a plain mean with fewer than three); with none, every offset is zero.
+    """
+    n = len(compiled.keys)
+    dx = np.zeros(n)
+    dy = np.zeros(n)
+    if n == 0:
+        return dx, dy
+    bubble, step, entries = _tile_models(compiled, tiles, min_bubbles)
+    radius = max(1, int(round(max_shift * bubble / step)))
+
+    gray = _gray(warped)
+    if step > 1:
+        h, w = gray.shape[:2]
+        # whole multiples of step keep INTER_AREA on its fast integer path
+        gray = cv2.resize(gray[:h - h % step, :w - w % step], (w // step, h // step),
+                          interpolation=cv2.INTER_AREA)
+    ink = cv2.subtract(255, gray)
+
+    trusted = []
+    for members, model, box in entries:
+        found = _tile_offset(ink, model, box, radius, min_score)
+        if found is None:
+            metrics.count("register.tiles_rejected")
+            continue
+        trusted.append((found[0] * step, found[1] * step, members))
+    metrics.count("register.tiles", len(trusted))
+    if not trusted:
+        return dx, dy
+
+    cx = compiled.xs + compiled.ws / 2.0
+    cy = compiled.ys + compiled.hs / 2.0
+    offsets = np.array([(ox, oy) for ox, oy, _ in trusted])
+    centres = np.array([(cx[m].mean(), cy[m].mean(), 1.0) for _, _, m in trusted])
+    if len(trusted) >= 3 and np.linalg.matrix_rank(centres) == 3:
+        coef, _, _, _ = np.linalg.lstsq(centres, offsets, rcond=None)
+        predicted = np.column_stack([cx, cy, np.ones(n)]) @ coef
+    else:
+        predicted = np.tile(offsets.mean(axis=0), (n, 1))
+    limit = max_shift * bubble
+    dx = np.clip(predicted[:, 0], -limit, limit)
+    dy = np.clip(predicted[:, 1], -limit, limit)
+    for ox, oy, members in trusted:
+        dx[members] = ox
+        dy[members] = oy
+    return dx, dy
+
+@metrics.timed("register")
+def register_template(warped, compiled, **kwargs):
+    """compiled moved onto warped's bubbles; kwargs as for estimate_offsets"""
+    dx, dy = estimate_offsets(warped, compiled, **kwargs)
+    if not (np.rint(dx).any() or np.rint(dy).any()):
+        return compiled
+    return compiled.shifted(dx, dy)
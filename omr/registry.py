@@ -0,0 +1,162 @@
+import json
+import os
+import threading
+import time
+
+from omr.template import compile_template
+
+class TemplateEntry:
+    """One template file with its answer key, as loaded by TemplateRegistry"""
+    __slots__ = ('name', 'path', 'mtime', 'template', 'version', 'answer_key', 'answer_path', 'answer_mtime')
+
+    def __init__(self, name, path, mtime, template, answer_key, answer_path, answer_mtime):
+        self.name = name
+        self.path = path
+        self.mtime = mtime
+        self.template = template
+        self.version = template.get('version')
+        self.answer_key = answer_key
+        self.answer_path = answer_path
+        self.answer_mtime = answer_mtime
+
+    def __repr__(self):
+        return f"TemplateEntry(name={self.name!r}, version={self.version!r})"
+
+
+def _mtime(path):
+    try:
+        return os.stat(path).st_mtime_ns
+    except OSError:
+        return None
+
+class TemplateRegistry:
+    """
+    Templates and answer keys from a templates directory, loaded once and
+    indexed by file name and by exact version.
+
+    Files are re-read only when their mtime changes (checked at most every
+    check_interval seconds), so the template dicts handed out keep their
+    identity and their CompiledTemplate stays cached. Treat them as read-only.
+    """
+
+    def __init__(self, templates_dir="templates", check_interval=1.0):
+        self.templates_dir = templates_dir
+        self.check_interval = check_interval
+        self._lock = threading.Lock()
+        self._entries = {}
+        self._by_version = {}
+        self._checked = None
+        # file name -> load error of the last refresh
+        self.errors = {}
+        self.refresh(force=True)
+
+    def _load_entry(self, name, path, mtime):
+        with open(path) as f:
+            template = json.load(f)
+        answer_key = {}
+        answer_path = None
+        answer_mtime = None
+        if 'answers' in template:
+            answer_key = template['answers']
+        elif template.get('version'):
+            answer_path = os.path.join(self.templates_dir, f"answers_{template['version']}.json")
+            answer_mtime = _mtime(answer_path)
+            if answer_mtime is not None:
+                with open(answer_path) as f:
+                    answer_key = json.load(f)
+        return TemplateEntry(name, path, mtime, template, answer_key, answer_path, answer_mtime)
+
+    def refresh(self, force=False):
+        """Reload templates whose file (or answer key file) changed on disk"""
+        now = time.monotonic()
+        if not force and self._checked is not None and now - self._checked < self.check_interval:
+            return
+        with self._lock:
+            entries = {}
+            for fn in sorted(os.listdir(self.templates_dir)):
+                if not fn.endswith(".json") or fn.startswith("answers_"):
+                    continue
+                path = os.path.join(self.templates_dir, fn)
+                mtime = _mtime(path)
+                old = self._entries.get(fn)
+                if (old is not None and old.mtime == mtime
+                        and (old.answer_path is None or _mtime(old.answer_path) == old.answer_mtime)):
+                    entries[fn] = old
+                    continue
+                try:
+                    entries[fn] = self._load_entry(fn, path, mtime)
+                    self.errors.pop(fn, None)
+                except (OSError, ValueError) as e:
+                    # keep serving the last good copy of a half-edited file
+                    self.errors[fn] = f"{type(e).__name__}: {e}"
+                    if old is not None:
+                        entries[fn] = old
+
+            by_version = {}
+            for fn, entry in entries.items():
+                if entry.version is not None:
+                    by_version.setdefault(str(entry.version), fn)
+            self._entries = entries
+            self._by_version = by_version
+            self._checked = now
+
+    def names(self):
+        self.refresh()
+        return list(self._entries)
+
+    def entry(self, name):
+        self.refresh()
+        return self._entries.get(name)
+
+    def get(self, name):
+        """Template dict for a file name, or None"""
+        entry = self.entry(name)
+        return entry.template if entry is not None else None
+
+    def answer_key(self, name):
+        entry = self.entry(name)
+        return entry.answer_key if entry is not None else {}
+
+    def resolve(self, version):
+        """
+        File name for a QR version string: exact 'version' field first, then
+        exact file name without .json. Unlike a substring match, 'v1' never
+        selects 'answers_v10'/'set_v10.json'.
+        """
+        self.refresh()
+        version = version.strip()
+        name = self._by_version.get(version)
+        if name is not None:
+            return name
+        for fn in self._entries:
+            if fn == version or fn[:-len(".json")] == version:
+                return fn
+        return None
+
+    def templates(self):
+        self.refresh()
+        return {fn: e.template for fn, e in self._entries.items()}
+
+    def answer_keys(self):
+        self.refresh()
+        return {fn: e.answer_key for fn, e in self._entries.items()}
+
+    def compiled(self, name, size):
+        """Shared read-only CompiledTemplate for a file name and canvas size"""
+        template = self.get(name)
+        if template is None:
+            raise KeyError(name)
+        return compile_template(template, size)
+
+
+_registries = {}
+_registries_lock = threading.Lock()
+
+def default_registry(templates_dir="templates"):
+    """Process-wide registry for a templates directory"""
+    key = os.path.abspath(templates_dir)
+    with _registries_lock:
+        reg = _registries.get(key)
+        if reg is None:
+            reg = _registries[key] = TemplateRegistry(templates_dir)
+        return reg
@@ -0,0 +1,493 @@
+"""
+Columnar batch results: one row per sheet, packed per-question arrays.
+
+    builder = ResultSetBuilder()
+    for res in iter_grade_batch(...):
+        builder.add(res['name'], res['result'], res['template'], res['error'])
+    rs = builder.build()
+    rs.save("results/batch.parquet")       # or .arrow / .npz
+    questions, p = ResultSet.load("results/batch.parquet").item_difficulty()
+
+Per-question answers are int8 matrices (sheets x questions) over the union of
+questions seen in the batch:
+    selected: option index into .options, NO_SELECTION (blank or multiple
+              marks) or ABSENT (question not on that sheet's template)
+    correct:  1 / 0, NO_SELECTION when not scored, ABSENT as above
+Optionally every bubble's raw fill ratio is kept too (sheets x questions x
+options, NaN where there is no bubble), so thresholds, selection rules and
+answer keys can be re-applied with regrade() without touching the images.
+Parquet and Arrow IPC need pyarrow; .npz works with NumPy alone.
+"""
+import json
+import os
+
+import numpy as np
+
+from omr.calibrate import AMBIGUOUS, MARKED, grid_states
+from omr.scoring import ABSENT, NO_SELECTION, score_batch
+from omr.selection import SelectionPolicy
+
+# cell codes for the 'correct' matrix besides 1 / 0
+_CORRECT_CODES = {True: 1, False: 0, None: NO_SELECTION}
+
+# uint8 fill ratios: 0..RATIO_SCALE maps onto 0..1, RATIO_MISSING is "no bubble"
+RATIO_SCALE = 254
+RATIO_MISSING = 255
+
+def quantize_ratios(ratios):
+    """float ratios (NaN for no bubble) -> uint8, resolution 1/254"""
+    ratios = np.asarray(ratios, dtype=np.float32)
+    q = np.rint(np.clip(ratios, 0.0, 1.0) * RATIO_SCALE)
+    return np.where(np.isnan(ratios), RATIO_MISSING, q).astype(np.uint8)
+
+def dequantize_ratios(packed):
+    packed = np.asarray(packed)
+    ratios = packed.astype(np.float16) / np.float16(RATIO_SCALE)
+    ratios[packed == RATIO_MISSING] = np.nan
+    return ratios
+
+def _arrow():
+    try:
+        import pyarrow
+        import pyarrow.ipc
+        import pyarrow.parquet
+    except ImportError:
+        raise ValueError("Parquet/Arrow result files need pyarrow; install it or save as .npz")
+    return pyarrow
+
+def preferred_suffix():
+    """'.parquet' when pyarrow is installed, else '.npz'"""
+    try:
+        _arrow()
+    except ValueError:
+        return ".npz"
+    return ".parquet"
+
+def _format(path):
+    ext = os.path.splitext(path)[1].lower()
+    if ext == ".parquet":
+        return "parquet"
+    if ext in (".arrow", ".feather", ".ipc"):
+        return "arrow"
+    if ext == ".npz":
+        return "npz"
+    raise ValueError(f"Unknown result file type {ext!r}; use .parquet, .arrow or .npz")
+
+def _stack_ratios(sets):
+    """Row-wise ratios of reindexed sets, NaN for sets stored without them"""
+    if all(rs.ratios is None for rs in sets):
+        return None
+    return np.concatenate([rs.ratios if rs.ratios is not None else
+                           np.full((len(rs), len(rs.questions), len(rs.options)), np.nan, np.float16)
+                           for rs in sets])
+
+class ResultSet:
+    """
+    Graded sheets of a batch as columns.
+
+    names, templates, errors: per-sheet strings ('' when missing)
+    total_score: float32; ambiguous_count: int32
+    scored: bool, False for sheets graded without an answer key
+    subjects: subject names; subject_scores: float32 (sheets x subjects), NaN if absent
+    questions: int64 question numbers; options: option labels
+    selected, correct: int8 (sheets x questions), see the module docstring
+    ratios: float16 (sheets x questions x options) fill ratios, or None
+    """
+
+    def __init__(self, names, templates, errors, total_score, ambiguous_count, scored, subjects, subject_scores,
+                 questions, options, selected, correct, ratios=None):
+        self.names = np.asarray(names, dtype=str)
+        self.templates = np.asarray(templates, dtype=str)
+        self.errors = np.asarray(errors, dtype=str)
+        self.total_score = np.asarray(total_score, dtype=np.float32)
+        self.ambiguous_count = np.asarray(ambiguous_count, dtype=np.int32)
+        self.scored = np.asarray(scored, dtype=bool)
+        self.subjects = tuple(subjects)
+        self.subject_scores = np.asarray(subject_scores, dtype=np.float32).reshape(len(self.names), len(self.subjects))
+        self.questions = np.asarray(questions, dtype=np.int64)
+        self.options = tuple(options)
+        self.selected = np.asarray(selected, dtype=np.int8).reshape(len(self.names), len(self.questions))
+        self.correct = np.asarray(correct, dtype=np.int8).reshape(len(self.names), len(self.questions))
+        if ratios is not None:
+            ratios = np.asarray(ratios, dtype=np.float16).reshape(
+                len(self.names), len(self.questions), len(self.options))
+        self.ratios = ratios
+
+    def __len__(self):
+        return len(self.names)
+
+    def __repr__(self):
+        return f"ResultSet(sheets={len(self)}, questions={len(self.questions)}, options={self.options})"
+
+    def subset(self, mask):
+        """Rows selected by a boolean mask or index array, e.g. rs.subset(rs.templates == 'setA.json')"""
+        return ResultSet(self.names[mask], self.templates[mask], self.errors[mask], self.total_score[mask],
+                         self.ambiguous_count[mask], self.scored[mask], self.subjects, self.subject_scores[mask],
+                         self.questions, self.options, self.selected[mask], self.correct[mask],
+                         None if self.ratios is None else self.ratios[mask])
+
+    def reindexed(self, questions, options, subjects):
+        """The same rows over other question / option / subject sets (which must be supersets)"""
+        questions = np.asarray(questions, dtype=np.int64)
+        options = tuple(options)
+        subjects = tuple(subjects)
+        n = len(self)
+
+        cols = np.searchsorted(questions, self.questions)
+        selected = np.full((n, len(questions)), ABSENT, np.int8)
+        correct = np.full((n, len(questions)), ABSENT, np.int8)
+        # option codes: shift old option indices onto the new option list; the
+        # two trailing entries are what the negative codes index
+        remap = np.array([options.index(o) for o in self.options] + [ABSENT, NO_SELECTION], np.int8)
+        selected[:, cols] = remap[self.selected.astype(np.intp)]
+        correct[:, cols] = self.correct
+
+        subject_scores = np.full((n, len(subjects)), np.nan, np.float32)
+        subject_scores[:, [subjects.index(s) for s in self.subjects]] = self.subject_scores
+
+        ratios = None
+        if self.ratios is not None:
+            ratios = np.full((n, len(questions), len(options)), np.nan, np.float16)
+            ratios[np.ix_(np.arange(n), cols, remap[:len(self.options)].astype(np.intp))] = self.ratios
+        return ResultSet(self.names, self.templates, self.errors, self.total_score, self.ambiguous_count,
+                         self.scored, subjects, subject_scores, questions, options, selected, correct, ratios)
+
+    @staticmethod
+    def concat(sets):
+        """Stack result sets row-wise over the union of their questions, options and subjects"""
+        sets = list(sets)
+        if not sets:
+            return ResultSetBuilder().build()
+        questions = np.unique(np.concatenate([rs.questions for rs in sets]))
+        options = []
+        subjects = []
+        for rs in sets:
+            options.extend(o for o in rs.options if o not in options)
+            subjects.extend(s for s in rs.subjects if s not in subjects)
+        options.sort(key=str)
+        sets = [rs.reindexed(questions, options, subjects) for rs in sets]
+        return ResultSet(
+            np.concatenate([rs.names for rs in sets]), np.concatenate([rs.templates for rs in sets]),
+            np.concatenate([rs.errors for rs in sets]), np.concatenate([rs.total_score for rs in sets]),
+            np.concatenate([rs.ambiguous_count for rs in sets]), np.concatenate([rs.scored for rs in sets]),
+            subjects,
+            np.concatenate([rs.subject_scores for rs in sets]), questions, options,
+            np.concatenate([rs.selected for rs in sets]), np.concatenate([rs.correct for rs in sets]),
+            _stack_ratios(sets))
+
+    def rescored(self, template, answer_key, rows=None, per_subject_max=20):
+        """
+        Re-score rows (default: all) against another answer key without
+        re-detecting anything, e.g. after a key correction. template supplies
+        the subjects; returns a new ResultSet.
+        """
+        if rows is None:
+            rows = np.arange(len(self))
+        names, scores, totals, correct = score_batch(self.selected[rows], self.questions, self.options,
+                                                     template, answer_key, per_subject_max)
+        subjects = list(self.subjects) + [s for s in names if s not in self.subjects]
+        rs = self.reindexed(self.questions, self.options, subjects)
+        rs.total_score = rs.total_score.copy()
+        rs.scored = rs.scored.copy()
+        rs.correct[rows] = correct
+        rs.total_score[rows] = totals
+        rs.scored[rows] = True
+        cols = [subjects.index(s) for s in names]
+        rs.subject_scores[np.ix_(np.arange(len(self))[rows], cols)] = scores
+        return rs
+
+    def rederived(self, low_thresh=0.12, high_thresh=0.40, rule="single", adaptive=False):
+        """
+        New selections from the stored fill ratios, for rows that have them.
+
+        A bubble is marked at ratio >= high_thresh and ambiguous between the
+        thresholds (ambiguous_count is recounted from that). rule "single"
+        selects an option only when exactly one is marked, as at grading
+        time; "max" takes the darkest option whenever it is marked; a
+        SelectionPolicy (omr.selection) decides from every option's ratio.
+        adaptive fits the thresholds to each sheet's ratios as at grading time
+        (omr.calibrate.grid_states).
+        Scores are left as they were; follow with rescored() or use regrade().
+        """
+        if not isinstance(rule, SelectionPolicy) and rule not in ("single", "max"):
+            raise ValueError(f"Unknown selection rule {rule!r}")
+        if self.ratios is None:
+            raise ValueError("This result set has no fill ratios stored")
+        ratios = self.ratios.astype(np.float32)
+        has = ~np.isnan(ratios)
+        rows = has.any(axis=(1, 2))
+        if adaptive:
+            states = np.array([grid_states(sheet, low_thresh, high_thresh, adaptive=True) for sheet in ratios],
+                              np.int8).reshape(ratios.shape)
+        else:
+            states = grid_states(ratios, low_thresh, high_thresh)
+        marked = states == MARKED
+        ambiguous = ((states == AMBIGUOUS) & has).sum(axis=(1, 2))
+        if isinstance(rule, SelectionPolicy):
+            pick, _ = rule.decide(states, ratios)
+            pick = np.where(pick >= 0, pick, NO_SELECTION)
+        elif rule == "single":
+            pick = np.where(marked.sum(axis=2) == 1, marked.argmax(axis=2), NO_SELECTION)
+        else:
+            darkest = np.where(has, ratios, -1.0).argmax(axis=2)
+            pick = np.where(marked.any(axis=2), darkest, NO_SELECTION)
+        pick = np.where(has.any(axis=2), pick, self.selected)
+
+        rs = self.subset(slice(None))
+        rs.correct = self.correct.copy()
+        rs.selected = np.where(rows[:, None], pick, self.selected).astype(np.int8)
+        rs.ambiguous_count = np.where(rows, ambiguous, self.ambiguous_count).astype(np.int32)
+        return rs
+
+    def regrade(self, templates, answer_keys, low_thresh=0.12, high_thresh=0.40, rule="single",
+                per_subject_max=20, adaptive=False):
+        """
+        Re-derive selections from the stored ratios and re-score every sheet
+        with its template's answer key, without re-imaging.
+        templates / answer_keys: {name as in .templates: template / key}
+        """
+        rs = self.rederived(low_thresh, high_thresh, rule, adaptive)
+        names = set(rs.templates[rs.templates != ""].tolist())
+        missing = sorted(names - set(templates))
+        if missing:
+            raise ValueError(f"No template given for {', '.join(missing)}")
+        for name in sorted(names):
+            rows = np.flatnonzero(rs.templates == name)
+            key = answer_keys.get(name)
+            if key:
+                rs = rs.rescored(templates[name], key, rows, per_subject_max)
+            else:
+                sel = rs.selected[rows]
+                rs.correct[rows] = np.where(sel == ABSENT, ABSENT, NO_SELECTION)
+        return rs
+
+    # ---- aggregate queries ----
+
+    def item_difficulty(self):
+        """
+        Fraction of sheets answering each question correctly, over the scored
+        sheets whose template has it (blank and multi-marked count as wrong).
+        returns: (questions, difficulty float64, NaN for questions nobody had)
+        """
+        correct = self.correct[self.scored]
+        present = (correct != ABSENT).sum(axis=0)
+        right = (correct == 1).sum(axis=0)
+        with np.errstate(invalid="ignore", divide="ignore"):
+            difficulty = right / present.astype(np.float64)
+        return self.questions, np.where(present > 0, difficulty, np.nan)
+
+    def option_distribution(self):
+        """
+        How often each option was chosen per question.
+        returns: (questions, labels, counts int64 of shape (questions, labels));
+                 labels are the options followed by None for no single selection
+        """
+        n_opt = len(self.options)
+        codes = self.selected.astype(np.intp)
+        codes = np.where(codes == NO_SELECTION, n_opt, codes)
+        keep = codes != ABSENT
+        cols = np.broadcast_to(np.arange(len(self.questions)), codes.shape)
+        flat = cols[keep] * (n_opt + 1) + codes[keep]
+        counts = np.bincount(flat, minlength=len(self.questions) * (n_opt + 1))
+        return self.questions, self.options + (None,), counts.reshape(len(self.questions), n_opt + 1)
+
+    def subject_means(self):
+        """Mean score per subject over the sheets that have it"""
+        means = {}
+        for i, name in enumerate(self.subjects):
+            col = self.subject_scores[:, i]
+            col = col[~np.isnan(col)]
+            means[name] = float(col.mean()) if len(col) else None
+        return means
+
+    # ---- storage ----
+
+    def save(self, path, ratio_dtype="uint8"):
+        """
+        Write to .parquet / .arrow (pyarrow) or .npz, by extension. Fill
+        ratios are stored as uint8 (see quantize_ratios) or, in .npz only,
+        as float16.
+        """
+        fmt = _format(path)
+        if ratio_dtype not in ("uint8", "float16"):
+            raise ValueError(f"Unsupported ratio dtype {ratio_dtype!r}")
+        extra = {}
+        if self.ratios is not None:
+            extra['ratios'] = self.ratios if ratio_dtype == "float16" and fmt == "npz" \
+                else quantize_ratios(self.ratios)
+        tmp = f"{path}.{os.getpid()}.tmp"
+        if fmt == "npz":
+            with open(tmp, "wb") as f:
+                np.savez(f, **extra, names=self.names, templates=self.templates, errors=self.errors,
+                         total_score=self.total_score, ambiguous_count=self.ambiguous_count, scored=self.scored,
+                         subjects=np.asarray(self.subjects, dtype=str), subject_scores=self.subject_scores,
+                         questions=self.questions, options=np.asarray([str(o) for o in self.options], dtype=str),
+                         selected=self.selected, correct=self.correct)
+        else:
+            pa = _arrow()
+            table = self._to_arrow(pa, extra.get('ratios'))
+            if fmt == "parquet":
+                pa.parquet.write_table(table, tmp)
+            else:
+                with pa.OSFile(tmp, "wb") as sink, pa.ipc.new_file(sink, table.schema) as writer:
+                    writer.write_table(table)
+        os.replace(tmp, path)
+
+    def _to_arrow(self, pa, ratios=None):
+        nq = len(self.questions)
+        columns = {
+            'name': pa.array(self.names.tolist(), pa.string()),
+            'template': pa.array(self.templates.tolist(), pa.string()),
+            'error': pa.array(self.errors.tolist(), pa.string()),
+            'total_score': pa.array(self.total_score),
+            'ambiguous_count': pa.array(self.ambiguous_count),
+            'scored': pa.array(self.scored),
+            'selected': pa.FixedSizeListArray.from_arrays(pa.array(self.selected.ravel()), nq),
+            'correct': pa.FixedSizeListArray.from_arrays(pa.array(self.correct.ravel()), nq),
+        }
+        if ratios is not None:
+            columns['ratios'] = pa.FixedSizeListArray.from_arrays(pa.array(ratios.ravel()), ratios[0].size)
+        for i, name in enumerate(self.subjects):
+            columns[f"subject:{name}"] = pa.array(self.subject_scores[:, i])
+        meta = {'questions': json.dumps(self.questions.tolist()), 'options': json.dumps(list(self.options))}
+        return pa.table(columns, metadata=meta)
+
+    @staticmethod
+    def load(path):
+        fmt = _format(path)
+        if fmt == "npz":
+            with np.load(path) as d:
+                ratios = d['ratios'] if 'ratios' in d.files else None
+                if ratios is not None and ratios.dtype == np.uint8:
+                    ratios = dequantize_ratios(ratios)
+                return ResultSet(d['names'], d['templates'], d['errors'], d['total_score'],
+                                 d['ambiguous_count'], d['scored'], d['subjects'].tolist(), d['subject_scores'],
+                                 d['questions'], d['options'].tolist(), d['selected'], d['correct'], ratios)
+        pa = _arrow()
+        if fmt == "parquet":
+            table = pa.parquet.read_table(path)
+        else:
+            with pa.memory_map(path) as source:
+                table = pa.ipc.open_file(source).read_all()
+        meta = table.schema.metadata
+        questions = json.loads(meta[b'questions'])
+        options = json.loads(meta[b'options'])
+        n = table.num_rows
+        nq = len(questions)
+
+        def matrix(col):
+            values = table.column(col).combine_chunks().flatten().to_numpy()
+            return values.reshape(n, nq)
+
+        ratios = None
+        if 'ratios' in table.column_names:
+            ratios = dequantize_ratios(table.column('ratios').combine_chunks().flatten().to_numpy())
+        subjects = [c[len("subject:"):] for c in table.column_names if c.startswith("subject:")]
+        subject_scores = np.stack([table.column(f"subject:{s}").to_numpy() for s in subjects], axis=1) \
+            if subjects else np.zeros((n, 0), np.float32)
+        return ResultSet(table.column('name').to_pylist(), table.column('template').to_pylist(),
+                         table.column('error').to_pylist(), table.column('total_score').to_numpy(),
+                         table.column('ambiguous_count').to_numpy(),
+                         table.column('scored').to_numpy(zero_copy_only=False), subjects, subject_scores,
+                         questions, options, matrix('selected'), matrix('correct'), ratios)
+
+
+class ResultSetBuilder:
+    """Accumulates graded sheets and packs them into a ResultSet"""
+
+    def __init__(self):
+        self._rows = []
+        self._per_question = []
+        self._subject_scores = []
+        self._options = {}
+        self._ratios = []
+
+    def __len__(self):
+        return len(self._rows)
+
+    def _option_code(self, opt):
+        code = self._options.get(opt)
+        if code is None:
+            code = self._options[opt] = len(self._options)
+        return code
+
+    def add(self, name, result, template=None, error=None, ratios=None):
+        """
+        result: the dict from grade_sheet (None for a failed sheet)
+        ratios: optional (questions, options, grid) fill ratios, e.g. the
+                'ratios' entry of iter_grade_batch(..., fill_ratios=True)
+        """
+        result = result or {}
+        qs = []
+        sel = []
+        cor = []
+        for q, res in (result.get('per_question') or {}).items():
+            qs.append(int(q))
+            opt = res.get('selected')
+            if opt is None:
+                sel.append(NO_SELECTION)
+            else:
+                sel.append(self._option_code(opt))
+            cor.append(_CORRECT_CODES[res.get('correct')])
+        scored = bool(result.get('per_subject_score')) or any(c != NO_SELECTION for c in cor)
+        self._rows.append((str(name), str(template or result.get('template_used') or ''), str(error or ''),
+                           float(result.get('total_score') or 0), int(result.get('ambiguous_count') or 0), scored))
+        self._per_question.append((np.asarray(qs, np.int64), np.asarray(sel, np.int8), np.asarray(cor, np.int8)))
+        self._subject_scores.append(result.get('per_subject_score') or {})
+        if ratios is not None:
+            questions, options, grid = ratios
+            ratios = (np.asarray(questions, np.int64), np.array([self._option_code(o) for o in options], np.intp),
+                      np.asarray(grid, np.float16))
+        self._ratios.append(ratios)
+
+    def add_record(self, record):
+        """A record written by the CLI (to_record) or read back from a ResultStore"""
+        if 'result' in record:
+            self.add(record['name'], record['result'])
+        else:
+            self.add(record['file'], record, record.get('template'), record.get('error'))
+
+    def build(self):
+        n = len(self._rows)
+        if len(self._options) > 127:
+            raise ValueError("Too many distinct options for int8 codes")
+        # options in a stable, readable order
+        options = sorted(self._options, key=str)
+        recode = np.full(len(self._options) + 2, 0, np.int8)
+        for opt, code in self._options.items():
+            recode[code] = options.index(opt)
+        recode[NO_SELECTION] = NO_SELECTION
+        recode[ABSENT] = ABSENT
+
+        lengths = np.array([len(qs) for qs, _, _ in self._per_question], np.intp)
+        all_q = np.concatenate([qs for qs, _, _ in self._per_question]) if n else np.zeros(0, np.int64)
+        ratio_q = [r[0] for r in self._ratios if r is not None]
+        questions = np.unique(np.concatenate([all_q] + ratio_q))
+        rows = np.repeat(np.arange(n), lengths)
+        cols = np.searchsorted(questions, all_q)
+        selected = np.full((n, len(questions)), ABSENT, np.int8)
+        correct = np.full((n, len(questions)), ABSENT, np.int8)
+        if len(all_q):
+            sel = np.concatenate([s for _, s, _ in self._per_question])
+            selected[rows, cols] = recode[sel.astype(np.intp)]
+            correct[rows, cols] = np.concatenate([c for _, _, c in self._per_question])
+
+        subjects = []
+        for scores in self._subject_scores:
+            subjects.extend(s for s in scores if s not in subjects)
+        subject_scores = np.full((n, len(subjects)), np.nan, np.float32)
+        for i, scores in enumerate(self._subject_scores):
+            for name, score in scores.items():
+                subject_scores[i, subjects.index(name)] = score
+
+        ratios = None
+        if ratio_q:
+            ratios = np.full((n, len(questions), len(options)), np.nan, np.float16)
+            for i, r in enumerate(self._ratios):
+                if r is not None:
+                    qs, codes, grid = r
+                    ratios[i][np.ix_(np.searchsorted(questions, qs), recode[codes].astype(np.intp))] = grid
+
+        names, templates, errors, totals, ambiguous, scored = zip(*self._rows) if n else ((),) * 6
+        return ResultSet(list(names), list(templates), list(errors), list(totals), list(ambiguous), list(scored),
+                         subjects, subject_scores, questions, options, selected, correct, ratios)
@@ -0,0 +1,141 @@
+"""
+Bulk storage of ambiguous bubble crops for manual review.
+
+A batch is written as two files next to each other:
+    <prefix>.crops.npy   every crop's gray pixels, flattened back to back (uint8)
+    <prefix>.index.npz   one row per crop: sheet, q, option, rect, ratio, offset
+The crops file is opened memory-mapped, so review tooling only pages in the
+crops it actually shows.
+"""
+import os
+
+import cv2
+import numpy as np
+
+INDEX_DTYPE = np.dtype([
+    ('sheet', np.int32),
+    ('q', np.int32),
+    ('option', 'U8'),
+    ('x', np.int32), ('y', np.int32), ('w', np.int32), ('h', np.int32),
+    ('ratio', np.float32),
+    ('offset', np.int64),
+])
+
+def crop_ambiguous(image, ambiguous):
+    """Gray copies of the sampled ambiguous bubbles, aligned with their 'rect' entries"""
+    crops = []
+    for amb in ambiguous:
+        rect = amb.get('rect')
+        if rect is None:
+            crops.append(None)
+            continue
+        x, y, w, h = rect
+        crop = image[y:y+h, x:x+w]
+        if crop.ndim == 3:
+            crop = cv2.cvtColor(crop, cv2.COLOR_BGR2GRAY)
+        crops.append(np.ascontiguousarray(crop))
+    return crops
+
+class AmbiguousCropWriter:
+    """
+    Collects ambiguous crops of a whole batch and writes them in bulk.
+
+    Pixels are spilled to a temporary file as sheets are added, so memory does
+    not grow with the batch; close() turns it into the final .npy.
+    """
+
+    def __init__(self, prefix):
+        self.prefix = prefix
+        out_dir = os.path.dirname(prefix)
+        if out_dir:
+            os.makedirs(out_dir, exist_ok=True)
+        self._spill_path = prefix + ".crops.tmp"
+        self._spill = open(self._spill_path, "wb")
+        self._offset = 0
+        self._rows = []
+        self.sheets = []
+
+    def add(self, sheet_id, ambiguous, image=None, crops=None):
+        """
+        Record one sheet's ambiguous bubbles. Pass either the warped image the
+        rects refer to, or crops already cut from it (see crop_ambiguous).
+        """
+        if crops is None:
+            if image is None and ambiguous:
+                raise ValueError("Need either the warped image or precomputed crops")
+            crops = crop_ambiguous(image, ambiguous) if ambiguous else []
+        sheet = len(self.sheets)
+        self.sheets.append(str(sheet_id))
+        for amb, crop in zip(ambiguous, crops):
+            if crop is None:
+                continue
+            x, y, w, h = amb['rect']
+            self._spill.write(crop.tobytes())
+            self._rows.append((sheet, amb['q'], str(amb['option']), x, y, w, h, amb['ratio'], self._offset))
+            self._offset += crop.size
+
+    def close(self):
+        """Write <prefix>.crops.npy and <prefix>.index.npz; returns the number of crops"""
+        self._spill.close()
+        if self._offset == 0:
+            # an empty file cannot be memory-mapped
+            np.save(self.prefix + ".crops.npy", np.zeros(0, np.uint8))
+        else:
+            self._copy_spill()
+        os.remove(self._spill_path)
+
+        index = np.array(self._rows, dtype=INDEX_DTYPE)
+        np.savez(self.prefix + ".index.npz", index=index, sheets=np.array(self.sheets, dtype=str))
+        return len(index)
+
+    def _copy_spill(self):
+        crops = np.lib.format.open_memmap(self.prefix + ".crops.npy", mode="w+", dtype=np.uint8,
+                                          shape=(self._offset,))
+        chunk = 1 << 24
+        with open(self._spill_path, "rb") as f:
+            pos = 0
+            while pos < self._offset:
+                data = f.read(chunk)
+                crops[pos:pos + len(data)] = np.frombuffer(data, np.uint8)
+                pos += len(data)
+        crops.flush()
+        del crops
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+class AmbiguousCropStore:
+    """Read side of a batch written by AmbiguousCropWriter"""
+
+    def __init__(self, prefix):
+        with np.load(prefix + ".index.npz") as data:
+            self.index = data['index']
+            self.sheets = data['sheets'].tolist()
+        if len(self.index):
+            self._crops = np.load(prefix + ".crops.npy", mmap_mode="r")
+        else:
+            self._crops = np.zeros(0, np.uint8)
+
+    def __len__(self):
+        return len(self.index)
+
+    def crop(self, i):
+        """i-th crop as a (h, w) view into the memory-mapped pixels"""
+        row = self.index[i]
+        start = int(row['offset'])
+        h, w = int(row['h']), int(row['w'])
+        return self._crops[start:start + h * w].reshape(h, w)
+
+    def record(self, i):
+        row = self.index[i]
+        return {'sheet_id': self.sheets[row['sheet']], 'q': int(row['q']), 'option': str(row['option']),
+                'rect': (int(row['x']), int(row['y']), int(row['w']), int(row['h'])),
+                'ratio': float(row['ratio'])}
+
+    def for_sheet(self, sheet_id):
+        """Indices of the crops belonging to one sheet"""
+        sheet = self.sheets.index(str(sheet_id))
+        return np.flatnonzero(self.index['sheet'] == sheet)
@@ -2,46 +2,60 @@ import json
 import math
 import os
 
+import numpy as np
+
+from omr import metrics
+from omr.detectbub_fixed import choose_selected_option
+from omr.template import CompiledTemplate
+
+# codes of a selected-option matrix besides option indices
+NO_SELECTION = -1   # blank or more than one mark
+ABSENT = -2         # question not on the sheet's template
+NO_KEY = -3         # answer key has no usable answer; never matches
+
 def load_answer_key(path):
     with open(path, "r") as f:
         return json.load(f)
 
-def compute_scores(detected_answers, template, answer_key, per_subject_max=20):
+@metrics.timed("score")
+def compute_scores(detected_answers, template, answer_key, per_subject_max=20, selections=None):
     """
     detected_answers: dict {q: {opt: True/False/None}}
-    template: template JSON (with 'subjects' list)
+    template: template JSON (with 'subjects' list) or a CompiledTemplate
     answer_key: dict mapping question "1" -> "A" etc (strings)
+    selections: optional {q: (selected, status)} from SelectionPolicy.select,
+                used instead of the single-mark rule; each question's
+                result then also carries its 'status'
     Returns:
       per_subject_score: {subject_name: score_out_of_20}
       total_score_0_100: float
       per_question_result: {q: {'selected': 'A' or None, 'correct': True/False/None}}
     """
-    # Build quick map of selected option per q
-    def get_selected(opt_dict):
-        marked = [opt for opt, st in opt_dict.items() if st is True]
-        if len(marked) == 1:
-            return marked[0]
-        # if none marked, or multiple, treat as None (can be flagged)
-        return None
-
     per_question_result = {}
     for q, opts in detected_answers.items():
-        selected = get_selected(opts)
+        if selections is not None:
+            selected, status = selections[q]
+        else:
+            selected = choose_selected_option(opts)
         correct_ans = answer_key.get(str(q))
         if selected is None:
             correct = None
         else:
             correct = (selected == correct_ans)
         per_question_result[int(q)] = {'selected': selected, 'correct': correct}
+        if selections is not None:
+            per_question_result[int(q)]['status'] = status
 
     # For each subject, count correct raw, then scale to per_subject_max
+    if isinstance(template, CompiledTemplate):
+        subjects = template.subjects
+    else:
+        subjects = [(s['name'], int(s['q_start']), int(s['q_count'])) for s in template['subjects']]
+
     per_subject_score = {}
     total_raw = 0
     total_max_raw = 0
-    for s in template['subjects']:
-        name = s['name']
-        q_start = int(s['q_start'])
-        q_count = int(s['q_count'])
+    for name, q_start, q_count in subjects:
         raw_correct = 0
         for qi in range(q_start, q_start + q_count):
             res = per_question_result.get(qi)
@@ -62,3 +76,58 @@ def compute_scores(detected_answers, template, answer_key, per_subject_max=20):
     total_score_0_100 = round((total_raw / total_max_raw) * 100 if total_max_raw > 0 else 0, 2)
 
     return per_subject_score, total_score_0_100, per_question_result
+
+def _subjects(template):
+    if isinstance(template, CompiledTemplate):
+        return template.subjects
+    return [(s['name'], int(s['q_start']), int(s['q_count'])) for s in template.get('subjects', [])]
+
+def encode_answer_key(answer_key, questions, options):
+    """Answer key as int8 option indices aligned with questions (NO_KEY where it has none)"""
+    lookup = {opt: i for i, opt in enumerate(options)}
+    return np.array([lookup.get(answer_key.get(str(int(q))), NO_KEY) for q in questions], np.int8)
+
+def _score_table(raw_max, scale):
+    """Scaled, rounded score for every raw count 0..raw_max, exactly as compute_scores rounds it"""
+    if raw_max <= 0:
+        return np.zeros(1)
+    return np.array([round((raw / raw_max) * scale, 2) for raw in range(raw_max + 1)])
+
+@metrics.timed("score.batch")
+def score_batch(selected, questions, options, template, answer_key, per_subject_max=20):
+    """
+    Score many sheets of one template at once; same numbers as compute_scores.
+
+    selected: int (sheets x questions) matrix of indices into options, or
+              NO_SELECTION / ABSENT
+    questions: question number of each column; template: for its subjects
+    answer_key: {"1": "A", ...} or an encode_answer_key() vector
+    Returns:
+      subject_names: [name] in template order
+      subject_scores: float64 (sheets x subjects)
+      total_scores: float64 (sheets,)
+      correct: int8 (sheets x questions): 1 / 0, NO_SELECTION or ABSENT
+    """
+    selected = np.asarray(selected)
+    questions = np.asarray(questions, dtype=np.int64)
+    if isinstance(answer_key, dict):
+        key = encode_answer_key(answer_key, questions, options)
+    else:
+        key = np.asarray(answer_key)
+
+    chosen = selected >= 0
+    right = chosen & (selected == key)
+    correct = np.where(chosen, right, selected).astype(np.int8)
+
+    subjects = _subjects(template)
+    membership = np.zeros((len(questions), len(subjects)), np.int32)
+    for j, (_, q_start, q_count) in enumerate(subjects):
+        membership[(questions >= q_start) & (questions < q_start + q_count), j] = 1
+    raw = right.astype(np.int32) @ membership
+
+    subject_scores = np.zeros(raw.shape, np.float64)
+    for j, (_, _, q_count) in enumerate(subjects):
+        subject_scores[:, j] = _score_table(q_count, per_subject_max)[raw[:, j]]
+    total_max = sum(q_count for _, _, q_count in subjects)
+    total_scores = _score_table(total_max, 100)[raw.sum(axis=1)]
+    return [name for name, _, _ in subjects], subject_scores, total_scores, correct
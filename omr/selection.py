@@ -0,0 +1,145 @@
+"""
+Per-question selection from bubble states and fill ratios.
+
+The plain rule (choose_selected_option without a policy) accepts exactly one
+marked bubble and gives up on everything else. A SelectionPolicy also looks
+at the fill ratio of every option of the question:
+
+    status     when                                              selected
+    single     one marked bubble and nothing ambiguous           that option
+    resolved   the darkest option beats the next by margin, and   the darkest
+               by more than the others spread among themselves
+    blank      nothing marked and no option stands out from      None
+               the lightest one by blank_spread or more
+    multi      two or more marked, none clearly darkest          None
+    review     anything else                                     None
+
+Only 'review' questions need a person (multi-marks too with
+multi_mark="review"); score_detected lists them in result['review'].
+
+    policy = SelectionPolicy(margin=0.15)
+    grade_sheet(image, templates, "setb.json", policy=policy)
+"""
+import numpy as np
+
+from omr.calibrate import AMBIGUOUS, BLANK, MARKED
+
+STATUSES = ("single", "resolved", "blank", "multi", "review")
+_SINGLE, _RESOLVED, _BLANK, _MULTI, _REVIEW = range(len(STATUSES))
+
+_STATE_CODES = {True: MARKED, False: BLANK, None: AMBIGUOUS}
+
+class SelectionPolicy:
+    """
+    margin: fill ratio lead the darkest option needs over the next one to be
+            taken when the states alone do not decide; None never resolves
+    blank_spread: a question with nothing marked whose options all lie within
+                  this of each other is blank, not unclear
+    multi_mark: "invalid" (clear double marks select nothing, like a blank)
+                or "review" (queue them)
+    """
+
+    def __init__(self, margin=0.15, blank_spread=0.05, multi_mark="invalid"):
+        if multi_mark not in ("invalid", "review"):
+            raise ValueError(f"Unknown multi_mark handling {multi_mark!r}")
+        if margin is not None and margin <= 0:
+            raise ValueError("margin must be positive")
+        self.margin = margin
+        self.blank_spread = blank_spread
+        self.multi_mark = multi_mark
+
+    def __repr__(self):
+        return (f"SelectionPolicy(margin={self.margin!r}, blank_spread={self.blank_spread!r}, "
+                f"multi_mark={self.multi_mark!r})")
+
+    def decide(self, states, ratios):
+        """
+        (option index or -1, status code into STATUSES) for every row of
+        (..., options) state / ratio arrays; NaN ratios are missing bubbles.
+        """
+        states = np.asarray(states)
+        ratios = np.asarray(ratios, np.float64)
+        has = ~np.isnan(ratios)
+        marked = has & (states == MARKED)
+        n_options = has.sum(axis=-1)
+        n_marked = marked.sum(axis=-1)
+        n_ambiguous = (has & (states == AMBIGUOUS)).sum(axis=-1)
+
+        r = np.where(has, ratios, -np.inf)
+        order = np.argsort(-r, axis=-1, kind="stable")
+        best = order[..., 0]
+        top = np.take_along_axis(r, order[..., :2], axis=-1)
+        first = top[..., 0]
+        # a lone bubble has nothing to lead
+        second = np.where(n_options > 1, top[..., -1], first)
+        floor = np.where(has, ratios, np.inf).min(axis=-1)
+        best_state = np.take_along_axis(states, best[..., None], axis=-1)[..., 0]
+
+        pick = np.full(first.shape, -1, np.intp)
+        status = np.full(first.shape, _REVIEW, np.int8)
+        single = (n_marked == 1) & (n_ambiguous == 0)
+        pick[single] = marked.argmax(axis=-1)[single]
+        status[single] = _SINGLE
+        open_ = ~single & (n_options > 0)
+        blank = open_ & (n_marked == 0) & (n_ambiguous == 0)
+        status[blank] = _BLANK
+        open_ &= ~blank
+
+        if self.margin is not None:
+            # the darkest must also stand out more than the others differ among
+            # themselves, so a shading gradient along the row never resolves
+            lead = first - second
+            resolved = open_ & (best_state != BLANK) & (lead >= self.margin) & (lead > second - floor)
+            pick[resolved] = best[resolved]
+            status[resolved] = _RESOLVED
+            open_ &= ~resolved
+
+        faint = open_ & (n_marked == 0) & (n_options > 1) & (first - floor < self.blank_spread)
+        status[faint] = _BLANK
+        open_ &= ~faint
+        if self.multi_mark == "invalid":
+            status[open_ & (n_marked >= 2)] = _MULTI
+        return pick, status
+
+    def select_one(self, answer_options, ratios):
+        """(selected option or None, status) for one question's {opt: state} and {opt: ratio}"""
+        opts = list(answer_options)
+        states = np.array([_STATE_CODES[answer_options[o]] for o in opts], np.int8)
+        values = np.array([ratios.get(o, np.nan) for o in opts], np.float64)
+        pick, status = self.decide(states, values)
+        return (opts[int(pick)] if pick >= 0 else None), STATUSES[int(status)]
+
+    def select(self, compiled, detected, ratios):
+        """
+        {q: (selected option or None, status)} for a sheet's detect_from_template
+        states and fill ratios aligned with compiled.keys. Questions with an
+        unusable bbox always go to review.
+        """
+        states = np.array([_STATE_CODES[detected[q][opt]] for q, opt in compiled.keys], np.int8)
+        state_grid = compiled.grid(states, fill=AMBIGUOUS, dtype=np.int8)
+        ratio_grid = compiled.grid(ratios, fill=np.nan, dtype=np.float64)
+        picks, codes = self.decide(state_grid, ratio_grid)
+        unusable = {amb['q'] for amb in compiled.invalid}
+
+        selections = {}
+        for q in detected:
+            row = compiled.q_lookup.get(int(q)) if q not in unusable else None
+            if row is None:
+                selections[q] = (None, "review")
+                continue
+            pick = int(picks[row])
+            selections[q] = (compiled.options[pick] if pick >= 0 else None, STATUSES[int(codes[row])])
+        return selections
+
+def review_records(compiled, ratios, questions):
+    """
+    Records like detect_from_template's ambiguous ones ('q', 'option', 'ratio',
+    'rect') for every option of the given questions, so a reviewer sees each
+    queued question whole.
+    """
+    wanted = set(int(q) for q in questions)
+    records = []
+    for (q, opt), rect, ratio in zip(compiled.keys, compiled.rects(), np.asarray(ratios).tolist()):
+        if int(q) in wanted:
+            records.append({'q': q, 'option': opt, 'ratio': ratio, 'rect': rect})
+    return records
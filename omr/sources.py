@@ -0,0 +1,73 @@
+import fnmatch
+import glob
+import os
+import tarfile
+import zipfile
+
+IMAGE_EXTENSIONS = (".jpg", ".jpeg", ".png", ".bmp", ".tif", ".tiff", ".webp")
+
+def is_image_name(name):
+    return name.lower().endswith(IMAGE_EXTENSIONS)
+
+def _iter_zip(path, pattern, skip):
+    with zipfile.ZipFile(path) as zf:
+        for info in zf.infolist():
+            if info.is_dir() or not is_image_name(info.filename):
+                continue
+            if pattern and not fnmatch.fnmatch(info.filename, pattern):
+                continue
+            name = f"{path}:{info.filename}"
+            if name not in skip:
+                yield name, zf.read(info)
+
+def _iter_tar(path, pattern, skip):
+    # "r|*" streams the archive front to back, so compressed tars are never seeked
+    with tarfile.open(path, "r|*") as tf:
+        for member in tf:
+            if not member.isfile() or not is_image_name(member.name):
+                continue
+            if pattern and not fnmatch.fnmatch(member.name, pattern):
+                continue
+            name = f"{path}:{member.name}"
+            if name in skip:
+                continue
+            f = tf.extractfile(member)
+            if f is not None:
+                yield name, f.read()
+
+def _iter_dir(path, skip):
+    for root, dirs, files in os.walk(path):
+        dirs.sort()
+        for fn in sorted(files):
+            if is_image_name(fn):
+                full = os.path.join(root, fn)
+                if full not in skip:
+                    yield full, full
+
+def iter_images(inputs, pattern=None, skip=()):
+    """
+    Lazily yield (name, source) for every image found in inputs.
+
+    Each input may be a directory (walked recursively), a glob, a single image
+    file, or a zip/tar archive (optionally filtered by pattern on member names).
+    source is a file path for files on disk and bytes for archive members, so
+    only the members currently being graded are held in memory. Names in
+    skip are passed over without reading their bytes.
+    """
+    for inp in inputs:
+        if os.path.isdir(inp):
+            yield from _iter_dir(inp, skip)
+        elif os.path.isfile(inp) and zipfile.is_zipfile(inp):
+            yield from _iter_zip(inp, pattern, skip)
+        elif os.path.isfile(inp) and tarfile.is_tarfile(inp):
+            yield from _iter_tar(inp, pattern, skip)
+        elif os.path.isfile(inp):
+            if inp not in skip:
+                yield inp, inp
+        else:
+            matches = sorted(glob.glob(inp, recursive=True))
+            if not matches:
+                raise FileNotFoundError(f"No such file, directory or glob match: {inp}")
+            for m in matches:
+                if os.path.isfile(m) and is_image_name(m) and m not in skip:
+                    yield m, m
@@ -0,0 +1,330 @@
+"""
+Result persistence off the grading thread.
+
+    store = ResultStore("results", image_format="jpg", quality=90, preview_max_side=1600)
+    sheet_id = store.submit("scan01.jpg", result, images={'warped': warped, 'overlay': overlay})
+    ...
+    store.close()
+
+submit() only allocates the sheet id and queues the work; a background thread
+encodes the images (PNG, JPEG or WebP, optionally downscaled to a preview) and
+appends the records in batches to one JSONL file or SQLite database. Sheet ids
+come from a locked counter file, so they stay unique and increasing across
+threads, Streamlit sessions and processes sharing the same results directory.
+"""
+import atexit
+import json
+import os
+import queue
+import re
+import sqlite3
+import threading
+import time
+
+import cv2
+
+from omr import metrics
+
+try:
+    import fcntl
+except ImportError:  # Windows: ids are only unique within one process
+    fcntl = None
+
+IMAGE_FORMATS = ("png", "jpg", "webp")
+
+# submit() keyword default: use the store's own setting
+_UNSET = object()
+
+# where each image kind goes, relative to the store root; {id} is the sheet id
+IMAGE_DIRS = {'warped': ("images", "warped_{id}"), 'overlay': ("overlays", "overlay_{id}")}
+
+class IdAllocator:
+    """Monotonic integer ids backed by a counter file under an exclusive lock"""
+
+    def __init__(self, path, start=0):
+        self.path = path
+        self.start = start
+        self._lock = threading.Lock()
+
+    def next(self):
+        with self._lock:
+            fd = os.open(self.path, os.O_RDWR | os.O_CREAT, 0o644)
+            try:
+                if fcntl is not None:
+                    fcntl.flock(fd, fcntl.LOCK_EX)
+                data = os.pread(fd, 32, 0).strip()
+                value = max(int(data) if data else 0, self.start) + 1
+                os.pwrite(fd, b"%d\n" % value, 0)
+                os.ftruncate(fd, len(b"%d\n" % value))
+            finally:
+                os.close(fd)  # also drops the flock
+            return value
+
+def _legacy_max_id(root):
+    """Highest index among files written by the old listdir-numbered layout"""
+    top = 0
+    pattern = re.compile(r"_(\d+)\.\w+$")
+    for sub in ("images", "overlays"):
+        try:
+            names = os.listdir(os.path.join(root, sub))
+        except OSError:
+            continue
+        for fn in names:
+            m = pattern.search(fn)
+            if m:
+                top = max(top, int(m.group(1)))
+    return top
+
+def encode_image(image, image_format="png", quality=90, preview_max_side=None):
+    """Encode image to bytes, downscaled so its long side is at most preview_max_side"""
+    if image_format not in IMAGE_FORMATS:
+        raise ValueError(f"Unsupported image format {image_format!r}; use one of {IMAGE_FORMATS}")
+    if preview_max_side:
+        h, w = image.shape[:2]
+        scale = preview_max_side / float(max(h, w))
+        if scale < 1.0:
+            image = cv2.resize(image, (max(1, round(w * scale)), max(1, round(h * scale))),
+                               interpolation=cv2.INTER_AREA)
+    if image_format == "jpg":
+        params = [cv2.IMWRITE_JPEG_QUALITY, int(quality)]
+    elif image_format == "webp":
+        params = [cv2.IMWRITE_WEBP_QUALITY, int(quality)]
+    else:
+        # png is lossless; quality 0..100 maps onto compression 9..0
+        params = [cv2.IMWRITE_PNG_COMPRESSION, max(0, min(9, round((100 - int(quality)) / 11)))]
+    ok, buf = cv2.imencode("." + image_format, image, params)
+    if not ok:
+        raise ValueError(f"Could not encode image as {image_format}")
+    return buf.tobytes()
+
+def _write_atomic(path, data):
+    tmp = f"{path}.{os.getpid()}.{threading.get_ident()}.tmp"
+    with open(tmp, "wb") as f:
+        f.write(data)
+    os.replace(tmp, path)
+
+class _JsonlSink:
+    def __init__(self, path):
+        self.path = path
+
+    def write(self, records):
+        lines = "".join(json.dumps(r, separators=(",", ":")) + "\n" for r in records)
+        # one append per batch keeps concurrent writers from interleaving lines
+        with open(self.path, "a") as f:
+            f.write(lines)
+
+    def close(self):
+        pass
+
+class _SqliteSink:
+    def __init__(self, path):
+        self.path = path
+        self._conn = None
+
+    def _connect(self):
+        # created on the writer thread, which is the only one using it
+        conn = sqlite3.connect(self.path, timeout=30)
+        conn.execute("PRAGMA journal_mode=WAL")
+        conn.execute(
+            "CREATE TABLE IF NOT EXISTS results ("
+            " id INTEGER PRIMARY KEY, name TEXT, created REAL, template TEXT,"
+            " total_score REAL, result TEXT, images TEXT)")
+        return conn
+
+    def write(self, records):
+        if self._conn is None:
+            self._conn = self._connect()
+        rows = [(r['id'], r['name'], r['created'], r['result'].get('template_used'),
+                 r['result'].get('total_score'), json.dumps(r['result'], separators=(",", ":")),
+                 json.dumps(r['images'])) for r in records]
+        with self._conn:
+            self._conn.executemany("INSERT OR REPLACE INTO results VALUES (?, ?, ?, ?, ?, ?, ?)", rows)
+
+    def close(self):
+        if self._conn is not None:
+            self._conn.close()
+            self._conn = None
+
+class ResultStore:
+    """
+    Background writer for graded sheets under root.
+
+    backend: "jsonl" (root/results.jsonl) or "sqlite" (root/results.sqlite)
+    image_format: "png", "jpg", "webp", or None to keep no images
+    quality: JPEG/WebP quality, or PNG compression expressed as 0..100
+    preview_max_side: downscale saved images to this long side (None: full size)
+    queue_size: sheets that may wait for the writer before submit() blocks
+    batch_size: records appended per write
+
+    image_format, quality and preview_max_side are defaults; submit() takes
+    its own per sheet, so callers sharing one store (e.g. Streamlit sessions)
+    never need to change them. Writer failures are collected in .errors
+    rather than raised; failures() takes out those of one sheet. Stores not
+    closed explicitly are drained and closed at interpreter exit.
+    """
+
+    def __init__(self, root="results", backend="jsonl", image_format="png", quality=90,
+                 preview_max_side=None, queue_size=32, batch_size=64):
+        if backend not in ("jsonl", "sqlite"):
+            raise ValueError(f"Unknown result store backend {backend!r}")
+        if image_format is not None and image_format not in IMAGE_FORMATS:
+            raise ValueError(f"Unsupported image format {image_format!r}; use one of {IMAGE_FORMATS}")
+        self.root = root
+        self.backend = backend
+        self.image_format = image_format
+        self.quality = quality
+        self.preview_max_side = preview_max_side
+        self.batch_size = batch_size
+        for sub, _ in IMAGE_DIRS.values():
+            os.makedirs(os.path.join(root, sub), exist_ok=True)
+        counter = os.path.join(root, ".next_id")
+        # scan old files only once, before the counter exists
+        self.ids = IdAllocator(counter, start=0 if os.path.exists(counter) else _legacy_max_id(root))
+        if backend == "jsonl":
+            self.path = os.path.join(root, "results.jsonl")
+            self._sink = _JsonlSink(self.path)
+        else:
+            self.path = os.path.join(root, "results.sqlite")
+            self._sink = _SqliteSink(self.path)
+        self.errors = []
+        self._errors_lock = threading.Lock()
+        self._queue = queue.Queue(maxsize=queue_size)
+        self._closed = False
+        self._thread = threading.Thread(target=self._run, name="omr-result-store", daemon=True)
+        self._thread.start()
+        # the writer is a daemon thread: drain it before the interpreter exits
+        atexit.register(self.close)
+
+    def image_path(self, sheet_id, kind, image_format=None):
+        sub, stem = IMAGE_DIRS[kind]
+        return os.path.join(self.root, sub, f"{stem.format(id=sheet_id)}.{image_format or self.image_format}")
+
+    def submit(self, name, result, images=None, image_format=_UNSET, quality=_UNSET, preview_max_side=_UNSET):
+        """
+        Queue one graded sheet; returns its id right away.
+
+        images maps a kind ('warped', 'overlay') to an array, or to a
+        zero-argument callable producing one, which then runs on the writer
+        thread (e.g. lambda: draw_overlay(...)). Arrays must not be modified
+        after submitting. image_format, quality and preview_max_side override
+        the store's settings for this sheet only.
+        """
+        if self._closed:
+            raise ValueError("ResultStore is closed")
+        for kind in images or ():
+            if kind not in IMAGE_DIRS:
+                raise ValueError(f"Unknown image kind {kind!r}")
+        if image_format is _UNSET:
+            image_format = self.image_format
+        elif image_format is not None and image_format not in IMAGE_FORMATS:
+            raise ValueError(f"Unsupported image format {image_format!r}; use one of {IMAGE_FORMATS}")
+        codec = (image_format, self.quality if quality is _UNSET else quality,
+                 self.preview_max_side if preview_max_side is _UNSET else preview_max_side)
+        sheet_id = self.ids.next()
+        self._queue.put((sheet_id, name, result, images or {}, codec, time.time()))
+        return sheet_id
+
+    def _save_images(self, sheet_id, images, codec):
+        image_format, quality, preview_max_side = codec
+        paths = {}
+        if image_format is None:
+            return paths
+        for kind, image in images.items():
+            if callable(image):
+                image = image()
+            if image is None:
+                continue
+            path = self.image_path(sheet_id, kind, image_format)
+            _write_atomic(path, encode_image(image, image_format, quality, preview_max_side))
+            paths[kind] = os.path.relpath(path, self.root)
+        return paths
+
+    def _run(self):
+        pending = []
+        while True:
+            try:
+                job = self._queue.get(timeout=0.5 if pending else None)
+            except queue.Empty:
+                job = False
+            if job:
+                sheet_id, name, result, images, codec, created = job
+                try:
+                    with metrics.stage("persist"):
+                        paths = self._save_images(sheet_id, images, codec)
+                except Exception as e:
+                    with self._errors_lock:
+                        self.errors.append((sheet_id, f"{type(e).__name__}: {e}"))
+                    paths = {}
+                pending.append({'id': sheet_id, 'name': name, 'created': created,
+                                'result': result, 'images': paths})
+            # write when the batch is full or the queue has gone idle
+            if pending and (job is None or len(pending) >= self.batch_size or self._queue.empty()):
+                try:
+                    self._sink.write(pending)
+                except Exception as e:
+                    with self._errors_lock:
+                        self.errors.extend((r['id'], f"{type(e).__name__}: {e}") for r in pending)
+                pending = []
+            if job is not False:
+                self._queue.task_done()
+            if job is None:
+                self._sink.close()
+                return
+
+    def flush(self):
+        """Block until every submitted sheet is on disk"""
+        self._queue.join()
+
+    def failures(self, sheet_id):
+        """Take the writer errors recorded for one sheet out of .errors (call flush() first)"""
+        with self._errors_lock:
+            mine = [err for sid, err in self.errors if sid == sheet_id]
+            if mine:
+                self.errors[:] = [(sid, err) for sid, err in self.errors if sid != sheet_id]
+        return mine
+
+    def close(self):
+        if self._closed:
+            return
+        self._closed = True
+        atexit.unregister(self.close)
+        self._queue.put(None)
+        self._thread.join()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+
+def iter_records(root="results"):
+    """Stored records (dicts with id, name, created, result, images), oldest first"""
+    path = os.path.join(root, "results.sqlite")
+    if os.path.exists(path):
+        conn = sqlite3.connect(path)
+        try:
+            for row in conn.execute("SELECT id, name, created, result, images FROM results ORDER BY id"):
+                yield {'id': row[0], 'name': row[1], 'created': row[2],
+                       'result': json.loads(row[3]), 'images': json.loads(row[4])}
+        finally:
+            conn.close()
+    path = os.path.join(root, "results.jsonl")
+    if os.path.exists(path):
+        with open(path) as f:
+            for line in f:
+                if line.strip():
+                    yield json.loads(line)
+
+
+_stores = {}
+_stores_lock = threading.Lock()
+
+def default_store(root="results", **kwargs):
+    """Process-wide ResultStore for root, created with kwargs on first use"""
+    key = os.path.abspath(root)
+    with _stores_lock:
+        store = _stores.get(key)
+        if store is None or store._closed:
+            store = _stores[key] = ResultStore(root, **kwargs)
+        return store
@@ -0,0 +1,259 @@
+from collections import OrderedDict
+import copy
+import math
+import threading
+
+import numpy as np
+
+def _frozen(values, dtype):
+    arr = np.ascontiguousarray(np.asarray(values, dtype=dtype))
+    arr.setflags(write=False)
+    return arr
+
+def _packed_axis(starts, sizes, n):
+    """Indices along one axis covered by any [start, start+size) span, and
+    each span's start position within that packed index list"""
+    cover = np.zeros(n + 1, np.int32)
+    np.add.at(cover, starts, 1)
+    np.add.at(cover, starts + sizes, -1)
+    covered = np.cumsum(cover[:-1]) > 0
+    position = np.cumsum(covered) - 1
+    return np.flatnonzero(covered), position[starts]
+
+class CompiledTemplate:
+    """
+    Pixel geometry of a template for one warped size (width, height).
+
+    Built once per (template, size) and then shared read-only by the
+    detector, scorer and overlay renderer:
+      keys: [(q, option)] for every bubble that can be sampled, in template order
+      xs, ys, ws, hs: clipped pixel rectangles (int arrays aligned with keys)
+      questions: sorted question numbers; q_row / option_index index into
+                 questions / options for every bubble
+      subjects: [(name, q_start, q_count)]; subject_rows: question rows per subject
+      invalid: ambiguous records for entries without a usable bbox
+      offsets: None, or for a shifted() copy the (dx, dy) arrays it was moved
+               by, as fractions of the width / height, so resized() keeps them
+    """
+
+    def __init__(self, template, size):
+        if 'bubbles' not in template:
+            raise ValueError("Template missing 'bubbles' key")
+        if not template['bubbles']:
+            raise ValueError("Template has no bubbles defined")
+
+        w, h = int(size[0]), int(size[1])
+        if w <= 0 or h <= 0:
+            raise ValueError("Image has zero dimensions")
+
+        self.template = template
+        self.version = template.get('version')
+        self.size = (w, h)
+        self.offsets = None
+
+        # every (q, option) in template order; None answers for invalid ones
+        self.order = []
+        self.invalid = []
+        keys = []
+        boxes = []
+        for entry in template['bubbles']:
+            try:
+                q = int(entry['q'])
+                opt = entry.get('option')
+                bbox = entry.get('bbox')
+
+                if bbox is None:
+                    self.invalid.append({'q': q, 'option': opt, 'reason': 'missing-bbox'})
+                    self.order.append((q, opt))
+                    continue
+
+                xn, yn, wn, hn = (float(v) for v in bbox)
+                self.order.append((q, opt))
+                keys.append((q, opt))
+                boxes.append((xn, yn, wn, hn))
+
+            except (KeyError, ValueError, TypeError) as e:
+                self.invalid.append({'q': entry.get('q', 'unknown'), 'option': entry.get('option', 'unknown'), 'reason': f'parsing-error: {str(e)}'})
+                continue
+
+        self.keys = keys
+        boxes = np.asarray(boxes, dtype=np.float64).reshape(-1, 4)
+        # same truncation as bbox_norm_to_px, then clip inside the image
+        xs = (boxes[:, 0] * w).astype(np.intp)
+        ys = (boxes[:, 1] * h).astype(np.intp)
+        ws = (boxes[:, 2] * w).astype(np.intp)
+        hs = (boxes[:, 3] * h).astype(np.intp)
+        xs = np.clip(xs, 0, w - 1)
+        ys = np.clip(ys, 0, h - 1)
+        ws = np.maximum(1, np.minimum(ws, w - xs))
+        hs = np.maximum(1, np.minimum(hs, h - ys))
+        self.xs = _frozen(xs, np.intp)
+        self.ys = _frozen(ys, np.intp)
+        self.ws = _frozen(ws, np.intp)
+        self.hs = _frozen(hs, np.intp)
+
+        # question / option lookup tables
+        qs = np.asarray([q for q, _ in keys], dtype=np.int64)
+        options = []
+        option_lookup = {}
+        for _, opt in keys:
+            if opt not in option_lookup:
+                option_lookup[opt] = len(options)
+                options.append(opt)
+        self.options = tuple(options)
+        self.option_lookup = option_lookup
+        self.questions = _frozen(np.unique(qs), np.int64)
+        self.q_lookup = {int(q): i for i, q in enumerate(self.questions)}
+        self.q_row = _frozen(np.searchsorted(self.questions, qs), np.intp)
+        self.option_index = _frozen([option_lookup[opt] for _, opt in keys], np.intp)
+
+        self.subjects = []
+        subject_rows = []
+        for s in template.get('subjects', []):
+            q_start = int(s['q_start'])
+            q_count = int(s['q_count'])
+            self.subjects.append((s['name'], q_start, q_count))
+            rows = [self.q_lookup[qi] for qi in range(q_start, q_start + q_count) if qi in self.q_lookup]
+            subject_rows.append(_frozen(rows, np.intp))
+        self.subject_rows = subject_rows
+
+        self._pack()
+
+    def _pack(self):
+        """Rows/columns covered by bubbles, for the packed detection canvas"""
+        w, h = self.size
+        if self.keys:
+            rows, ys_packed = _packed_axis(self.ys, self.hs, h)
+            cols, xs_packed = _packed_axis(self.xs, self.ws, w)
+        else:
+            rows = cols = ys_packed = xs_packed = np.zeros(0, np.intp)
+        self.rows = _frozen(rows, np.intp)
+        self.cols = _frozen(cols, np.intp)
+        self.ys_packed = _frozen(ys_packed, np.intp)
+        self.xs_packed = _frozen(xs_packed, np.intp)
+
+    def __len__(self):
+        return len(self.keys)
+
+    def __repr__(self):
+        return f"CompiledTemplate(version={self.version!r}, size={self.size}, bubbles={len(self.keys)})"
+
+    def rects(self):
+        """Iterate (x, y, w, h) tuples aligned with keys"""
+        return zip(self.xs.tolist(), self.ys.tolist(), self.ws.tolist(), self.hs.tolist())
+
+    def grid(self, values, fill=np.nan, dtype=np.float32):
+        """Per-bubble values (aligned with keys) as a (questions x options) array"""
+        out = np.full((len(self.questions), len(self.options)), fill, dtype)
+        out[self.q_row, self.option_index] = values
+        return out
+
+    def resized(self, size):
+        """Same template compiled for another warped size, shifted like this one"""
+        compiled = compile_template(self.template, size)
+        if self.offsets is None:
+            return compiled
+        w, h = compiled.size
+        return compiled.shifted(self.offsets[0] * w, self.offsets[1] * h)
+
+    def moved_to(self, xs, ys):
+        """Copy with the bubbles at pixel positions xs, ys (e.g. saved from a shifted copy)"""
+        return self.shifted(np.asarray(xs) - self.xs, np.asarray(ys) - self.ys)
+
+    def shifted(self, dx, dy):
+        """
+        Copy with every bubble moved by (dx, dy) pixels, scalars or arrays
+        aligned with keys (e.g. from omr.register). Not memoized.
+        """
+        w, h = self.size
+        moved = copy.copy(self)
+        xs = np.clip(self.xs + np.rint(dx).astype(np.intp), 0, w - 1)
+        ys = np.clip(self.ys + np.rint(dy).astype(np.intp), 0, h - 1)
+        # the shift as applied, so a copy rebuilt with moved_to() resizes the same way
+        fx, fy = self.offsets if self.offsets is not None else (0.0, 0.0)
+        moved.offsets = (_frozen(fx + (xs - self.xs) / w, np.float64), _frozen(fy + (ys - self.ys) / h, np.float64))
+        moved.ws = _frozen(np.maximum(1, np.minimum(self.ws, w - xs)), np.intp)
+        moved.hs = _frozen(np.maximum(1, np.minimum(self.hs, h - ys)), np.intp)
+        moved.xs = _frozen(xs, np.intp)
+        moved.ys = _frozen(ys, np.intp)
+        moved._pack()
+        return moved
+
+
+def smallest_bubble(template):
+    """Smallest normalized (width, height) among the template's bubble bboxes"""
+    if isinstance(template, CompiledTemplate):
+        template = template.template
+    min_w = min_h = None
+    for entry in template.get('bubbles', []):
+        try:
+            wn, hn = float(entry['bbox'][2]), float(entry['bbox'][3])
+        except (KeyError, IndexError, TypeError, ValueError):
+            continue
+        if wn <= 0 or hn <= 0:
+            continue
+        min_w = wn if min_w is None else min(min_w, wn)
+        min_h = hn if min_h is None else min(min_h, hn)
+    if min_w is None:
+        return None
+    return min_w, min_h
+
+def grading_size(templates, output_size=(2480, 3508), min_bubble_px=16):
+    """
+    Smallest canvas with output_size's aspect ratio on which every bubble of
+    every template is at least min_bubble_px pixels wide and tall.
+
+    templates may be one template or an iterable of them (e.g. every template a
+    QR code could select). Never larger than output_size.
+    """
+    if isinstance(templates, (dict, CompiledTemplate)):
+        templates = [templates]
+    out_w, out_h = output_size
+    scale = 0.0
+    for template in templates:
+        smallest = smallest_bubble(template)
+        if smallest is None:
+            return tuple(output_size)
+        min_w, min_h = smallest
+        scale = max(scale, min_bubble_px / (min_w * out_w), min_bubble_px / (min_h * out_h))
+    if scale <= 0 or scale >= 1:
+        return tuple(output_size)
+    return (int(math.ceil(out_w * scale)), int(math.ceil(out_h * scale)))
+
+
+_CACHE_SIZE = 32
+_cache = OrderedDict()
+_cache_lock = threading.Lock()
+
+def compile_template(template, size):
+    """
+    Return the CompiledTemplate for (template, size), memoized with LRU eviction.
+
+    Entries are keyed by the template object's identity, so a template dict
+    must not be mutated after it was compiled; load a fresh one instead.
+    A CompiledTemplate is accepted too and recompiled only if the size
+    differs, keeping the shifts of a shifted() copy (CompiledTemplate.resized).
+    """
+    if isinstance(template, CompiledTemplate):
+        if template.size == (int(size[0]), int(size[1])):
+            return template
+        return template.resized(size)
+
+    key = (id(template), int(size[0]), int(size[1]))
+    with _cache_lock:
+        hit = _cache.get(key)
+        if hit is not None and hit.template is template:
+            _cache.move_to_end(key)
+            return hit
+
+    compiled = CompiledTemplate(template, size)
+    with _cache_lock:
+        _cache[key] = compiled
+        _cache.move_to_end(key)
+        while len(_cache) > _CACHE_SIZE:
+            _cache.popitem(last=False)
+    return compiled
+
+def clear_template_cache():
+    with _cache_lock:
+        _cache.clear()
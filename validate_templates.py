@@ -5,6 +5,8 @@ Validate template files for OMR system
 import json
 import os
 
+from omr.fiducials import parse_fiducials
+
 def validate_template(template_path):
     """Validate a single template file"""
     try:
@@ -75,6 +77,15 @@ def validate_template(template_path):
                 return False
 
         print(f"  ✅ All bubbles validated successfully")
+
+        # Validate corner fiducials, if declared
+        if template.get('fiducials'):
+            try:
+                layout = parse_fiducials(template['fiducials'])
+            except ValueError as e:
+                print(f"  ❌ Invalid fiducials: {e}")
+                return False
+            print(f"  ✅ Fiducials: {layout['type']} markers")
         return True
 
     except json.JSONDecodeError as e: